@@ -0,0 +1,93 @@
+"""
+Ports that are prepared from a source archive downloaded over HTTP, rather than
+from a Git mirror.
+
+Only the file tree at a single tag is needed to prepare a package, so for
+large or one-off repositories a source archive is much cheaper than cloning
+the full history. Archives are kept in the download cache, and are extracted
+into the blob store (see :mod:`dds_ports.blobs`) with the port's prune rules
+applied during extraction.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from . import blobs, cache, github, staging
+from .deferred import dagon
+from .port import PackageID
+from .prune import DEFAULT_RULES, PruneRules
+
+if TYPE_CHECKING:
+    from dagon import task
+
+
+class ArchivePort:
+    """
+    A port that is prepared from the tar archive at ``url``.
+
+    :param download_key: The key of the archive in the download cache.
+    :param strip_components: The number of leading path components to remove
+        from the archive members (``1`` for GitHub source archives, which have
+        a single top-level directory).
+    """
+    def __init__(self,
+                 pkg_id: PackageID,
+                 url: str,
+                 download_key: str,
+                 *,
+                 strip_components: int = 1,
+                 prune: PruneRules = DEFAULT_RULES,
+                 cost_hint: float | None = None) -> None:
+        self._pid = pkg_id
+        self._url = url
+        self._key = download_key
+        self._strip = strip_components
+        self._prune = prune
+        self._cost_hint = cost_hint
+
+    @property
+    def package_id(self) -> PackageID:
+        """The ID of the package prepared from the archive"""
+        return self._pid
+
+    @property
+    def cost_hint(self) -> float | None:
+        """The rough number of seconds the package takes to prepare and import (see :func:`.port.cost_hint`)"""
+        return self._cost_hint
+
+    async def _make_sdist(self) -> Path:
+        archive = await cache.cached_download(self._url, self._key)
+        tree = await staging.current().create(str(self.package_id))
+        dagon.ui.status(f'Generating sdist for {self.package_id}')
+        async with cache.locked(archive, shared=True):
+            cache.touch('downloads', archive)
+            await blobs.extract_archive(archive, tree, self._prune, strip_components=self._strip)
+        return await self.prepare(tree)
+
+    async def prepare(self, tree: Path) -> Path:
+        return tree
+
+    def make_prep_task(self) -> task.Task[Path]:
+        download = dagon.task.fn_task(f'{self.package_id}@download', self._make_sdist)
+        dagon.pool.assign(download, 'cloner')
+        return download
+
+    def __repr__(self) -> str:
+        return f'<ArchivePort package={self.package_id} url=[{self._url}]>'
+
+
+def github_archive_port(owner: str,
+                        repo: str,
+                        tag: str,
+                        pkg_id: PackageID,
+                        *,
+                        prune: PruneRules = DEFAULT_RULES,
+                        cost_hint: float | None = None) -> ArchivePort:
+    """Create a port that is prepared from the source archive of a tag of a GitHub repository"""
+    return ArchivePort(pkg_id,
+                       github.gh_archive_url(owner, repo, tag),
+                       github.gh_archive_key(owner, repo, tag),
+                       prune=prune,
+                       cost_hint=cost_hint)
@@ -4,19 +4,18 @@ from copy import deepcopy
 import itertools
 from asyncio import Semaphore
 from pathlib import Path
-from typing import Callable, Iterable, Sequence, Optional, NamedTuple, Awaitable, cast
-from typing_extensions import TypedDict
-import json5
-
-import dagon.ui
-import dagon.fs
-import dagon.proc
-import dagon.pool
-from dagon import task
+from typing import TYPE_CHECKING, Callable, Iterable, Sequence, Optional, NamedTuple, Awaitable, cast
+from typing_extensions import Literal, TypedDict
+
 from semver import VersionInfo
 
 from dds_ports.port import Port, PackageID
-from dds_ports import git, github, util, crs
+from dds_ports import archive, git, github, util, crs, selection
+from dds_ports.deferred import dagon
+from dds_ports.prune import DEFAULT_RULES, PruneRules
+
+if TYPE_CHECKING:
+    from dagon import task
 
 PackageJSON = TypedDict('PackageJSON', {
     'name': str,
@@ -32,10 +31,17 @@ LibraryJSON = TypedDict('LibraryJSON', {
 
 FSTransformFn = Callable[[Path], Awaitable[None]]
 
-BUILD_SEMAPHORE = Semaphore(1)
+PortSource = Literal['git', 'archive']
+"""
+Where the upstream tree of a port comes from: A checkout of a Git mirror, or
+the source archive of the tag (see :mod:`dds_ports.archive`)
+"""
+
+BUILD_SEMAPHORE = util.LoopLocal(lambda: Semaphore(1))
 
 
 def read_package_json(dirpath: Path) -> PackageJSON:
+    import json5
     for fname in ('package.json', 'package.jsonc', 'package.json5'):
         cand = dirpath / fname
         if not cand.is_file():
@@ -45,6 +51,7 @@ def read_package_json(dirpath: Path) -> PackageJSON:
 
 
 def read_library_jsons(dirpath: Path) -> Iterable[tuple[Path, LibraryJSON]]:
+    import json5
     lib_fnames = ('library.json', 'library.jsonc', 'library.json5')
     for fname in lib_fnames:
         cand = dirpath / fname
@@ -70,9 +77,14 @@ class SimpleGitHubAdaptingPort(NamedTuple):
     crs_json: crs.CRS_JSON
     fs_transform: FSTransformFn
     try_build: bool
+    prune: PruneRules = DEFAULT_RULES
+    "Which files of the upstream tree are left out, before ``fs_transform`` runs"
+    source: PortSource = 'git'
+    cost_hint: Optional[float] = None
+    "The rough number of seconds the package takes to prepare and import (see :func:`.port.cost_hint`)"
 
     async def _prep_crs(self, cloner: task.Task[Path]) -> Path:
-        clone: Path = await task.result_of(cloner)
+        clone: Path = await dagon.task.result_of(cloner)
         dagon.ui.status(f'Generating sdist for {self.package_id}')
         full_crs_json = deepcopy(self.crs_json)
         full_crs_json['name'] = self.package_id.name
@@ -83,13 +95,18 @@ class SimpleGitHubAdaptingPort(NamedTuple):
         return clone
 
     def make_prep_task(self) -> task.Task[Path]:
-        simple = git.SimpleGitPort(
-            f'gh/{self.owner}/{self.repo}',
-            self.package_id,
-            github.gh_repo_url(self.owner, self.repo),
-            self.tag,
-        ).make_prep_task()
-        return task.fn_task(f'{self.package_id}@fixup', lambda: self._prep_crs(simple), depends=[simple])
+        if self.source == 'archive':
+            simple = archive.github_archive_port(self.owner, self.repo, self.tag, self.package_id,
+                                                 prune=self.prune).make_prep_task()
+        else:
+            simple = git.SimpleGitPort(
+                github.gh_clone_key(self.owner, self.repo),
+                self.package_id,
+                github.gh_repo_url(self.owner, self.repo),
+                self.tag,
+                prune=self.prune,
+            ).make_prep_task()
+        return dagon.task.fn_task(f'{self.package_id}@fixup', lambda: self._prep_crs(simple), depends=[simple])
 
 
 def _version_in_range(ver: VersionInfo, min_: VersionInfo, max_: VersionInfo) -> bool:
@@ -122,7 +139,13 @@ async def get_repo_ports(
     pkg_version: int,
     tagged_versions: Iterable[tuple[str, VersionInfo]] | None = None,
     tag_mapper: TagVersionMapFn = util.tag_as_version,
+    prune: PruneRules = DEFAULT_RULES,
+    source: PortSource = 'git',
+    cost_hint: Optional[float] = None,
 ) -> Iterable[Port]:
+    sel = selection.current()
+    if not sel.wants_package(crs_json['name']):
+        return ()
     if tagged_versions is None:
         tags = list(await github.get_repo_tags(owner, repo))
         tagged_versions_1 = list((tag, _tag_as_version(tag, owner, repo, tag_mapper)) for tag in tags)
@@ -136,9 +159,12 @@ async def get_repo_ports(
             crs_json=crs_json,
             fs_transform=fs_transform,
             try_build=try_build,
+            prune=prune,
+            source=source,
+            cost_hint=cost_hint,
         )  #
         for tag, version in tagged_versions  #
-        if _version_in_range(version, min_version, max_version)  #
+        if _version_in_range(version, min_version, max_version) and sel.wants_version(version)  #
     )
 
 
@@ -159,6 +185,9 @@ async def enumerate_simple_github(
     try_build: bool = False,
     tagged_versions: Iterable[tuple[str, VersionInfo]] | None = None,
     tag_mapper: TagVersionMapFn = util.tag_as_version,
+    prune: PruneRules = DEFAULT_RULES,
+    source: PortSource = 'git',
+    cost_hint: Optional[float] = None,
 ) -> Iterable[Port]:
     return await get_repo_ports(
         owner,
@@ -188,4 +217,7 @@ async def enumerate_simple_github(
         pkg_version=pkg_version,
         tagged_versions=tagged_versions,
         tag_mapper=tag_mapper,
+        prune=prune,
+        source=source,
+        cost_hint=cost_hint,
     )
@@ -0,0 +1,371 @@
+"""
+Content-addressed store of file contents, shared by the staged sdists of all
+ports.
+
+Rather than making a separate checkout of every version of a project, a staged
+tree is assembled from hard links into a store of Git blobs, keyed by blob ID
+and executable bit. Trees are assembled either from a Git mirror
+(:func:`checkout`) or from a source archive (:func:`extract_archive`).
+Consecutive versions of a project share most of their files, and so share the
+disk space and page cache of those files.
+
+Files in the store (and so the files of a freshly checked out tree) always
+have the modification time :data:`BLOB_MTIME`. A transform that modifies a
+checked-out file in place must first detach it from the store with
+:func:`dds_ports.fs.detach`
+(copy-on-write), or it would modify the file in every tree that shares it.
+:func:`verify` detects files that were modified in place anyway.
+
+The store is one entry in the dds-ports cache (see :mod:`dds_ports.cache`), and
+is evicted as a unit.
+"""
+
+from __future__ import annotations
+
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, NamedTuple
+
+from . import cache, fs, ioacct
+from .prune import NO_PRUNE, PruneRules
+
+BLOB_MTIME = 315532800
+"The modification time of every file in the blob store (1980-01-01)"
+
+GIT_TIMEOUT: float | None = 10 * 60
+"Seconds after which a Git command that reads from a mirror is killed as hung (``None`` waits forever)"
+
+_UNSUPPORTED_ATTRIBUTES = ('filter=', 'eol=', 'ident', 'working-tree-encoding=')
+"Git attributes that make a checkout differ from the stored blobs"
+
+
+class TreeEntry(NamedTuple):
+    """A file within a Git tree"""
+    mode: str
+    oid: str
+    size: int
+    path: str
+
+
+def _git(mirror: Path, *args: str) -> bytes:
+    out = subprocess.run(['git', *args],
+                         cwd=mirror,
+                         check=True,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         timeout=GIT_TIMEOUT).stdout
+    ioacct.count('git', nbytes=len(out))
+    return out
+
+
+def _resolve_tree(mirror: Path, ref: str) -> str:
+    for cand in (f'refs/tags/{ref}', f'refs/remotes/origin/{ref}', f'refs/heads/{ref}'):
+        res = subprocess.run(['git', 'rev-parse', '--verify', '--quiet', f'{cand}^{{tree}}'],
+                             cwd=mirror,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL,
+                             check=False,
+                             timeout=GIT_TIMEOUT)
+        ioacct.count('git', nbytes=len(res.stdout))
+        if res.returncode == 0:
+            return res.stdout.decode().strip()
+    raise RuntimeError(f'No tag or branch "{ref}" in Git repository [{mirror}]')
+
+
+def list_tree(mirror: Path, ref: str) -> list[TreeEntry]:
+    """List every file and submodule within the given tag or branch of a repository"""
+    out = _git(mirror, 'ls-tree', '-r', '-z', '-l', '--full-tree', _resolve_tree(mirror, ref))
+    entries: list[TreeEntry] = []
+    for rec in out.decode().split('\0'):
+        if not rec:
+            continue
+        meta, path = rec.split('\t', 1)
+        mode, _type, oid, size = meta.split()
+        entries.append(TreeEntry(mode, oid, 0 if size == '-' else int(size), path))
+    return entries
+
+
+def store_dir() -> Path:
+    """The directory of the blob store"""
+    return cache.cache_dir('blobs')
+
+
+def _blob_path(entry: TreeEntry) -> Path:
+    suffix = '.x' if entry.mode == '100755' else ''
+    return store_dir() / entry.oid[:2] / f'{entry.oid[2:]}{suffix}'
+
+
+def _is_intact(blob: Path, entry: TreeEntry) -> bool:
+    try:
+        st = blob.stat()
+    except FileNotFoundError:
+        return False
+    return st.st_size == entry.size and st.st_mtime == BLOB_MTIME
+
+
+def _read_blob(catfile: subprocess.Popen[bytes], oid: str) -> bytes:
+    stdin: IO[bytes] = catfile.stdin  # type: ignore
+    stdout: IO[bytes] = catfile.stdout  # type: ignore
+    stdin.write(f'{oid}\n'.encode())
+    stdin.flush()
+    header = stdout.readline().decode().split()
+    if len(header) != 3:
+        raise RuntimeError(f'Failed to read Git object {oid}: {" ".join(header)}')
+    content = stdout.read(int(header[2]))
+    if len(content) != int(header[2]):
+        raise RuntimeError(f'Failed to read Git object {oid}: The output of git cat-file ended early')
+    stdout.read(1)
+    ioacct.count('git', nbytes=len(content))
+    return content
+
+
+def _store_blob(blob: Path, entry: TreeEntry, content: bytes) -> None:
+    blob.parent.mkdir(exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=blob.parent, prefix=f'.{blob.name}.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.chmod(tmp, 0o755 if entry.mode == '100755' else 0o644)
+    os.utime(tmp, (BLOB_MTIME, BLOB_MTIME))
+    os.replace(tmp, blob)
+    ioacct.count('fs', nbytes=len(content), files=1, ops=4)
+
+
+def _place(blob: Path, dest: Path) -> None:
+    try:
+        os.link(blob, dest)
+        ioacct.count('fs', files=1)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            raise
+        # Not on the same filesystem as the store (or too many links). Copy instead.
+        shutil.copy2(blob, dest)
+        ioacct.count('fs', nbytes=dest.stat().st_size, files=1)
+
+
+@contextmanager
+def _deadline(proc: subprocess.Popen[bytes], timeout: float | None) -> Iterator[None]:
+    """
+    Kill ``proc`` if the context has not exited after ``timeout`` seconds. The
+    resulting failure to talk with it is raised as :class:`subprocess.TimeoutExpired`.
+    """
+    if timeout is None:
+        yield
+        return
+    expired = threading.Event()
+
+    def expire() -> None:
+        expired.set()
+        proc.kill()
+
+    # Reads from the process block, so it is killed from another thread
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        yield
+    except Exception as e:
+        if expired.is_set():
+            raise subprocess.TimeoutExpired(proc.args, timeout) from e
+        raise
+    finally:
+        timer.cancel()
+
+
+def _needs_real_checkout(entries: list[TreeEntry], catfile: subprocess.Popen[bytes]) -> bool:
+    for ent in entries:
+        if os.path.basename(ent.path) == '.gitattributes':
+            attrs = _read_blob(catfile, ent.oid).decode(errors='replace')
+            if any(a in attrs for a in _UNSUPPORTED_ATTRIBUTES):
+                return True
+    return False
+
+
+def checkout_sync(mirror: Path, ref: str, dest: Path, prune: PruneRules = NO_PRUNE) -> bool:
+    """Synchronous version of :func:`checkout`"""
+    entries = [ent for ent in list_tree(mirror, ref) if not prune.excludes(ent.path)]
+    with subprocess.Popen(['git', 'cat-file', '--batch'], cwd=mirror, stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE) as catfile, _deadline(catfile, GIT_TIMEOUT):
+        ioacct.count('git')
+        try:
+            if _needs_real_checkout(entries, catfile):
+                return False
+            for ent in entries:
+                target = dest / ent.path
+                target.parent.mkdir(exist_ok=True, parents=True)
+                if ent.mode == '160000':
+                    # A submodule. A plain clone leaves an empty directory.
+                    target.mkdir(exist_ok=True)
+                    continue
+                if ent.mode == '120000':
+                    os.symlink(_read_blob(catfile, ent.oid), target)
+                    continue
+                blob = _blob_path(ent)
+                if not _is_intact(blob, ent):
+                    _store_blob(blob, ent, _read_blob(catfile, ent.oid))
+                _place(blob, target)
+        finally:
+            catfile.stdin.close()  # type: ignore
+    return True
+
+
+async def checkout(mirror: Path, ref: str, dest: Path, prune: PruneRules = NO_PRUNE) -> bool:
+    """
+    Check out the given tag or branch of the Git repository at ``mirror`` into
+    the (empty) directory ``dest``, with hard links into the blob store. Files
+    excluded by ``prune`` are not checked out. The caller should hold a shared
+    lock on the mirror.
+
+    Returns ``False`` (and leaves ``dest`` empty) if the repository uses Git
+    attributes that transform file content on checkout. Such repositories need
+    a real ``git clone``.
+    """
+    store = store_dir()
+    async with cache.locked(store, shared=True):
+        cache.touch('blobs', store)
+        return await fs.run_fs_op(lambda: checkout_sync(mirror, ref, dest, prune))
+
+
+def _archive_relpath(name: str, strip_components: int) -> str | None:
+    parts = [p for p in name.split('/') if p not in ('', '.')]
+    if '..' in parts:
+        raise RuntimeError(f'Refusing to extract archive member with a parent-relative path: {name}')
+    parts = parts[strip_components:]
+    return '/'.join(parts) if parts else None
+
+
+def _is_within(root: Path, path: Path) -> bool:
+    return path == root or root in path.parents
+
+
+def _is_link_within(root: Path, parent: Path, linkname: str) -> bool:
+    """
+    Whether a symlink in the (real) directory ``parent`` to ``linkname`` stays
+    within ``root``. Only leading parent-relative components are allowed, as
+    those are not resolved through other symlinks.
+    """
+    if os.path.isabs(linkname):
+        return False
+    parts = [p for p in linkname.split('/') if p not in ('', '.')]
+    ups = 0
+    while ups < len(parts) and parts[ups] == '..':
+        ups += 1
+    if '..' in parts[ups:]:
+        return False
+    return _is_within(root, Path(os.path.normpath(parent / '/'.join(parts[:ups] or ['.']))))
+
+
+def _real_parent(root: Path, relpath: str, member: str, known: dict[str, Path]) -> Path:
+    """
+    The real path of the directory in which the archive member at ``relpath``
+    is extracted. Raises if a symlink leads it out of ``root``.
+    """
+    parent = os.path.dirname(relpath)
+    real = known.get(parent)
+    if real is None:
+        real = (root / parent).resolve()
+        if not _is_within(root, real):
+            raise RuntimeError(f'Refusing to extract archive member through a symlink that leaves the tree: {member}')
+        # The directory is created right away, so it can no longer be replaced with a symlink
+        real.mkdir(exist_ok=True, parents=True)
+        known[parent] = real
+    return real
+
+
+def extract_archive_sync(archive: Path, dest: Path, prune: PruneRules = NO_PRUNE, *, strip_components: int = 0) -> None:
+    """Synchronous version of :func:`extract_archive`"""
+    import tarfile
+    root = dest.resolve()
+    known_dirs: dict[str, Path] = {}
+    # The blobs of the extracted files, for the hard links to them
+    extracted: dict[str, Path] = {}
+    with tarfile.open(archive, 'r|*') as tf:
+        for mem in tf:
+            relpath = _archive_relpath(mem.name, strip_components)
+            if relpath is None or prune.excludes(relpath):
+                continue
+            if mem.isdir() and prune.excludes(f'{relpath}/'):
+                # Only create directories that are not pruned as a whole
+                continue
+            target = _real_parent(root, relpath, mem.name, known_dirs) / os.path.basename(relpath)
+            if mem.isdir():
+                target.mkdir(exist_ok=True)
+                continue
+            if mem.issym():
+                if not _is_link_within(root, target.parent, mem.linkname):
+                    raise RuntimeError(
+                        f'Refusing to extract archive symlink to outside of the tree: {mem.name} -> {mem.linkname}')
+                os.symlink(mem.linkname, target)
+                continue
+            if mem.islnk():
+                src = _archive_relpath(mem.linkname, strip_components)
+                blob = extracted.get(src or '')
+                if blob is None:
+                    raise RuntimeError(f'Archive hard link {mem.name} refers to a file that was not extracted: '
+                                       f'{mem.linkname}')
+                _place(blob, target)
+                extracted[relpath] = blob
+                continue
+            if not mem.isfile():
+                continue
+            fd = tf.extractfile(mem)
+            assert fd
+            content = fd.read()
+            oid = hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+            ent = TreeEntry('100755' if mem.mode & 0o111 else '100644', oid, len(content), relpath)
+            blob = _blob_path(ent)
+            if not _is_intact(blob, ent):
+                _store_blob(blob, ent, content)
+            _place(blob, target)
+            extracted[relpath] = blob
+
+
+async def extract_archive(archive: Path,
+                          dest: Path,
+                          prune: PruneRules = NO_PRUNE,
+                          *,
+                          strip_components: int = 0) -> None:
+    """
+    Extract the tar archive at ``archive`` into the directory ``dest``, with
+    hard links into the blob store. The archive is read as a stream, and
+    members excluded by ``prune`` are skipped without being written.
+
+    Raises :class:`RuntimeError` for members that would be written outside of
+    ``dest`` (through parent-relative paths or symlinks), for symlinks to
+    outside of ``dest``, and for hard links to files that were not extracted
+    (e.g. pruned ones).
+
+    :param strip_components: The number of leading path components to remove
+        from the names of archive members (e.g. ``1`` for the top-level
+        directory of a source archive).
+    """
+    store = store_dir()
+    async with cache.locked(store, shared=True):
+        cache.touch('blobs', store)
+        await fs.run_fs_op(lambda: extract_archive_sync(archive, dest, prune, strip_components=strip_components))
+
+
+def verify_sync(dirpath: Path) -> None:
+    """Synchronous version of :func:`verify`"""
+    for parent, _dirs, files in os.walk(dirpath):
+        for name in files:
+            fpath = Path(parent, name)
+            if fpath.is_symlink():
+                continue
+            st = fpath.stat()
+            if st.st_nlink > 1 and st.st_mtime != BLOB_MTIME:
+                raise RuntimeError(f'File [{fpath}] was modified in place while shared with the blob store. '
+                                   'Transforms must fs.detach() checked-out files before modifying them.')
+
+
+async def verify(dirpath: Path) -> None:
+    """
+    Check that no file in the given staged tree was modified in place while
+    shared with the blob store. Raises :class:`RuntimeError` if one was.
+    """
+    await fs.run_fs_op(lambda: verify_sync(dirpath))
@@ -0,0 +1,296 @@
+"""
+Async library API for building repositories from a process of one's own.
+
+Everything that a build depends on is passed explicitly in a
+:class:`BuildConfig`, and is only put into effect for the duration of each
+call. The cache root (:func:`.cache.using`), the port selection
+(:func:`.selection.selecting`), the staging area (:func:`.staging.using`) and
+the Dagon job pools are all context-local, and the module-level limits are
+kept per event loop (:class:`.util.LoopLocal`). So builders may be used
+repeatedly and concurrently within one process. They may also run on several
+event loops, though a single builder belongs to the loop that opened it. A
+long-lived process keeps a warm cache, HTTP connections and tag listings
+between builds.
+
+Example::
+
+    config = BuildConfig(Path('ports'), Path('_ports-repo'))
+    async with open_builder(config) as builder:
+        print((await builder.plan()).to_text())
+        result = await builder.build()
+
+Two builds of the same repository must not run at the same time.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import traceback
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, ContextManager, Iterable, Iterator, NamedTuple, Optional
+
+from . import cache, fs, git, github, ioacct, journal, metrics, net, profiling, selection, staging
+from .collect import collect_ports, stream_ports_with_origin
+from .deferred import dagon
+from .history import History
+from .plan import ImportPlan, compute_plan
+from .port import Port, PackageID
+from .repo import RepositoryAccess
+from .selection import PortSelection
+from .staging import IMPORT_JOBS, PREP_JOBS
+
+if TYPE_CHECKING:
+    from dagon.ext.loader import ExtLoader
+
+    from .pipeline import PipelineResult
+    from .validate import PackageInfo
+
+
+class BuildConfig(NamedTuple):
+    """The configuration of the build of one repository"""
+    ports_dir: Path
+    "The directory containing the port files"
+    repo_dir: Path
+    "The directory of the repository that is built"
+    cache_root: Optional[Path] = None
+    "The root of the dds-ports cache (Default: :func:`.cache.cache_root`)"
+    selection: PortSelection = PortSelection()
+    "The ports and package versions that are built"
+    staging_dir: Optional[Path] = None
+    "The directory in which sdists are prepared (Default: within the cache)"
+    staging_budget: Optional[int] = None
+    "The disk space (in bytes) that prepared-but-not-yet-imported sdists may occupy"
+    prep_jobs: int = PREP_JOBS
+    "The number of packages that are prepared concurrently"
+    import_jobs: int = IMPORT_JOBS
+    "The number of sdists that are imported concurrently"
+    full_validate_interval: Optional[float] = None
+    """
+    After importing, run a full ``bpt repo validate`` if the last one was more
+    than this many seconds ago. ``None`` never runs one.
+    """
+    io_report: Optional[Path] = None
+    """
+    Account the I/O of each build, and write the counts to this file, as JSON
+    (see :mod:`dds_ports.ioacct`). I/O is only accounted if this is set.
+    """
+    profile: Optional[profiling.Mode] = None
+    "Profile each build in this mode (see :mod:`dds_ports.profiling`)"
+    profile_dir: Path = Path('dds-ports-profile')
+    "The directory to which the profile of each build is written, if it is profiled"
+    ui: str = 'none'
+    """
+    The Dagon user interface that reports the progress of tasks (see
+    :func:`.pipeline.extension_context`). Builders that run at the same time
+    must all use ``none``, which only prints the messages of tasks.
+    """
+    github_hedge_after: Optional[float] = None
+    """
+    Race a GitHub API request that has not completed after this many seconds
+    by a second, identical request (see :func:`.github.hedging`). ``None``
+    never hedges.
+    """
+
+
+class PreparedPackage(NamedTuple):
+    """An sdist prepared by :meth:`Builder.prepare`, ready to import"""
+    package_id: PackageID
+    sdist: Path
+    "The sdist directory, within the staging area of the builder"
+    digest: str
+    "The content digest of the sdist (see :mod:`dds_ports.sdist`)"
+
+
+class Builder:
+    """Builds one repository. Obtained from :func:`open_builder`."""
+    def __init__(self, config: BuildConfig, repo: RepositoryAccess, area: staging.StagingArea, exts: ExtLoader) -> None:
+        self._config = config
+        self._repo = repo
+        self._area = area
+        self._exts = exts
+        self._mirrors: git.MirrorFetches = {}
+        self._unfinished = False
+
+    @property
+    def config(self) -> BuildConfig:
+        """The configuration of the build"""
+        return self._config
+
+    @property
+    def repository(self) -> RepositoryAccess:
+        """
+        The repository. Its package listing is read once, and is kept up to
+        date with the imports of the builder.
+        """
+        return self._repo
+
+    @property
+    def unfinished(self) -> bool:
+        """
+        Whether the last build did not finish (e.g. because it was
+        interrupted). The sdists that it prepared are kept for a resumed build.
+        """
+        return self._unfinished
+
+    @contextmanager
+    def _settings(self) -> Iterator[None]:
+        root = self._config.cache_root
+        with cache.using(root) if root else contextlib.nullcontext(), \
+                selection.selecting(self._config.selection), staging.using(self._area), \
+                git.mirror_scope(self._mirrors), github.hedging(self._config.github_hedge_after):
+            yield
+
+    @asynccontextmanager
+    async def _running(self) -> AsyncIterator[None]:
+        from .pipeline import extension_context
+        with self._settings(), self._exts.app_context():
+            # Ports assign their clone tasks to this pool. Limits across ports
+            # are enforced by the pipeline.
+            dagon.pool.add('cloner', 3)
+            async with net.session_scope(), extension_context(self._exts, ui=self._config.ui):
+                yield
+
+    async def discover(self, *, cached_tags: bool = False) -> list[Port]:
+        """
+        Collect the selected ports. If ``cached_tags``, use the tags from the
+        most recent listing of each upstream repository, where there is one.
+        """
+        with self._settings(), github.prefer_cached_tags() if cached_tags else contextlib.nullcontext(), \
+                profiling.stage('discovery'):
+            async with net.session_scope():
+                return list(await collect_ports(self._config.ports_dir, self._config.selection))
+
+    async def plan(self) -> ImportPlan:
+        """Compute the packages that a build would import, using cached tag listings where available"""
+        ports = await self.discover(cached_tags=True)
+        with self._settings(), profiling.stage('plan'):
+            hist = History.open()
+            try:
+                return compute_plan(ports, self._repo, hist)
+            finally:
+                hist.close()
+
+    async def prepare(self, port: Port) -> PreparedPackage:
+        """
+        Prepare the sdist of the given port in the staging area of the builder.
+        The sdist is removed when it is imported, or when the builder is closed.
+        """
+        from .pipeline import prepare_port
+        from .sdist import finalize
+        async with self._running():
+            sdist = await prepare_port(port, self._exts)
+            try:
+                digest = await finalize(sdist)
+            except Exception:
+                await self._area.release(sdist)
+                raise
+            return PreparedPackage(port.package_id, sdist, digest)
+
+    async def import_prepared(self, prepared: PreparedPackage) -> Optional[PackageInfo]:
+        """
+        Import an sdist from :meth:`prepare` into the repository. Returns the
+        dependency information of the package, or ``None`` if the package was
+        not imported because its content is unchanged.
+        """
+        from .pipeline import import_sdist
+        async with self._running():
+            result = await import_sdist(self._repo, self._exts, *prepared)
+        self._repo.add_packages(result.imported)
+        return result.imported.get(prepared.package_id)
+
+    async def validate(self, imported: Iterable[PackageInfo]) -> None:
+        """
+        Validate the repository after the given packages were imported (see
+        :func:`.validate.validate_imports`)
+        """
+        from .validate import validate_imports
+        with self._settings():
+            await validate_imports(self._repo, imported, full_interval=self._config.full_validate_interval)
+
+    async def build(self, *, resume: bool = False) -> PipelineResult:
+        """
+        Discover, prepare, import and validate every new package of the
+        selected ports. If ``resume``, skip the work that an interrupted
+        earlier build of the repository already completed (see
+        :mod:`dds_ports.journal`).
+        """
+        from .pipeline import run_pipeline
+        # Each mirror is fetched again (at most once) by each build
+        self._mirrors = {}
+        with self._settings():
+            jnl = journal.Journal.start(self._config.repo_dir, resume=resume)
+        self._unfinished = True
+        with journal.journaling(jnl):
+            if resume and jnl.resumed == journal.ResumeState():
+                print('The previous run finished (or there is no previous run). Nothing to resume.')
+            discovery_errors: dict[Path, str] = {}
+            async with self._running():
+                # The interrupted run has listed the tags of the repositories recently
+                with github.prefer_cached_tags() if resume else contextlib.nullcontext(), \
+                        metrics.recording(self._config.repo_dir), self._accounting() as io, \
+                        self._profiling() as prof:
+                    result = await run_pipeline(self._repo,
+                                                self._discover(discovery_errors),
+                                                self._exts,
+                                                prep_jobs=self._config.prep_jobs,
+                                                import_jobs=self._config.import_jobs)
+            result = result._replace(discovery_errors=discovery_errors, io=io, profile=prof)
+            if io is not None and self._config.io_report:
+                io.write(self._config.io_report)
+            self._repo.add_packages(result.imported)
+            # Even with nothing new, a full validation may be due
+            await self.validate(result.imported.values())
+            jnl.finish()
+        self._unfinished = False
+        return result
+
+    def _accounting(self) -> ContextManager[Optional[ioacct.IOAccount]]:
+        # Counting walks trees that are otherwise not walked, so only do it for a report
+        return ioacct.accounting() if self._config.io_report else contextlib.nullcontext()
+
+    def _profiling(self) -> ContextManager[Optional[profiling.Profiler]]:
+        mode = self._config.profile
+        return profiling.profiling(mode, self._config.profile_dir) if mode else contextlib.nullcontext()
+
+    async def _discover(self, errors: dict[Path, str]) -> AsyncIterator[Port]:
+        def on_error(fpath: Path, exc: Exception) -> None:
+            # The ports of the other port files are still built
+            dagon.ui.print(f'Failed to load the ports of [{fpath}]: {exc}')
+            errors[fpath] = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+
+        async for _, p in stream_ports_with_origin(self._config.ports_dir, self._config.selection, on_error=on_error):
+            yield p
+
+
+def default_extensions() -> ExtLoader:
+    """The Dagon extensions used by builders: Dagon's defaults, and stage timing"""
+    import dagon.tool.main
+    from .timing import TimingExtension
+    exts = dagon.tool.main.get_extensions()
+    exts.load(TimingExtension())
+    return exts
+
+
+@asynccontextmanager
+async def open_builder(config: BuildConfig, *, exts: Optional[ExtLoader] = None) -> AsyncIterator[Builder]:
+    """
+    Open a builder for the repository of ``config``. The staging area of the
+    builder, and any sdists that were prepared but not imported, are deleted
+    when the context exits, unless the last build is :attr:`~Builder.unfinished`.
+
+    :param exts: The Dagon extensions to run tasks with (Default:
+        :func:`default_extensions`).
+    """
+    repo = await fs.run_fs_op(lambda: RepositoryAccess.open(config.repo_dir))
+    with cache.using(config.cache_root) if config.cache_root else contextlib.nullcontext():
+        area = staging.new_area(config.staging_dir, budget=config.staging_budget)
+    builder: Optional[Builder] = None
+    try:
+        # Connections are kept open for the life of the builder
+        async with net.session_scope():
+            builder = Builder(config, repo, area, exts or default_extensions())
+            yield builder
+    finally:
+        if builder is None or not builder.unfinished:
+            area.close()
@@ -0,0 +1,379 @@
+"""
+Shared on-disk cache for mirrors, downloads, staged file content, and prepared sdists.
+
+Every entry in the cache is guarded by an advisory lock file next to it, so
+several dds-ports processes on one machine can share a single warm cache.
+Entries are created in a private temporary location and then renamed into
+place, so a reader will never observe a partially-written entry.
+
+Entries are accounted in an index database at the cache root, which records
+when each entry was last used so that the cache can be trimmed to a size cap
+by evicting the least-recently-used entries first.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager, closing, contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Iterator, NamedTuple
+
+from . import fs, ioacct, metrics, net
+from .deferred import dagon
+
+if TYPE_CHECKING:
+    import sqlite3
+
+_LOCK_POLL_MIN = 0.05
+_LOCK_POLL_MAX = 1.0
+
+_ROOT = contextvars.ContextVar['Path | None']('_CACHE_ROOT', default=None)
+
+
+def cache_root() -> Path:
+    """
+    The root directory of the cache. Can be set for a context with
+    :func:`using`, or else overridden with the ``DDS_PORTS_CACHE_DIR``
+    environment variable.
+    """
+    root = _ROOT.get()
+    if root is not None:
+        return root
+    env = os.getenv('DDS_PORTS_CACHE_DIR')
+    if env:
+        return Path(env)
+    return Path('~/.cache/dds-ports').expanduser()
+
+
+@contextmanager
+def using(root: Path) -> Iterator[None]:
+    """Use the cache at the given root directory for the duration of the context"""
+    tok = _ROOT.set(root)
+    try:
+        yield
+    finally:
+        _ROOT.reset(tok)
+
+
+def cache_dir(kind: str) -> Path:
+    """Get (and create) the cache subdirectory for the given kind of entry"""
+    dirpath = cache_root() / kind
+    dirpath.mkdir(exist_ok=True, parents=True)
+    return dirpath
+
+
+class CacheEntry(NamedTuple):
+    """An item in the cache that is accounted and evicted as a unit"""
+    kind: str
+    path: Path
+    size: int
+    last_used: float
+
+
+_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER,
+    last_used REAL NOT NULL
+)
+'''
+
+
+def _open_index() -> sqlite3.Connection:
+    import sqlite3  # pylint: disable=redefined-outer-name
+    db = sqlite3.connect(cache_root() / 'index.db', timeout=30)
+    db.execute(_INDEX_SCHEMA)
+    return db
+
+
+def _index_key(path: Path) -> str:
+    return path.relative_to(cache_root()).as_posix()
+
+
+def touch(kind: str, entry: Path, *, size: int | None = None) -> None:
+    """
+    Record that the given cache entry was just used. If ``size`` is given, also
+    record the size of the entry.
+    """
+    cache_root().mkdir(exist_ok=True, parents=True)
+    with closing(_open_index()) as db, db:
+        db.execute(
+            '''
+            INSERT INTO entries (path, kind, size, last_used) VALUES (?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                last_used = excluded.last_used,
+                size = coalesce(excluded.size, entries.size)
+            ''',
+            (_index_key(entry), kind, size, time.time()),
+        )
+
+
+def lock_path(entry: Path) -> Path:
+    """The path to the lock file that guards the given cache entry"""
+    return entry.with_name(entry.name + '.lock')
+
+
+def _try_flock(fd: int, shared: bool) -> bool:
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        return True
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        raise
+
+
+@asynccontextmanager
+async def locked(entry: Path, *, shared: bool = False) -> AsyncIterator[None]:
+    """
+    Hold an advisory lock on the given cache entry for the duration of the
+    context. Exclusive locks are for creating/updating an entry, and shared
+    locks are for reading from it.
+
+    The lock is held on an open file description, so it also excludes other
+    tasks within the same process.
+    """
+    lck = lock_path(entry)
+    lck.parent.mkdir(exist_ok=True, parents=True)
+    fd = os.open(lck, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        delay = _LOCK_POLL_MIN
+        announced = False
+        while not _try_flock(fd, shared):
+            if not announced:
+                dagon.ui.status(f'Waiting for lock on cache entry {entry}')
+                announced = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _LOCK_POLL_MAX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _discard(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _publish(tmp: Path, dest: Path) -> None:
+    if dest.is_dir() and not dest.is_symlink():
+        # os.replace() cannot replace a non-empty directory. Move the old entry
+        # aside first so that the new entry appears in a single rename.
+        old = Path(tempfile.mkdtemp(dir=dest.parent, prefix=f'.{dest.name}.', suffix='.old'))
+        os.replace(dest, old / dest.name)
+        os.replace(tmp, dest)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(tmp, dest)
+
+
+@contextmanager
+def publishing_dir(dest: Path) -> Iterator[Path]:
+    """
+    Yield a new empty directory next to ``dest``. When the context exits
+    successfully, the directory is atomically renamed to ``dest``. If an
+    exception occurs, the directory is deleted.
+
+    The caller should hold an exclusive lock on ``dest`` (see :func:`locked`).
+    """
+    dest.parent.mkdir(exist_ok=True, parents=True)
+    tmp = Path(tempfile.mkdtemp(dir=dest.parent, prefix=f'.{dest.name}.', suffix='.tmp'))
+    try:
+        yield tmp
+    except BaseException:
+        _discard(tmp)
+        raise
+    _publish(tmp, dest)
+
+
+@contextmanager
+def publishing_file(dest: Path) -> Iterator[Path]:
+    """
+    Like :func:`publishing_dir`, but yields a path to a file to be written.
+    """
+    dest.parent.mkdir(exist_ok=True, parents=True)
+    fd, tmp_str = tempfile.mkstemp(dir=dest.parent, prefix=f'.{dest.name}.', suffix='.tmp')
+    os.close(fd)
+    tmp = Path(tmp_str)
+    try:
+        yield tmp
+    except BaseException:
+        _discard(tmp)
+        raise
+    _publish(tmp, dest)
+
+
+async def cached_download(url: str, key: str) -> Path:
+    """
+    Download the file at ``url`` into the download cache under ``key``, unless
+    it is already present. Returns the path to the cached file.
+    """
+    dest = cache_dir('downloads') / key
+    async with locked(dest):
+        if dest.is_file():
+            touch('downloads', dest)
+            return dest
+        with publishing_file(dest) as tmp:
+            dagon.ui.status(f'Downloading {url}')
+            async with net.session().get(url) as resp:
+                ioacct.count('net')
+                resp.raise_for_status()
+                with tmp.open('wb') as ofd:
+                    while 1:
+                        buf = await resp.content.read(1024 * 64)
+                        if not buf:
+                            break
+                        metrics.add('downloaded-bytes', len(buf))
+                        ioacct.count('net', nbytes=len(buf), ops=0)
+                        ofd.write(buf)
+        touch('downloads', dest, size=dest.stat().st_size)
+    return dest
+
+
+def _is_lock_or_temp(path: Path) -> bool:
+    return path.name.startswith('.') or path.suffix in ('.lock', '.tmp')
+
+
+def _find_mirrors(dirpath: Path) -> Iterable[Path]:
+    for parent, dirs, _files in os.walk(dirpath):
+        if '.git' in dirs:
+            # This is a clone. Don't descend into it.
+            dirs.clear()
+            yield Path(parent)
+        else:
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+
+
+def _find_downloads(dirpath: Path) -> Iterable[Path]:
+    return (p for p in dirpath.rglob('*') if p.is_file() and not _is_lock_or_temp(p))
+
+
+def _pid_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _find_stale_staging(dirpath: Path) -> Iterable[Path]:
+    from . import journal
+    # The staging directories of interrupted runs, which a resumed run imports from
+    resumable = set(p for sdist in journal.unfinished_sdists() for p in sdist.parents)
+    for child in dirpath.glob('run-*'):
+        pid = child.name.split('-')[1]
+        if pid.isdigit() and not _pid_is_alive(int(pid)) and child not in resumable:
+            yield child
+
+
+def _scan_entries() -> Iterable[tuple[str, Path]]:
+    root = cache_root()
+    if root.joinpath('clones').is_dir():
+        yield from (('clones', p) for p in _find_mirrors(root / 'clones'))
+    if root.joinpath('downloads').is_dir():
+        yield from (('downloads', p) for p in _find_downloads(root / 'downloads'))
+    if root.joinpath('blobs').is_dir():
+        yield ('blobs', root / 'blobs')
+    if root.joinpath('staging').is_dir():
+        yield from (('staging', p) for p in _find_stale_staging(root / 'staging'))
+
+
+def _entry_size(path: Path) -> int:
+    if path.is_dir():
+        return fs.tree_size_sync(path)
+    return path.stat().st_size
+
+
+def collect_entries() -> list[CacheEntry]:
+    """
+    Scan the cache and return every entry, with sizes brought up-to-date. Entries
+    that have never been recorded in the cache index are given the
+    modification time of their lock file (or the entry itself) as the
+    last-used time. Stale staging directories left behind by dead processes
+    are also listed, as these are always safe to remove. Those that hold sdists
+    of an unfinished run are not (see :func:`.journal.unfinished_sdists`).
+    """
+    root = cache_root()
+    if not root.is_dir():
+        return []
+    with closing(_open_index()) as db, db:
+        known = {row[0]: float(row[1]) for row in db.execute('SELECT path, last_used FROM entries')}
+        ret: list[CacheEntry] = []
+        for kind, path in _scan_entries():
+            key = _index_key(path)
+            last_used = known.pop(key, None)
+            if last_used is None:
+                lck = lock_path(path)
+                last_used = (lck if lck.exists() else path).stat().st_mtime
+            ent = CacheEntry(kind, path, _entry_size(path), last_used)
+            db.execute(
+                '''
+                INSERT INTO entries (path, kind, size, last_used) VALUES (?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET size = excluded.size
+                ''',
+                (key, kind, ent.size, ent.last_used),
+            )
+            ret.append(ent)
+        # Forget about entries that no longer exist
+        db.executemany('DELETE FROM entries WHERE path = ?', ((k, ) for k in known))
+    return ret
+
+
+def _try_evict(ent: CacheEntry) -> bool:
+    if ent.kind == 'staging':
+        shutil.rmtree(ent.path, ignore_errors=True)
+        return True
+    fd = os.open(lock_path(ent.path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not _try_flock(fd, shared=False):
+            # Someone is using this entry right now
+            return False
+        try:
+            _discard(ent.path)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+    with closing(_open_index()) as db, db:
+        db.execute('DELETE FROM entries WHERE path = ?', (_index_key(ent.path), ))
+    return True
+
+
+def collect_garbage(max_size: int, *, min_age: float = 0, dry_run: bool = False) -> list[CacheEntry]:
+    """
+    Evict least-recently-used entries until the cache is no larger than
+    ``max_size`` bytes. Entries used within the last ``min_age`` seconds and
+    entries that are locked by another task or process are never evicted.
+    Stale staging directories are always evicted.
+
+    Returns the entries that were (or, with ``dry_run``, would be) evicted.
+    """
+    entries = sorted(collect_entries(), key=lambda e: (e.kind != 'staging', e.last_used))
+    total = sum(e.size for e in entries)
+    now = time.time()
+    evicted: list[CacheEntry] = []
+    for ent in entries:
+        if ent.kind != 'staging':
+            if total <= max_size:
+                break
+            if now - ent.last_used < min_age:
+                continue
+        if dry_run or _try_evict(ent):
+            evicted.append(ent)
+            total -= ent.size
+    return evicted
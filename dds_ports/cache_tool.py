@@ -0,0 +1,88 @@
+"""
+Command-line tool for inspecting and trimming the dds-ports cache
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import sys
+from typing import NoReturn, Sequence, cast
+
+from typing_extensions import Protocol
+
+from . import cache
+from .util import format_size, parse_size
+
+
+class CommandArguments(Protocol):
+    command: str
+    json: bool
+    max_size: int
+    min_age: float
+    dry_run: bool
+
+
+def _stats(args: CommandArguments) -> int:
+    entries = cache.collect_entries()
+    if args.json:
+        items = [{
+            'kind': e.kind,
+            'path': str(e.path),
+            'size': e.size,
+            'last-used': e.last_used,
+        } for e in entries]
+        json.dump({'root': str(cache.cache_root()), 'entries': items}, sys.stdout, indent=2)
+        print()
+        return 0
+    print(f'Cache directory: {cache.cache_root()}')
+    kinds = sorted(set(e.kind for e in entries))
+    for kind in kinds:
+        of_kind = [e for e in entries if e.kind == kind]
+        print(f'  {kind}: {len(of_kind)} entries, {format_size(sum(e.size for e in of_kind))}')
+    print(f'  total: {len(entries)} entries, {format_size(sum(e.size for e in entries))}')
+    if entries:
+        print('Least recently used:')
+        for ent in sorted(entries, key=lambda e: e.last_used)[:10]:
+            when = datetime.datetime.fromtimestamp(ent.last_used).isoformat(sep=' ', timespec='seconds')
+            print(f'  {when}  {format_size(ent.size):>10}  {ent.path.relative_to(cache.cache_root())}')
+    return 0
+
+
+def _gc(args: CommandArguments) -> int:
+    evicted = cache.collect_garbage(args.max_size, min_age=args.min_age * 60 * 60, dry_run=args.dry_run)
+    verb = 'Would evict' if args.dry_run else 'Evicted'
+    for ent in evicted:
+        print(f'{verb} {ent.kind} entry {ent.path} ({format_size(ent.size)})')
+    print(f'{verb} {len(evicted)} entries, freeing {format_size(sum(e.size for e in evicted))}')
+    return 0
+
+
+def main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='dds-ports-cache')
+    sub = parser.add_subparsers(dest='command', required=True)
+    stats = sub.add_parser('stats', help='Show the size and usage of cache entries')
+    stats.add_argument('--json', action='store_true', help='Emit the cache entries as JSON')
+    gc = sub.add_parser('gc', help='Evict least-recently-used cache entries down to a size cap')
+    gc.add_argument('--max-size',
+                    type=parse_size,
+                    required=True,
+                    help='The size to trim the cache down to (e.g. "50G")')
+    gc.add_argument('--min-age',
+                    type=float,
+                    default=1,
+                    help='Never evict entries used within this many hours (Default: 1)')
+    gc.add_argument('--dry-run', action='store_true', help='Only print what would be evicted')
+    args = cast(CommandArguments, parser.parse_args(argv))
+    if args.command == 'stats':
+        return _stats(args)
+    return _gc(args)
+
+
+def start() -> NoReturn:
+    sys.exit(main(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    start()
@@ -1,10 +1,13 @@
-import itertools
-from typing import Iterable
+from __future__ import annotations
+
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterable, NamedTuple, Optional, Union
 import fnmatch
 from pathlib import Path
 import importlib.util
 
 from .port import Port
+from .selection import PortSelection, selecting
 from .util import wait_all
 
 
@@ -15,16 +18,110 @@ def find_port_files(dirpath: Path) -> Iterable[Path]:
     return matching
 
 
-async def collect_ports(dirpath: Path) -> Iterable[Port]:
-    loading = (ports_in_file(fpath) for fpath in find_port_files(dirpath))
-    ports = await wait_all(loading)
-    return itertools.chain.from_iterable(ports)
+async def collect_ports(dirpath: Path, selection: PortSelection = PortSelection()) -> Iterable[Port]:
+    return (p for _, p in await collect_ports_with_origin(dirpath, selection))
 
 
-async def ports_in_file(fpath: Path) -> Iterable[Port]:
+async def collect_ports_with_origin(
+    dirpath: Path, selection: PortSelection = PortSelection()) -> list[tuple[Path, Port]]:
+    """Collect the selected ports, each paired with the path to the port file that defines it"""
+    with selecting(selection):
+        files = [fpath for fpath in find_port_files(dirpath) if selection.wants_port_file(fpath)]
+        ports = await wait_all(ports_in_file(fpath) for fpath in files)
+    pairs = [(fpath, p) for fpath, file_ports in zip(files, ports) for p in file_ports]
+    chosen = set(id(p) for p in selection.apply(p for _, p in pairs))
+    return [(fpath, p) for fpath, p in pairs if id(p) in chosen]
+
+
+_DONE = object()
+
+
+class _FileError(NamedTuple):
+    fpath: Path
+    error: Exception
+
+
+async def _stream_file(fpath: Path, selection: PortSelection, queue: 'asyncio.Queue[object]') -> None:
+    try:
+        if selection.newest is not None:
+            # The newest versions of a package are only known once the whole
+            # file has been enumerated
+            for p in selection.apply(await ports_in_file(fpath)):
+                await queue.put((fpath, p))
+        else:
+            async for p in iter_ports_in_file(fpath):
+                if selection.wants(p.package_id):
+                    await queue.put((fpath, p))
+    except Exception as e:  # pylint: disable=broad-except
+        await queue.put(_FileError(fpath, e))
+    finally:
+        await queue.put(_DONE)
+
+
+async def stream_ports_with_origin(
+        dirpath: Path,
+        selection: PortSelection = PortSelection(),
+        *,
+        on_error: Optional[Callable[[Path, Exception], None]] = None) -> AsyncIterator[tuple[Path, Port]]:
+    """
+    Collect the selected ports, yielding each port (paired with the path to the
+    port file that defines it) as soon as it is discovered. Port files are
+    loaded concurrently, and ports from port files that finish early are
+    yielded before slower port files have finished.
+
+    The ``newest`` selection is applied within each port file.
+
+    :param on_error: Called with the port file and the exception if loading or
+        enumerating a port file fails, after which the other port files are
+        still collected. If not given, the exception is raised.
+    """
+    queue: asyncio.Queue[object] = asyncio.Queue()
+    with selecting(selection):
+        files = [fpath for fpath in find_port_files(dirpath) if selection.wants_port_file(fpath)]
+        loaders = [asyncio.ensure_future(_stream_file(fpath, selection, queue)) for fpath in files]
+    n_running = len(loaders)
+    try:
+        while n_running:
+            item = await queue.get()
+            if item is _DONE:
+                n_running -= 1
+            elif isinstance(item, _FileError):
+                if on_error is None:
+                    raise item.error
+                on_error(item.fpath, item.error)
+            else:
+                yield item  # type: ignore
+    finally:
+        for fut in loaders:
+            fut.cancel()
+
+
+PortsResult = Union[Awaitable[Iterable[Port]], AsyncIterator[Port]]
+
+
+def _load_port_file(fpath: Path) -> PortsResult:
     spec = importlib.util.spec_from_file_location(f'<portfile at {fpath}>', fpath)
     assert spec
     module = importlib.util.module_from_spec(spec)
     assert spec.loader
     spec.loader.exec_module(module)
-    return await module.all_ports()  # type: ignore
+    return module.all_ports()  # type: ignore
+
+
+async def iter_ports_in_file(fpath: Path) -> AsyncIterator[Port]:
+    """
+    Yield the ports defined by the given port file. A port file's
+    ``all_ports()`` may either be a coroutine function returning an iterable of
+    ports, or an async generator that yields ports as they are discovered.
+    """
+    res = _load_port_file(fpath)
+    if hasattr(res, '__aiter__'):
+        async for p in res:  # type: ignore
+            yield p
+    else:
+        for p in await res:  # type: ignore
+            yield p
+
+
+async def ports_in_file(fpath: Path) -> Iterable[Port]:
+    return [p async for p in iter_ports_in_file(fpath)]
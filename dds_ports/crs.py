@@ -7,6 +7,8 @@ import re
 
 import semver
 
+from . import fs
+
 CRS_DepVersionRange = TypedDict('CRS_DepVersionRange', {
     'low': str,
     'high': str,
@@ -66,7 +68,7 @@ def convert_dep_str(dep: str) -> CRS_Dependency:
 
 def write_crs_file(dirpath: Path, content: CRS_JSON) -> Path:
     dest = dirpath / 'pkg.json'
-    dest.write_text(json.dumps(content, indent=2))
+    fs.detach(dest).write_text(json.dumps(content, indent=2))
     return dest
 
 
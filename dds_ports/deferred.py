@@ -0,0 +1,38 @@
+"""
+Dagon, imported on first use.
+
+Dagon is slow to import, and the command-line entry points must not import it
+at startup (see :mod:`dds_ports.importtime`). Modules use it through
+:data:`dagon`, which imports each submodule when it is first accessed::
+
+    from .deferred import dagon
+
+    dagon.ui.status('Working')
+
+For type checkers, :data:`dagon` is the package itself, with the submodules
+that dds-ports uses.
+"""
+
+from __future__ import annotations
+
+import importlib
+from types import ModuleType
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import dagon
+    import dagon.pool
+    import dagon.task
+    import dagon.ui
+else:
+
+    class _DeferredDagon:
+        """Imports ``dagon.<name>`` when the attribute ``<name>`` is first accessed"""
+        def __getattr__(self, name: str) -> ModuleType:
+            if name.startswith('_'):
+                raise AttributeError(name)
+            mod = importlib.import_module(f'dagon.{name}')
+            setattr(self, name, mod)
+            return mod
+
+    dagon = _DeferredDagon()
@@ -1,8 +1,14 @@
 import asyncio
 import concurrent.futures
-from typing import Awaitable, TypeVar, Callable, Iterable
+import contextvars
+import hashlib
+import os
+from typing import Awaitable, NamedTuple, TypeVar, Callable, Iterable, Mapping, Optional, Sequence
 from pathlib import Path
 import shutil
+import tempfile
+
+from . import ioacct, profiling
 
 _FS_POOL = concurrent.futures.ThreadPoolExecutor(8)  # pylint: disable=consider-using-with
 
@@ -10,16 +16,36 @@ T = TypeVar('T')
 
 
 def _run_fs_op(op: Callable[[], T]) -> Awaitable[T]:
-    return asyncio.get_running_loop().run_in_executor(_FS_POOL, op)
+    # Run in a copy of the current context, e.g. so that the cache root set by cache.using() applies
+    ctx = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(_FS_POOL, ctx.run, profiling.call_labelled, op)
+
+
+def run_fs_op(op: Callable[[], T]) -> Awaitable[T]:
+    """Run a blocking filesystem operation in the filesystem thread pool"""
+    return _run_fs_op(op)
+
+
+def _remove_directory(dirpath: Path, absent_ok: bool) -> None:
+    if absent_ok and not dirpath.exists():
+        return
+    if ioacct.active():
+        # One unlink per file
+        n = sum(len(files) for _, _, files in os.walk(dirpath))
+        ioacct.count('fs', files=n, ops=n)
+    shutil.rmtree(dirpath)
 
 
-async def remove_directory(dirpath: Path) -> None:
-    await _run_fs_op(lambda: shutil.rmtree(dirpath))
+async def remove_directory(dirpath: Path, *, absent_ok: bool = False) -> None:
+    await _run_fs_op(lambda: _remove_directory(dirpath, absent_ok))
 
 
 def _remove_files(files: Iterable[Path]) -> None:
+    n = 0
     for f in files:
         f.unlink()
+        n += 1
+    ioacct.count('fs', files=n, ops=n)
 
 
 async def remove_files(files: Iterable[Path]) -> None:
@@ -40,6 +66,7 @@ def _move_files(*, into: Path, files: Iterable[Path], whence: Path) -> None:
         else:
             dest_path.parent.mkdir(exist_ok=True, parents=True)
             src_path.rename(dest_path)
+    ioacct.count('fs', files=len(files), ops=len(files))
 
 
 async def move_files(*, into: Path, files: Iterable[Path], whence: Path) -> None:
@@ -48,6 +75,7 @@ async def move_files(*, into: Path, files: Iterable[Path], whence: Path) -> None
 
 def _copy_files(*, into: Path, files: Iterable[Path], whence: Path) -> None:
     files = list(files)
+    nbytes = 0
     for src_path in files:
         relpath = src_path.relative_to(whence)
         if relpath.parts[0] == '..':
@@ -60,7 +88,189 @@ def _copy_files(*, into: Path, files: Iterable[Path], whence: Path) -> None:
         else:
             dest_path.parent.mkdir(exist_ok=True, parents=True)
             shutil.copy2(src_path, dest_path)
+            nbytes += dest_path.stat().st_size
+    ioacct.count('fs', nbytes=nbytes, files=len(files), ops=len(files))
 
 
 async def copy_files(*, into: Path, files: Iterable[Path], whence: Path) -> None:
     await _run_fs_op(lambda: _copy_files(into=into, files=files, whence=whence))
+
+
+class TreeStats(NamedTuple):
+    """The files within a directory tree"""
+    size: int
+    "The total (apparent) size of the files, in bytes"
+    files: int
+    "The number of files"
+
+
+def tree_stats_sync(dirpath: Path) -> TreeStats:
+    """Synchronous version of :func:`tree_stats`"""
+    size = files = 0
+    for parent, _dirs, fnames in os.walk(dirpath):
+        for fname in fnames:
+            try:
+                size += os.lstat(os.path.join(parent, fname)).st_size
+            except FileNotFoundError:
+                continue
+            files += 1
+    ioacct.count('fs', files=files, ops=files)
+    return TreeStats(size, files)
+
+
+async def tree_stats(dirpath: Path) -> TreeStats:
+    """Count the files within the given directory, and their total size"""
+    return await _run_fs_op(lambda: tree_stats_sync(dirpath))
+
+
+def tree_size_sync(dirpath: Path) -> int:
+    """Synchronous version of :func:`tree_size`"""
+    total = count = 0
+    for parent, _dirs, files in os.walk(dirpath):
+        for fname in files:
+            try:
+                st = os.lstat(os.path.join(parent, fname))
+            except FileNotFoundError:
+                continue
+            blocks = getattr(st, 'st_blocks', None)
+            total += st.st_size if blocks is None else blocks * 512
+            count += 1
+    ioacct.count('fs', files=count, ops=count)
+    return total
+
+
+async def tree_size(dirpath: Path) -> int:
+    """Compute the disk usage of the files within the given directory, in bytes"""
+    return await _run_fs_op(lambda: tree_size_sync(dirpath))
+
+
+def tree_digest_sync(dirpath: Path, replace: Optional[Mapping[str, bytes]] = None) -> str:
+    """Synchronous version of :func:`tree_digest`"""
+    replace = replace or {}
+    h = hashlib.sha256()
+    nbytes = nfiles = 0
+    for parent, dirs, files in os.walk(dirpath):
+        # Git metadata (e.g. of a sub-clone) is not part of the package content
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for fname in sorted(files):
+            fpath = Path(parent, fname)
+            relpath = fpath.relative_to(dirpath).as_posix()
+            nfiles += 1
+            if fpath.is_symlink():
+                h.update(f'L {relpath} {os.readlink(fpath)}\n'.encode())
+                continue
+            executable = os.access(fpath, os.X_OK)
+            content = replace.get(relpath)
+            if content is not None:
+                h.update(f'{"X" if executable else "F"} {relpath} {len(content)}\n'.encode())
+                h.update(content)
+                continue
+            h.update(f'{"X" if executable else "F"} {relpath} {fpath.stat().st_size}\n'.encode())
+            with fpath.open('rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+                    nbytes += len(chunk)
+    ioacct.count('fs', nbytes=nbytes, files=nfiles, ops=nfiles)
+    return h.hexdigest()
+
+
+async def tree_digest(dirpath: Path, replace: Optional[Mapping[str, bytes]] = None) -> str:
+    """
+    Compute a digest of the contents of the given directory: The relative paths,
+    contents, and executable bits of its files. Timestamps and ``.git``
+    directories are not included.
+
+    :param replace: Content to use in place of the content of the files at the
+        given (POSIX-style) relative paths.
+    """
+    return await _run_fs_op(lambda: tree_digest_sync(dirpath, replace))
+
+
+def detach(path: Path) -> Path:
+    """
+    Give the file at ``path`` its own copy of its content, if it is a hard link
+    that shares its content with other files (i.e. with the blob store, see
+    :mod:`dds_ports.blobs`). Must be called before modifying a checked-out file
+    in place. Returns ``path``.
+    """
+    if path.is_symlink() or not path.is_file() or path.stat().st_nlink == 1:
+        return path
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    os.close(fd)
+    shutil.copy2(path, tmp)
+    os.replace(tmp, path)
+    ioacct.count('fs', nbytes=path.stat().st_size, files=1)
+    return path
+
+
+def normalize_tree_sync(dirpath: Path, mtime: float) -> None:
+    """Synchronous version of :func:`normalize_tree`"""
+    nfiles = 0
+    for parent, dirs, files in os.walk(dirpath):
+        for name in files:
+            fpath = os.path.join(parent, name)
+            if os.path.islink(fpath):
+                continue
+            mode = os.stat(fpath).st_mode
+            os.chmod(fpath, 0o755 if mode & 0o111 else 0o644)
+            os.utime(fpath, (mtime, mtime))
+            nfiles += 1
+        for name in dirs:
+            dpath = os.path.join(parent, name)
+            if not os.path.islink(dpath):
+                os.chmod(dpath, 0o755)
+        os.utime(parent, (mtime, mtime))
+    # stat, chmod and utime of each file
+    ioacct.count('fs', files=nfiles, ops=nfiles * 3)
+
+
+async def normalize_tree(dirpath: Path, mtime: float) -> None:
+    """
+    Normalize the metadata of the files within the given directory: Set all
+    modification times to ``mtime``, and all modes to either 0644 or (for
+    executables and directories) 0755.
+    """
+    await _run_fs_op(lambda: normalize_tree_sync(dirpath, mtime))
+
+
+def _extract_tar(archive: Path, into: Path) -> None:
+    import tarfile
+    with tarfile.open(archive) as tf:
+        members = tf.getmembers()
+        for mem in members:
+            dest = (into / mem.name).resolve()
+            if dest != into.resolve() and into.resolve() not in dest.parents:
+                raise RuntimeError(f'Archive [{archive}] contains member [{mem.name}] outside of its root')
+            if not (mem.isfile() or mem.isdir()):
+                raise RuntimeError(f'Archive [{archive}] contains unsupported member [{mem.name}]')
+        tf.extractall(into, members)
+    files = [m for m in members if m.isfile()]
+    ioacct.count('fs', nbytes=sum(m.size for m in files), files=len(files), ops=len(members))
+
+
+async def extract_archive(archive: Path, into: Path) -> None:
+    """Extract a tar archive into the given directory"""
+    await _run_fs_op(lambda: _extract_tar(archive, into))
+
+
+def _read_tar_member(archive: Path, names: Sequence[str]) -> Optional[bytes]:
+    import tarfile
+    with tarfile.open(archive) as tf:
+        for mem in tf:
+            parts = Path(mem.name).parts
+            if mem.isfile() and len(parts) <= 2 and parts[-1] in names:
+                f = tf.extractfile(mem)
+                assert f
+                content = f.read()
+                ioacct.count('fs', nbytes=len(content), files=1)
+                return content
+    return None
+
+
+async def read_archive_file(archive: Path, names: Sequence[str]) -> Optional[bytes]:
+    """
+    Read the first file with one of the given names from the root of a tar
+    archive (or from a single top-level directory within it). Returns ``None``
+    if there is no such file.
+    """
+    return await _run_fs_op(lambda: _read_tar_member(archive, names))
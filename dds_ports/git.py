@@ -2,50 +2,95 @@
 Git utilities
 """
 
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import os
 from asyncio import Semaphore
-from typing import AsyncIterator
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Iterator
 from pathlib import Path
-from contextlib import asynccontextmanager
-
-import dagon.fs
-import dagon.ui
-import dagon.proc
-import dagon.pool
-from dagon import task
+from contextlib import asynccontextmanager, contextmanager
+from weakref import WeakKeyDictionary
 
+from . import blobs, cache, fs, ioacct, journal, metrics, process, staging
+from .deferred import dagon
+from .prune import DEFAULT_RULES, PruneRules, prune_tree
 from .port import PackageID
-from .util import temporary_directory, run_process
+from .util import LoopLocal, temporary_directory
+
+if TYPE_CHECKING:
+    from dagon import task
+    from dagon.task import TaskDAG
+
+CLONE_SEMAPHORE = LoopLocal(lambda: Semaphore(4))
+MIRROR_SEMAPHORE = LoopLocal(lambda: Semaphore(3))
+"Limits the number of concurrent mirror clones/fetches across all task graphs"
 
-CLONE_SEMAPHORE = Semaphore(4)
+CLONE_TIMEOUT: float | None = 10 * 60
+"Seconds after which a shallow clone of a single tag is killed as hung (``None`` waits forever)"
+MIRROR_TIMEOUT: float | None = 60 * 60
+"Seconds after which a mirror clone/fetch is killed as hung (``None`` waits forever)"
+
+MirrorFetches = dict[tuple[Path, str], 'asyncio.Future[Path]']
+"Single-flight map of mirror clone/fetch operations, keyed by the cache root and the clone key"
+
+_MIRRORS_IN_FLIGHT = contextvars.ContextVar['MirrorFetches | None']('_MIRRORS_IN_FLIGHT', default=None)
+_DEFAULT_MIRRORS: MirrorFetches = {}
+"The mirror fetches of the process, outside of any :func:`mirror_scope`"
+
+_CLONER_TASKS: 'WeakKeyDictionary[TaskDAG, dict[str, task.Task[Path]]]' = WeakKeyDictionary()
+"Per-DAG registry of the mirror cloning tasks, keyed by the clone key"
 
 
 @asynccontextmanager
 async def temporary_git_clone(url: str, tag_or_branch: str) -> AsyncIterator[Path]:
     with temporary_directory(tag_or_branch) as tdir:
-        async with CLONE_SEMAPHORE:
+        async with CLONE_SEMAPHORE.get():
             print(f'Cloning repository {url} at {tag_or_branch} into {tdir}')
-            await run_process(['git', 'clone', '--quiet', f'--branch={tag_or_branch}', '--depth=1', url, str(tdir)])
+            await process.run(['git', 'clone', '--quiet', f'--branch={tag_or_branch}', '--depth=1', url, tdir],
+                              timeout=CLONE_TIMEOUT)
+            ioacct.count('git')
         yield tdir
 
 
 class SimpleGitPort:
-    def __init__(self, clone_key: str, pkg_id: PackageID, url: str, tag: str) -> None:
+    def __init__(self,
+                 clone_key: str,
+                 pkg_id: PackageID,
+                 url: str,
+                 tag: str,
+                 *,
+                 prune: PruneRules = DEFAULT_RULES,
+                 cost_hint: float | None = None) -> None:
         self._clone_key = clone_key
         self._pid = pkg_id
         self._url = url
         self._tag = tag
+        self._prune = prune
+        self._cost_hint = cost_hint
 
     @property
     def package_id(self) -> PackageID:
         """The ID of this simple git package"""
         return self._pid
 
+    @property
+    def cost_hint(self) -> float | None:
+        """The rough number of seconds the package takes to prepare and import (see :func:`.port.cost_hint`)"""
+        return self._cost_hint
+
     async def _make_sdist(self, cloner: task.Task[Path]) -> Path:
-        full_clone = await task.result_of(cloner)
-        sub_clone: Path = full_clone.with_name(full_clone.name + f'@{self._tag}')
-        await dagon.fs.remove(sub_clone, recurse=True, absent_ok=True)
+        full_clone: Path = await dagon.task.result_of(cloner)
+        sub_clone = await staging.current().create(str(self.package_id))
         dagon.ui.status(f'Generating sdist for {self.package_id}')
-        await dagon.proc.run(['git', 'clone', f'--branch={self._tag}', '--depth=1', full_clone.as_uri(), sub_clone])
+        async with cache.locked(full_clone, shared=True):
+            cache.touch('clones', full_clone)
+            if not await blobs.checkout(full_clone, self._tag, sub_clone, self._prune):
+                clone = ['git', 'clone', f'--branch={self._tag}', '--depth=1', full_clone.as_uri(), sub_clone]
+                await process.run(clone, timeout=CLONE_TIMEOUT, on_line=dagon.ui.status)
+                ioacct.count('git')
+                await prune_tree(sub_clone, self._prune)
         return await self.prepare(sub_clone)
 
     async def prepare(self, clone: Path) -> Path:
@@ -53,7 +98,7 @@ class SimpleGitPort:
 
     def make_prep_task(self) -> task.Task[Path]:
         cloner = get_git_cloner_task(self._clone_key, self._url)
-        clone = task.fn_task(f'{self.package_id}@clone', lambda: self._make_sdist(cloner), depends=[cloner])
+        clone = dagon.task.fn_task(f'{self.package_id}@clone', lambda: self._make_sdist(cloner), depends=[cloner])
         dagon.pool.assign(clone, 'cloner')
         return clone
 
@@ -61,26 +106,90 @@ class SimpleGitPort:
         return f'<SimpleGitPort package={self.package_id} url=[{self._url}]>'
 
 
+def _pack_size(clone: Path) -> int:
+    """
+    The size of the packs of a clone. Git stores what it receives as a pack,
+    unless a fetch is small enough to be unpacked into loose objects.
+    """
+    try:
+        with os.scandir(clone / '.git/objects/pack') as entries:
+            return sum(e.stat().st_size for e in entries if e.is_file())
+    except FileNotFoundError:
+        return 0
+
+
 async def _cached_clone(key: str, url: str) -> Path:
-    clones_dir = Path('~/.cache/dds-ports/clones').expanduser()
-    clones_dir.mkdir(exist_ok=True, parents=True)
-    dest = clones_dir / key
-    if dest.is_dir():
-        dagon.ui.status(f'Re-fetching git repository {url}')
-        await dagon.proc.run(['git', 'fetch', '--all'], cwd=dest)
-        return dest
-    tmp = dest.with_suffix('.tmp')
-    dagon.ui.status(f'Cloning Git repository {url}')
-    await dagon.proc.run(['git', 'clone', '--quiet', url, tmp])
-    tmp.rename(dest)
+    dest = cache.cache_dir('clones') / key
+    jnl = journal.current()
+    # Git does not report what it transferred, so count the growth of its packs.
+    # Only the pack directory is listed, rather than the whole object store.
+    async with MIRROR_SEMAPHORE.get(), cache.locked(dest):
+        if dest.is_dir() and jnl.mirror_is_fresh(key):
+            # Already fetched by the interrupted run that is being resumed
+            pass
+        elif dest.is_dir():
+            dagon.ui.status(f'Re-fetching git repository {url}')
+            before = await fs.run_fs_op(lambda: _pack_size(dest))
+            await process.run(['git', 'fetch', '--all'], cwd=dest, timeout=MIRROR_TIMEOUT, on_line=dagon.ui.status)
+            fetched = max(0, await fs.run_fs_op(lambda: _pack_size(dest)) - before)
+            metrics.add('downloaded-bytes', fetched)
+            ioacct.count('git', nbytes=fetched)
+        else:
+            with cache.publishing_dir(dest) as tmp:
+                dagon.ui.status(f'Cloning Git repository {url}')
+                await process.run(['git', 'clone', '--quiet', url, tmp],
+                                  timeout=MIRROR_TIMEOUT,
+                                  on_line=dagon.ui.status)
+                fetched = await fs.run_fs_op(lambda: _pack_size(tmp))
+                metrics.add('downloaded-bytes', fetched)
+                ioacct.count('git', nbytes=fetched)
+        cache.touch('clones', dest)
+    jnl.mirror_fetched(key)
     return dest
 
 
-def get_git_cloner_task(key: str, url: str) -> task.Task[Path]:
-    name = f'{key}@clone-all'
+def fetch_mirror(key: str, url: str) -> Awaitable[Path]:
+    """
+    Obtain the cached mirror clone of the given repository. Concurrent and
+    subsequent requests for the same key (within the same event loop and
+    :func:`mirror_scope`) share a single clone/fetch.
+    """
+    fetches = _MIRRORS_IN_FLIGHT.get()
+    if fetches is None:
+        fetches = _DEFAULT_MIRRORS
+    slot = (cache.cache_root(), key)
+    pending = fetches.get(slot)
+    if (pending is None or pending.get_loop() is not asyncio.get_running_loop()
+            or (pending.done() and (pending.cancelled() or pending.exception() is not None))):
+        pending = asyncio.ensure_future(_cached_clone(key, url))
+        fetches[slot] = pending
+    return asyncio.shield(pending)
+
+
+@contextmanager
+def mirror_scope(fetches: MirrorFetches) -> Iterator[None]:
+    """
+    Within this context, the mirror clones/fetches are shared through
+    ``fetches`` (e.g. one map per build, so that the next build fetches each
+    mirror again to pick up new upstream commits).
+    """
+    tok = _MIRRORS_IN_FLIGHT.set(fetches)
     try:
-        t = task.fn_task(name, lambda: _cached_clone(key, url))
-    except RuntimeError:
-        return next(iter(t for t in task.dag.current_dag().tasks if t.name == name))
+        yield
+    finally:
+        _MIRRORS_IN_FLIGHT.reset(tok)
+
+
+def get_git_cloner_task(key: str, url: str) -> task.Task[Path]:
+    """
+    Get the task that clones/fetches the mirror for ``key`` in the current DAG,
+    creating it if this is the first request for that mirror.
+    """
+    cloners = _CLONER_TASKS.setdefault(dagon.task.current_dag(), {})
+    existing = cloners.get(key)
+    if existing is not None:
+        return existing
+    t = dagon.task.fn_task(f'{key}@clone-all', lambda: fetch_mirror(key, url))
     dagon.pool.assign(t, 'cloner')
+    cloners[key] = t
     return t
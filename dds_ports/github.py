@@ -1,21 +1,189 @@
+import asyncio
 from asyncio import Semaphore
+import contextvars
+from contextlib import contextmanager
+import json
 import os
-from typing import Any, AsyncContextManager, Callable, Iterable, Optional, TypeVar
+import random
+import time
+from pathlib import Path
+from typing import Any, AsyncContextManager, Callable, Iterable, Iterator, Mapping, NamedTuple, Optional, TypeVar, cast
 
-from aiohttp import client
 from semver import VersionInfo
 
 from dds_ports.git import SimpleGitPort
 from dds_ports.legacy import LegacyDDSGitPort
 
+from . import cache, ioacct, net, selection
 from .port import Port, PackageID
-from .util import tag_as_version
+from .util import LoopLocal, tag_as_version
 
-HTTP_SESSION = client.ClientSession()
-HTTP_SEMAPHORE = Semaphore(6)
+HTTP_SEMAPHORE = LoopLocal(lambda: Semaphore(6))
 
+MAX_ATTEMPTS = 6
+"The number of times a GitHub API request is attempted before giving up"
+BACKOFF_BASE = 1.0
+"The upper bound (in seconds) of the delay before the first retry. Doubles with each retry."
+BACKOFF_MAX = 60.0
+"The largest delay (in seconds) before a retry"
+MAX_RATE_LIMIT_WAIT = 15 * 60.0
+"The longest time (in seconds) to wait for the rate limit to reset before failing the request"
+PACE_BELOW = 100
+"When fewer requests than this remain in the rate limit window, requests are spread over the window"
+REQUEST_TIMEOUT = 30.0
+"Timeout (in seconds) of a single GitHub API request"
 
-async def github_http_get(path: str) -> Any:
+_RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+_PREFER_CACHED_TAGS = contextvars.ContextVar('_PREFER_CACHED_TAGS', default=False)
+_HEDGE_AFTER = contextvars.ContextVar[Optional[float]]('_HEDGE_AFTER', default=None)
+
+
+class GitHubError(RuntimeError):
+    """Raised when a GitHub API request fails"""
+    def __init__(self, url: str, status: int | None, message: str) -> None:
+        super().__init__(f'GitHub request [{url}] failed: {message}')
+        self.url = url
+        self.status = status
+
+
+class _RateLimitFailure(GitHubError):
+    def __init__(self, url: str, status: int, message: str, retry_after: float) -> None:
+        super().__init__(url, status, message)
+        self.retry_after = retry_after
+
+
+class _TransientFailure(GitHubError):
+    pass
+
+
+def _parse_retry_after(value: str) -> float | None:
+    import email.utils
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimit:
+    """The GitHub API rate limit budget, as reported by the most recent response"""
+    def __init__(self) -> None:
+        self.remaining: int | None = None
+        self.reset_at: float | None = None
+        self._lock = LoopLocal(asyncio.Lock)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """Update the budget from the ``X-RateLimit-*`` headers of a response"""
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is not None and remaining.isdigit():
+            self.remaining = int(remaining)
+        if reset is not None and reset.isdigit():
+            self.reset_at = float(reset)
+
+    @property
+    def is_low(self) -> bool:
+        """Whether the remaining budget is low enough that requests are being paced"""
+        return self.remaining is not None and self.remaining < PACE_BELOW
+
+    async def pace(self, url: str) -> None:
+        """
+        Wait as needed to spread the remaining budget over the rest of the rate
+        limit window. If the budget is exhausted and will not be reset within
+        :data:`MAX_RATE_LIMIT_WAIT`, raises :class:`GitHubError` right away.
+        """
+        async with self._lock.get():
+            if not self.is_low or self.reset_at is None:
+                return
+            assert self.remaining is not None
+            until_reset = self.reset_at - time.time()
+            if until_reset <= 0:
+                return
+            if self.remaining == 0:
+                if until_reset > MAX_RATE_LIMIT_WAIT:
+                    raise GitHubError(url, None, f'The rate limit is exhausted for the next {until_reset:.0f}s')
+                await asyncio.sleep(until_reset)
+                self.remaining = None
+                return
+            await asyncio.sleep(until_reset / self.remaining)
+            self.remaining -= 1
+
+
+RATE_LIMIT = RateLimit()
+
+
+class _Response(NamedTuple):
+    data: Any
+    "The decoded JSON body, or ``None`` if the resource is not modified (HTTP 304)"
+    etag: Optional[str]
+
+
+async def _request_once(url: str, headers: Mapping[str, str]) -> _Response:
+    import aiohttp
+    await RATE_LIMIT.pace(url)
+    try:
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        async with net.session().get(url, headers=headers, timeout=timeout) as resp:
+            RATE_LIMIT.update(resp.headers)
+            ioacct.count('net', nbytes=len(await resp.read()))
+            if resp.status == 200:
+                return _Response(await resp.json(), resp.headers.get('ETag'))
+            if resp.status == 304:
+                return _Response(None, resp.headers.get('ETag'))
+            message = f'HTTP {resp.status}: {(await resp.text())[:200]}'
+            retry_after = resp.headers.get('Retry-After')
+            if resp.status in (403, 429) and retry_after is not None:
+                # Secondary rate limit
+                raise _RateLimitFailure(url, resp.status, message, _parse_retry_after(retry_after) or BACKOFF_MAX)
+            if resp.status in (403, 429) and resp.headers.get('X-RateLimit-Remaining') == '0':
+                wait = (RATE_LIMIT.reset_at or time.time()) - time.time()
+                raise _RateLimitFailure(url, resp.status, message, max(1.0, wait))
+            if resp.status in _RETRY_STATUSES:
+                raise _TransientFailure(url, resp.status, message)
+            raise GitHubError(url, resp.status, message)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise _TransientFailure(url, None, f'{type(e).__name__}: {e}') from e
+
+
+async def _hedged(url: str, headers: Mapping[str, str]) -> _Response:
+    hedge_after = _HEDGE_AFTER.get()
+    if hedge_after is None or RATE_LIMIT.is_low:
+        return await _request_once(url, headers)
+    racing = {asyncio.ensure_future(_request_once(url, headers))}
+    try:
+        done, _ = await asyncio.wait(racing, timeout=hedge_after)
+        if not done:
+            racing.add(asyncio.ensure_future(_request_once(url, headers)))
+        while 1:
+            done, racing = await asyncio.wait(racing, return_when=asyncio.FIRST_COMPLETED)
+            # Both requests may complete at once: Prefer the one that succeeded
+            succeeded = [fut for fut in done if fut.exception() is None]
+            if succeeded:
+                return succeeded[0].result()
+            if not racing:
+                return done.pop().result()
+    finally:
+        for fut in racing:
+            fut.cancel()
+
+
+def api_url() -> str:
+    """
+    The base URL of the GitHub API. Can be overridden with the
+    ``DDS_PORTS_GITHUB_API_URL`` environment variable.
+    """
+    return os.getenv('DDS_PORTS_GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+async def _github_get(path: str, etag: Optional[str] = None) -> _Response:
     token = os.getenv('GITHUB_API_TOKEN', os.getenv('GITHUB_TOKEN'))
     if token is None:
         raise RuntimeError('Set a GITHUB_API_TOKEN environment variable to talk with GitHub, please')
@@ -23,20 +191,123 @@ async def github_http_get(path: str) -> Any:
         'Accept-Encoding': 'application/json',
         'Authorization': f'token {token}',
     }
-    url = f'https://api.github.com{path}'
-    async with HTTP_SEMAPHORE:
-        resp = await HTTP_SESSION.get(url, headers=headers)
-        return await resp.json()
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    url = f'{api_url()}{path}'
+    async with HTTP_SEMAPHORE.get():
+        for attempt in range(MAX_ATTEMPTS):
+            last = attempt == MAX_ATTEMPTS - 1
+            try:
+                return await _hedged(url, headers)
+            except _RateLimitFailure as e:
+                if last or e.retry_after > MAX_RATE_LIMIT_WAIT:
+                    raise
+                print(f'GitHub rate limit reached. Retrying {path} in {e.retry_after:.0f}s')
+                await asyncio.sleep(e.retry_after + random.uniform(0, 1))
+            except _TransientFailure as e:
+                if last:
+                    raise
+                delay = _backoff(attempt)
+                print(f'{e} (Retrying in {delay:.1f}s)')
+                await asyncio.sleep(delay)
+    raise AssertionError('unreachable')
+
+
+async def github_http_get(path: str) -> Any:
+    """
+    Issue a GET request for the given GitHub API path, and return the decoded
+    JSON response.
+
+    Requests are paced according to the ``X-RateLimit-*`` headers of earlier
+    responses. Server errors and connection failures are retried with
+    jittered exponential backoff, and rate-limited requests are retried after
+    ``Retry-After`` or the rate limit reset (see :data:`MAX_ATTEMPTS`). Slow
+    requests may be hedged (see :func:`hedging`).
+
+    Raises :class:`GitHubError` if the request fails.
+    """
+    return (await _github_get(path)).data
+
+
+def _tags_cache_path(owner: str, repo: str) -> Path:
+    return cache.cache_dir('tags') / owner / f'{repo}.json'
+
+
+@contextmanager
+def prefer_cached_tags() -> Iterator[None]:
+    """
+    Within this context, :func:`get_repo_tags` will return the tags from the
+    most recent successful listing of a repository rather than asking GitHub.
+    Repositories that have never been listed are still queried.
+    """
+    tok = _PREFER_CACHED_TAGS.set(True)
+    try:
+        yield
+    finally:
+        _PREFER_CACHED_TAGS.reset(tok)
+
+
+@contextmanager
+def hedging(after: Optional[float]) -> Iterator[None]:
+    """
+    Within this context, a GitHub API request that has not completed after
+    ``after`` seconds is raced by a second, identical request (``None`` for no
+    hedging). Hedging is skipped when the rate limit is running low.
+    """
+    tok = _HEDGE_AFTER.set(after)
+    try:
+        yield
+    finally:
+        _HEDGE_AFTER.reset(tok)
+
+
+_WARM_TAGS: dict[tuple[str, str], tuple[str, list[str]]] = {}
+"""
+The ETag and tags of each repository listed by this process. Listing a
+repository again is a conditional request, which GitHub answers with "304 Not
+Modified" (not counted against the rate limit) if the tags are unchanged.
+"""
+
+
+def _read_cached_tags(cache_path: Path) -> list[str]:
+    return cast('list[str]', json.loads(cache_path.read_text()))
 
 
 async def get_repo_tags(owner: str, repo: str) -> Iterable[str]:
+    """
+    Get the names of the tags of a GitHub repository. If GitHub cannot be
+    reached (or the rate limit is exhausted), the tags from the most recent
+    successful listing are used instead, and a repository that has never been
+    listed is treated as having no tags.
+    """
+    cache_path = _tags_cache_path(owner, repo)
+    if _PREFER_CACHED_TAGS.get() and cache_path.is_file():
+        return _read_cached_tags(cache_path)
     print(f'Collecting tags for GitHub repo {owner}/{repo}')
-    resp = await github_http_get(f'/repos/{owner}/{repo}/tags')
-    return (t['name'] for t in resp)
+    warm = _WARM_TAGS.get((owner, repo))
+    try:
+        resp = await _github_get(f'/repos/{owner}/{repo}/tags', etag=warm[0] if warm else None)
+    except GitHubError as e:
+        if e.status == 404:
+            raise
+        if cache_path.is_file():
+            print(f'Warning: {e}\n  Using the previously listed tags of {owner}/{repo}')
+            return _read_cached_tags(cache_path)
+        print(f'Warning: {e}\n  No tags of {owner}/{repo} have been listed before. Skipping it.')
+        return []
+    if resp.data is None and warm:
+        return warm[1]
+    tags = [t['name'] for t in resp.data]
+    if resp.etag is not None:
+        _WARM_TAGS[(owner, repo)] = (resp.etag, tags)
+    with cache.publishing_file(cache_path) as tmp:
+        tmp.write_text(json.dumps(tags))
+    return tags
 
 
-def session_context_manager() -> AsyncContextManager[client.ClientSession]:
-    return HTTP_SESSION
+def session_context_manager() -> AsyncContextManager[None]:
+    """Use the shared HTTP session (see :func:`.net.session_scope`)"""
+    return net.session_scope()
 
 
 def _each_tag_as_version(owner: str, repo: str, tags: Iterable[str]) -> Iterable[VersionInfo]:
@@ -75,14 +346,40 @@ def _tags_as_ports(tags: Iterable[str],
             continue
         if max_version is not None and ver >= max_version:
             continue
+        if not selection.current().wants_version(ver):
+            continue
         pid = PackageID(name=pkg_name or repo, version=ver, revision=revision)
-        yield porttype(pid.name, pid, gh_repo_url(owner, repo), t)
+        yield porttype(gh_clone_key(owner, repo), pid, gh_repo_url(owner, repo), t)
 
 
 def gh_repo_url(owner: str, repo: str) -> str:
     return f'https://github.com/{owner}/{repo}.git'
 
 
+def codeload_url() -> str:
+    """
+    The base URL from which GitHub serves source archives. Can be overridden
+    with the ``DDS_PORTS_CODELOAD_URL`` environment variable (e.g. to serve
+    archives locally).
+    """
+    return os.getenv('DDS_PORTS_CODELOAD_URL', 'https://codeload.github.com').rstrip('/')
+
+
+def gh_archive_url(owner: str, repo: str, tag: str) -> str:
+    """The URL of the .tar.gz source archive of a tag of a GitHub repository"""
+    return f'{codeload_url()}/{owner}/{repo}/tar.gz/refs/tags/{tag}'
+
+
+def gh_archive_key(owner: str, repo: str, tag: str) -> str:
+    """The download cache key for the source archive of a tag of a GitHub repository"""
+    return f'gh/{owner}/{repo}/{tag}.tar.gz'
+
+
+def gh_clone_key(owner: str, repo: str) -> str:
+    """The mirror clone key for a GitHub repository, shared by every port of that repository"""
+    return f'gh/{owner}/{repo}'
+
+
 async def native_dds_ports_for_github_repo(*,
                                            owner: str,
                                            repo: str,
@@ -90,6 +387,8 @@ async def native_dds_ports_for_github_repo(*,
                                            min_version: VersionInfo = VersionInfo(0),
                                            max_version: VersionInfo | None = None,
                                            revision: int = 1) -> Iterable[Port]:
+    if not selection.current().wants_package(pkg_name or repo):
+        return ()
     tags = await get_repo_tags(owner, repo)
     print(f'Generating ports for {owner}/{repo}')
     return _tags_as_ports(tags, owner, repo, pkg_name, min_version, max_version, revision, porttype=LegacyDDSGitPort)
@@ -102,5 +401,7 @@ async def native_bpt_ports_for_github_repo(*,
                                            min_version: VersionInfo = VersionInfo(0),
                                            max_version: VersionInfo | None = None,
                                            revision: int = 1) -> Iterable[Port]:
+    if not selection.current().wants_package(pkg_name or repo):
+        return ()
     tags = await get_repo_tags(owner, repo)
     return _tags_as_ports(tags, owner, repo, pkg_name, min_version, max_version, revision, porttype=SimpleGitPort)
@@ -0,0 +1,126 @@
+"""
+Historical timings of port preparation and import stages.
+
+Stage timings are recorded by a Dagon extension
+(:class:`dds_ports.timing.TimingExtension`) that measures each task as it runs,
+and are kept in a small SQLite database in the dds-ports cache directory. The
+recorded timings are used to estimate the cost of future runs.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING, Iterable, NamedTuple
+
+from . import cache
+from .port import PackageID
+
+if TYPE_CHECKING:
+    import sqlite3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stage_timings (
+    subject TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stage_timings_by_subject ON stage_timings (subject, stage, recorded_at);
+'''
+
+RECENT_SAMPLES = 5
+"The number of most recent samples that are averaged to estimate a stage"
+
+
+class TaskSubject(NamedTuple):
+    """The package (or mirror key) and stage that a task name refers to"""
+    subject: str
+    stage: str
+
+
+def task_subject(task_name: str) -> TaskSubject:
+    """
+    Split a task name into the subject and stage that it works on.
+
+    Task names are of the form ``<package-id>@<stage>`` or ``<clone-key>@<stage>``.
+    A task named with only a package ID is the package's "prep" stage.
+    """
+    try:
+        return TaskSubject(str(PackageID.parse(task_name)), 'prep')
+    except ValueError:
+        pass
+    subject, _, stage = task_name.rpartition('@')
+    if not subject:
+        return TaskSubject(task_name, 'run')
+    return TaskSubject(subject, stage)
+
+
+class History:
+    """Access to the database of historical stage timings"""
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self._db = db
+        self._db.executescript(_SCHEMA)
+
+    @staticmethod
+    def open() -> 'History':
+        """Open the history database in the dds-ports cache directory"""
+        import sqlite3  # pylint: disable=redefined-outer-name
+        root = cache.cache_root()
+        root.mkdir(exist_ok=True, parents=True)
+        return History(sqlite3.connect(root / 'history.db', timeout=30))
+
+    def close(self) -> None:
+        """Close the database"""
+        self._db.close()
+
+    def record(self, subject: str, stage: str, seconds: float) -> None:
+        """Record the duration of a stage for a package or mirror"""
+        with self._db:
+            self._db.execute('INSERT INTO stage_timings (subject, stage, seconds, recorded_at) VALUES (?, ?, ?, ?)',
+                             (subject, stage, seconds, time.time()))
+
+    def _stage_means(self, subjects: Iterable[str]) -> dict[str, float]:
+        samples: dict[str, list[float]] = {}
+        for subject in subjects:
+            rows = self._db.execute(
+                '''
+                SELECT stage, seconds FROM stage_timings
+                 WHERE subject = ?
+                 ORDER BY recorded_at DESC
+                ''', (subject, ))
+            for stage, seconds in rows:
+                stage_samples = samples.setdefault(stage, [])
+                if len(stage_samples) < RECENT_SAMPLES:
+                    stage_samples.append(seconds)
+        return {stage: sum(vals) / len(vals) for stage, vals in samples.items()}
+
+    def _subject_estimate(self, subject: str, stage: str | None) -> float | None:
+        means = self._stage_means([subject])
+        if stage is not None:
+            return means.get(stage)
+        return sum(means.values()) if means else None
+
+    def estimate(self, pid: PackageID, *, stage: str | None = None) -> float | None:
+        """
+        Estimate the total duration of all stages (or of only ``stage``) of the
+        given package, based on previous runs of the same package ID, or else
+        of other versions of the same package. Returns ``None`` if there is no
+        history for the package.
+        """
+        own = self._subject_estimate(str(pid), stage)
+        if own is not None:
+            return own
+        others = [
+            row[0] for row in self._db.execute(
+                '''
+                SELECT subject FROM stage_timings
+                 WHERE subject LIKE ? ESCAPE '\\'
+                 GROUP BY subject
+                 ORDER BY max(recorded_at) DESC
+                 LIMIT ?
+                ''', (pid.name.replace('%', '\\%').replace('_', '\\_') + '@%', RECENT_SAMPLES))
+        ]
+        per_version = [e for e in (self._subject_estimate(o, stage) for o in others) if e is not None]
+        if not per_version:
+            return None
+        return sum(per_version) / len(per_version)
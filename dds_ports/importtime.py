@@ -0,0 +1,117 @@
+"""
+Import-time budget check for the command-line entry points of dds-ports.
+
+Each entry module is imported in a fresh interpreter with ``python -X
+importtime``. The modules that must not be imported at startup (Dagon and
+aiohttp are slow to import) are reported if they are, and the best cumulative
+import time over several runs is reported along with the module's budget.
+
+Run with ``python -m dds_ports.importtime``. Exits non-zero if any entry module
+imports one of :data:`DEFERRED_MODULES`. Import times depend on the machine
+(and on how busy it is), so a module over its budget is only reported, unless
+``--strict`` is given.
+"""
+
+from __future__ import annotations
+
+import argparse
+import subprocess
+import sys
+from typing import NamedTuple, NoReturn, Optional, Sequence, cast
+
+from typing_extensions import Protocol
+
+BUDGETS_MS = {
+    'dds_ports.main': 80.0,
+    'dds_ports.cache_tool': 70.0,
+    'dds_ports.merge': 70.0,
+    'dds_ports.report': 70.0,
+}
+"""
+Import time budgets (in milliseconds) of the entry modules on a quiet machine.
+Enforced by ``make import-time``, which runs with ``--strict``.
+"""
+
+DEFERRED_MODULES = ('dagon', 'aiohttp', 'json5')
+"Top-level packages that the entry modules must only import when they are used"
+
+
+class ImportTiming(NamedTuple):
+    """The import of one entry module in a fresh interpreter"""
+    cumulative_ms: float
+    "The time spent importing the module, including the modules it imports"
+    modules: frozenset[str]
+    "Every module that was imported along with it"
+
+
+class CommandArguments(Protocol):
+    modules: list[str]
+    runs: int
+    budget: Optional[float]
+    strict: bool
+
+
+def measure(module: str) -> ImportTiming:
+    """Import ``module`` in a new interpreter and measure the import"""
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE,
+                         check=True)
+    cumulative: float | None = None
+    modules: set[str] = set()
+    for line in res.stderr.decode().splitlines():
+        # import time: <self us> | <cumulative us> | <indented module name>
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        modules.add(name)
+        if parts[2] == f' {name}' and name == module:
+            cumulative = int(parts[1]) / 1000
+    if cumulative is None:
+        raise RuntimeError(f'No import time was reported for {module}')
+    return ImportTiming(cumulative, frozenset(modules))
+
+
+def check(module: str, budget_ms: float, runs: int, *, strict: bool = False) -> bool:
+    """
+    Measure the import of ``module`` and print whether it imports any of the
+    deferred modules, and whether it is within its budget. Returns ``False`` if
+    it imports a deferred module (or, if ``strict``, if it is over budget).
+    """
+    timings = [measure(module) for _ in range(runs)]
+    best = min(t.cumulative_ms for t in timings)
+    deferred = sorted(set(m for t in timings for m in t.modules if m in DEFERRED_MODULES))
+    over = best > budget_ms
+    ok = not deferred and not (strict and over)
+    note = ', over budget' if over else ''
+    print(f'{"OK" if ok else "FAIL":4}  {module}: {best:.1f}ms (budget {budget_ms:.0f}ms{note}, best of {runs})')
+    for name in deferred:
+        print(f'        imports {name} at startup')
+    return ok
+
+
+def main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='python -m dds_ports.importtime')
+    parser.add_argument('modules',
+                        nargs='*',
+                        metavar='<module>',
+                        help=f'The modules to check (Default: {", ".join(BUDGETS_MS)})')
+    parser.add_argument('--runs', type=int, default=5, help='Measure each module this many times (Default: 5)')
+    parser.add_argument('--budget',
+                        metavar='<ms>',
+                        type=float,
+                        help='Use this budget (in milliseconds) instead of the budget of each module')
+    parser.add_argument('--strict', action='store_true', help='Also fail if a module is over its budget')
+    args = cast(CommandArguments, parser.parse_args(argv))
+    modules = args.modules or list(BUDGETS_MS)
+    results = [check(m, args.budget or BUDGETS_MS.get(m, 100.0), args.runs, strict=args.strict) for m in modules]
+    return 0 if all(results) else 1
+
+
+def start() -> NoReturn:
+    sys.exit(main(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    start()
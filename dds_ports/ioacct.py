@@ -0,0 +1,146 @@
+"""
+Accounting of the I/O of a run, per package, stage and channel.
+
+While a run is accounted (see :func:`accounting`), the code that talks to the
+network (GitHub API requests and archive downloads), runs Git, or works on
+files (the helpers of :mod:`dds_ports.fs` and :mod:`dds_ports.blobs`) reports
+what it did with :func:`count`: the bytes it transferred, the files it touched,
+and the operations it performed (requests, Git processes and object reads, or
+filesystem calls). Counts are attributed to the package of the current context
+(see :func:`.metrics.for_package`) and to the stage of the current task. Work
+that is not done for a single package (e.g. listing the tags of upstream
+repositories) is attributed to no package.
+
+Counting is cheap, and may be done from the filesystem threads, which run in
+a copy of the context of their caller (see :func:`.fs.run_fs_op`).
+"""
+
+from __future__ import annotations
+
+import contextvars
+import json
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+from typing_extensions import Literal
+
+from . import metrics
+from .util import format_size
+
+Channel = Literal['net', 'git', 'fs']
+CHANNELS: tuple[Channel, ...] = ('net', 'git', 'fs')
+
+
+class IOCounts(NamedTuple):
+    """The I/O of one package, stage and channel (or a total of several)"""
+    bytes: int = 0
+    "The number of bytes transferred (received, read, or written)"
+    files: int = 0
+    "The number of files touched"
+    ops: int = 0
+    "The number of operations (requests, Git processes or object reads, filesystem calls)"
+
+    def __add__(self, other: object) -> IOCounts:
+        assert isinstance(other, IOCounts)
+        return IOCounts(self.bytes + other.bytes, self.files + other.files, self.ops + other.ops)
+
+
+class IOKey(NamedTuple):
+    """What a count is attributed to"""
+    package: Optional[str]
+    "The package ID, or ``None`` for work that is not done for a single package"
+    stage: Optional[str]
+    "The stage of the task (see :func:`.history.task_subject`), or ``None`` outside of tasks"
+    channel: Channel
+
+
+class IOAccount:
+    """The I/O counts of one run"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts: dict[IOKey, IOCounts] = {}
+
+    def count(self, key: IOKey, counts: IOCounts) -> None:
+        """Add to the counts of the given key"""
+        with self._lock:
+            self._counts[key] = self._counts.get(key, IOCounts()) + counts
+
+    @property
+    def counts(self) -> dict[IOKey, IOCounts]:
+        """A snapshot of all counts"""
+        with self._lock:
+            return dict(self._counts)
+
+    def totals(self) -> dict[Channel, IOCounts]:
+        """The total counts of each channel"""
+        totals = {ch: IOCounts() for ch in CHANNELS}
+        for key, counts in self.counts.items():
+            totals[key.channel] += counts
+        return totals
+
+    def summary(self) -> str:
+        """A one-line summary of the totals, for the run summary"""
+        return ', '.join(f'{ch}: {format_size(c.bytes)} in {c.files} files, {c.ops} ops'
+                         for ch, c in self.totals().items())
+
+    def to_json(self) -> str:
+        """Render the counts (and the totals of each channel) as a JSON document"""
+        return json.dumps(
+            {
+                'totals': {ch: c._asdict()
+                           for ch, c in self.totals().items()},
+                'counts': [{
+                    'package': key.package,
+                    'stage': key.stage,
+                    'channel': key.channel,
+                    **counts._asdict(),
+                } for key, counts in sorted(self.counts.items(), key=lambda kv: tuple(map(str, kv[0])))],
+            },
+            indent=2,
+        )
+
+    def write(self, path: Path) -> None:
+        """Write the counts as JSON (see :meth:`to_json`) to the given file"""
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path.write_text(self.to_json())
+
+
+_ACCOUNT = contextvars.ContextVar['IOAccount | None']('_IO_ACCOUNT', default=None)
+_STAGE = contextvars.ContextVar['str | None']('_IO_STAGE', default=None)
+
+
+def active() -> bool:
+    """Whether the I/O of the current context is being accounted"""
+    return _ACCOUNT.get() is not None
+
+
+@contextmanager
+def accounting() -> Iterator[IOAccount]:
+    """Account the I/O that is done within the context"""
+    acct = IOAccount()
+    tok = _ACCOUNT.set(acct)
+    try:
+        yield acct
+    finally:
+        _ACCOUNT.reset(tok)
+
+
+@contextmanager
+def in_stage(stage: str) -> Iterator[None]:
+    """Attribute the I/O that is done within the context to the given stage"""
+    tok = _STAGE.set(stage)
+    try:
+        yield
+    finally:
+        _STAGE.reset(tok)
+
+
+def count(channel: Channel, *, nbytes: int = 0, files: int = 0, ops: int = 1) -> None:
+    """Count I/O of the current package and stage. Does nothing if I/O is not being accounted."""
+    acct = _ACCOUNT.get()
+    if acct is None:
+        return
+    pid = metrics.current_package()
+    acct.count(IOKey(None if pid is None else str(pid), _STAGE.get(), channel), IOCounts(nbytes, files, ops))
@@ -0,0 +1,182 @@
+"""
+Checkpoint journal of a repository build, for resuming interrupted runs.
+
+Every run appends the stages that it completes (mirror fetched, sdist
+prepared, package imported) to a journal file for its repository in the
+dds-ports cache directory. A run with ``--resume`` reads the journal of the
+previous run, and if that run did not finish it skips the work that was
+already done: Fetched mirrors are not fetched again, and sdists that are still
+intact in the staging directory are imported without being prepared again.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, Iterator, Mapping, NamedTuple
+
+from . import cache
+from .port import PackageID
+
+
+class PreparedSdist(NamedTuple):
+    """An sdist that was prepared by an earlier run"""
+    sdist: Path
+    digest: str
+    "The :func:`~.fs.tree_digest` of the sdist directory when it was prepared"
+
+
+class ResumeState(NamedTuple):
+    """The work that was completed by an unfinished earlier run"""
+    mirrors: frozenset[str] = frozenset()
+    "Clone keys of the mirrors that were fetched"
+    prepared: Mapping[PackageID, PreparedSdist] = {}
+    "Sdists that were prepared but not imported"
+    imported: frozenset[PackageID] = frozenset()
+    "Packages that were imported"
+
+
+def journal_path(repo_dir: Path) -> Path:
+    """The path to the journal file for the repository in the given directory"""
+    key = hashlib.sha1(str(repo_dir.resolve()).encode()).hexdigest()[:16]
+    return cache.cache_dir('journal') / f'{key}.jsonl'
+
+
+def _read_events(path: Path) -> list[dict[str, Any]]:
+    events: list[dict[str, Any]] = []
+    try:
+        lines = path.read_text().splitlines()
+    except FileNotFoundError:
+        return events
+    for line in lines:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            # A partial line left by a run that was killed mid-write
+            continue
+    return events
+
+
+def read_resume_state(path: Path) -> ResumeState | None:
+    """
+    Read the work completed by the last run recorded in the given journal.
+    Returns ``None`` if there is no journal, or if the last run finished.
+    """
+    events = _read_events(path)
+    if not events or events[-1]['event'] == 'finish':
+        return None
+    mirrors: set[str] = set()
+    prepared: dict[PackageID, PreparedSdist] = {}
+    imported: set[PackageID] = set()
+    for ev in events:
+        kind = ev['event']
+        if kind == 'mirror-fetched':
+            mirrors.add(ev['key'])
+        elif kind == 'prepared':
+            prepared[PackageID.parse(ev['package'])] = PreparedSdist(Path(ev['sdist']), ev['digest'])
+        elif kind == 'imported':
+            pid = PackageID.parse(ev['package'])
+            imported.add(pid)
+            prepared.pop(pid, None)
+    return ResumeState(frozenset(mirrors), prepared, frozenset(imported))
+
+
+def unfinished_sdists() -> set[Path]:
+    """
+    The sdists that were prepared but not imported by the unfinished runs of
+    all repositories. They are kept for the runs that resume them.
+    """
+    sdists: set[Path] = set()
+    for path in cache.cache_dir('journal').glob('*.jsonl'):
+        state = read_resume_state(path)
+        if state is not None:
+            sdists.update(p.sdist for p in state.prepared.values())
+    return sdists
+
+
+class Journal:
+    """
+    An append-only record of the stages completed by a run. A journal without
+    a file records nothing.
+    """
+    def __init__(self, out: IO[str] | None, resumed: ResumeState | None = None) -> None:
+        self._out = out
+        self._resumed = resumed or ResumeState()
+
+    @staticmethod
+    def start(repo_dir: Path, *, resume: bool = False) -> 'Journal':
+        """
+        Start the journal of a run that builds the repository in the given
+        directory. If ``resume`` is true and the previous run did not finish,
+        the previous run's journal is continued, and its state is available as
+        :attr:`resumed`. Otherwise a new journal is started.
+        """
+        path = journal_path(repo_dir)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        state = read_resume_state(path) if resume else None
+        journal = Journal(path.open('a' if state else 'w'), state)  # pylint: disable=consider-using-with
+        journal.record('resume' if state else 'start')
+        return journal
+
+    @property
+    def resumed(self) -> ResumeState:
+        """The work completed by the run that is being resumed (empty if not resuming)"""
+        return self._resumed
+
+    def record(self, event: str, **fields: str) -> None:
+        """Append an event to the journal"""
+        if self._out is None:
+            return
+        self._out.write(json.dumps({'event': event, 'time': time.time(), **fields}) + '\n')
+        self._out.flush()
+        os.fsync(self._out.fileno())
+
+    def mirror_fetched(self, key: str) -> None:
+        """Record that the mirror with the given clone key was fetched"""
+        self.record('mirror-fetched', key=key)
+
+    def mirror_is_fresh(self, key: str) -> bool:
+        """Whether the mirror with the given clone key was fetched by the run being resumed"""
+        return key in self._resumed.mirrors
+
+    def prepared(self, pid: PackageID, sdist: Path, digest: str) -> None:
+        """Record that the sdist for the given package was prepared"""
+        self.record('prepared', package=str(pid), sdist=str(sdist), digest=digest)
+
+    def imported(self, pid: PackageID) -> None:
+        """Record that the given package was imported"""
+        self.record('imported', package=str(pid))
+
+    def finish(self) -> None:
+        """Record that the run finished. A finished run will not be resumed."""
+        self.record('finish')
+
+    def close(self) -> None:
+        """Close the journal file"""
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+
+_CURRENT = contextvars.ContextVar('_CURRENT_JOURNAL', default=Journal(None))
+
+
+def current() -> Journal:
+    """Get the journal of the current run. Records nothing if no journal was set with :func:`journaling`"""
+    return _CURRENT.get()
+
+
+@contextmanager
+def journaling(journal: Journal) -> Iterator[Journal]:
+    """Make the given journal current for the duration of the context, and close it afterwards"""
+    tok = _CURRENT.set(journal)
+    try:
+        yield journal
+    finally:
+        _CURRENT.reset(tok)
+        journal.close()
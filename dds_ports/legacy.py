@@ -3,14 +3,16 @@ from __future__ import annotations
 from copy import deepcopy
 from pathlib import Path
 import re
-from typing import Iterable, Sequence, Union
-
-from dagon import task
+from typing import TYPE_CHECKING, Iterable, Sequence, Union
 
 from . import crs
+from .deferred import dagon
 from .auto import read_package_json, read_library_jsons
 from .git import SimpleGitPort
 
+if TYPE_CHECKING:
+    from dagon import task
+
 
 class LegacyDDSGitPort(SimpleGitPort):
     def _fixup_crs(self, dirpath: Path) -> None:
@@ -55,13 +57,13 @@ class LegacyDDSGitPort(SimpleGitPort):
         return list(self._fixup_dep_str(key + mark) for key, mark in deps.items())
 
     async def _fixup(self, prepper: task.Task[Path]) -> Path:
-        self._fixup_crs(await task.result_of(prepper))
-        p: Path = await task.result_of(prepper)
+        self._fixup_crs(await dagon.task.result_of(prepper))
+        p: Path = await dagon.task.result_of(prepper)
         return p
 
     def make_prep_task(self) -> task.Task[Path]:
         prep = super().make_prep_task()
-        return task.fn_task(f'{self.package_id}@fixup-legacy', lambda: self._fixup(prep), depends=[prep])
+        return dagon.task.fn_task(f'{self.package_id}@fixup-legacy', lambda: self._fixup(prep), depends=[prep])
 
     def __repr__(self) -> str:
         return f'<LegacyDDSGitPort package={self.package_id} url=[{self._url}]>'
@@ -2,89 +2,316 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import contextlib
 import sys
 from pathlib import Path
-from typing import Iterable, NoReturn, Sequence, cast
-
-import dagon.ext.exec
-import dagon.ext.loader
-import dagon.pool
-import dagon.tool.main
-import dagon.ui
-from dagon import proc, task
-from dagon.task import TaskDAG
-from dagon.task.dag import populate_dag_context
+from typing import TYPE_CHECKING, Iterable, NoReturn, Optional, Sequence, cast
+
+from semver import VersionInfo
 from typing_extensions import Protocol
 
-from .collect import collect_ports
+# Dagon and the modules that build on it are slow to import. They are imported
+# by the commands that run ports, so that e.g. --plan starts quickly.
+from . import cache, github, profiling
+from .builder import BuildConfig, open_builder
+from .collect import collect_ports, collect_ports_with_origin
 from .github import session_context_manager
+from .history import History
+from .plan import compute_plan
 from .port import Port, PackageID
 from .repo import RepositoryAccess
+from .selection import PortSelection, Shard
+from .staging import PREP_JOBS
+from .util import format_size, parse_size
+
+if TYPE_CHECKING:
+    from .pipeline import PipelineResult
+    from .serve import Address
 
 
 class CommandArguments(Protocol):
     ports_dir: Path
     repo_dir: Path
+    staging_dir: Optional[Path]
+    staging_budget: Optional[int]
+    cache_max_size: Optional[int]
+    select: list[str]
+    port_file: list[str]
+    min_version: Optional[VersionInfo]
+    max_version: Optional[VersionInfo]
+    newest: Optional[int]
+    shard: Optional[Shard]
+    plan: bool
+    plan_format: str
+    workers: Optional[int]
+    jobs: int
+    resume: bool
+    full_validate_every: float
+    no_full_validate: bool
+    github_hedge_after: Optional[float]
+    io_report: Optional[Path]
+    profile: Optional[profiling.Mode]
+    profile_dir: Path
+    interval: float
+    listen: Optional[Address]
 
 
-async def _init_all_ports(dirpath: Path) -> Iterable[Port]:
+async def _init_all_ports(dirpath: Path, selection: PortSelection) -> Iterable[Port]:
     async with session_context_manager():
-        return await collect_ports(dirpath)
+        return await collect_ports(dirpath, selection)
 
 
-async def _import_from(repo: RepositoryAccess, id_: PackageID, pkg: task.Task[Path], imported: set[PackageID]) -> None:
-    d = await task.result_of(pkg)
-    dagon.ui.status(f'Importing {id_}')
-    await proc.run(['./bpt', 'repo', 'import', str(repo.directory), d, '--if-exists=replace'], on_output='status')
-    dagon.ui.print(f'New package imported: {id_}')
-    imported.add(id_)
+async def _init_ports_with_origin(dirpath: Path, selection: PortSelection) -> list[tuple[Path, Port]]:
+    async with session_context_manager():
+        return await collect_ports_with_origin(dirpath, selection)
 
 
-def make_importer(repo: RepositoryAccess, id_: PackageID, prepper: task.Task[Path],
-                  imported: set[PackageID]) -> task.Task[None]:
-    return task.fn_task(f'{id_}@import', lambda: _import_from(repo, id_, prepper, imported), depends=[prepper])
+def _run_workers(args: CommandArguments, selection: PortSelection) -> int:
+    from .validate import validate_imports
+    from .worker import run_with_workers
+    assert args.workers
+    with github.hedging(args.github_hedge_after):
+        ports = asyncio.get_event_loop().run_until_complete(_init_ports_with_origin(args.ports_dir, selection))
+    repo = RepositoryAccess.open(args.repo_dir)
+    result = run_with_workers(repo, ports, args.workers)
+    # The packages that were imported are validated even if others failed
+    asyncio.run(validate_imports(repo, result.imported.values(), full_interval=_full_validate_interval(args)))
+    _print_imported(result.imported)
+    for job in result.failed:
+        print(f'Failed to prepare/import {job.package_id}:\n{job.error}', file=sys.stderr)
+    if result.failed:
+        print(f'{len(result.failed)} packages failed', file=sys.stderr)
+        return 1
+    return 0
 
 
-def main(argv: Sequence[str]) -> int:
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--ports-dir', type=Path, required=True, help='Root directory of the ports directories')
-    parser.add_argument('--repo-dir', type=Path, required=True, help='Directory containing the dds repository')
-    args = cast(CommandArguments, parser.parse_args(argv))
-    dag = TaskDAG('<dds-ports-mkrepo>')
-    ports = asyncio.get_event_loop().run_until_complete(_init_all_ports(args.ports_dir))
-    import_pkgs: list[task.Task[None]] = []
+def _full_validate_interval(args: CommandArguments) -> Optional[float]:
+    if args.no_full_validate:
+        return None
+    return args.full_validate_every * 60 * 60
 
-    repo = RepositoryAccess.open(args.repo_dir)
-    exts = dagon.tool.main.get_extensions()
-    imported: set[PackageID] = set()
-    with exts.app_context():
-        dagon.pool.add('cloner', 3)
-        dagon.pool.add('importer', 10)
-        with populate_dag_context(dag):
-            for p in ports:
-                prepper = p.make_prep_task()
-                if p.package_id in repo.packages:
-                    continue
-                importer = make_importer(repo, p.package_id, prepper, imported)
-                dagon.pool.assign(importer, 'importer')
-                import_pkgs.append(importer)
-
-            validate = proc.cmd_task('validate-repo', ['./bpt', 'repo', 'validate', repo.directory],
-                                     on_output='status',
-                                     depends=import_pkgs)
-            task.gather('all', [validate])
-
-        i: int = dagon.tool.main.run_for_dag(dag, exts, argv=[], default_tasks=['all'])
 
+def _print_imported(imported: Iterable[PackageID]) -> None:
     if imported:
         print('The following packages were imported:')
         for pid in sorted(imported):
             print(f'  - {pid}')
     else:
         print('No new packages were imported')
+
+
+def _print_result(result: PipelineResult) -> int:
+    _print_imported(result.imported)
+    if result.unchanged:
+        print(f'{len(result.unchanged)} packages were not imported because their content is unchanged')
+    if result.io is not None:
+        print(f'I/O: {result.io.summary()}')
+    if result.profile is not None:
+        print(f'Profile ({result.profile.mode}): {result.profile.summary()}')
+    for fpath, error in sorted(result.discovery_errors.items()):
+        print(f'Failed to load the ports of [{fpath}]:\n{error}', file=sys.stderr)
+    for pid, error in sorted(result.failed.items()):
+        print(f'Failed to prepare/import {pid}:\n{error}', file=sys.stderr)
+    if result.discovery_errors:
+        print(f'{len(result.discovery_errors)} port files failed to load', file=sys.stderr)
+    if result.failed:
+        print(f'{len(result.failed)} packages failed', file=sys.stderr)
+    return 1 if result.failed or result.discovery_errors else 0
+
+
+async def _run_pipeline(args: CommandArguments, config: BuildConfig) -> int:
+    async with open_builder(config) as builder:
+        return _print_result(await builder.build(resume=args.resume))
+
+
+async def _serve(args: CommandArguments, config: BuildConfig) -> int:
+    from .serve import serve
+
+    # The builder (and with it the package listing of the repository and the
+    # open HTTP connections) is kept for the life of the daemon
+    async with open_builder(config) as builder:
+
+        async def poll() -> PipelineResult:
+            result = await builder.build()
+            _print_result(result)
+            _collect_garbage(args)
+            return result
+
+        await serve(poll, interval=args.interval * 60, listen=args.listen)
+    return 0
+
+
+def _print_plan(args: CommandArguments, selection: PortSelection) -> int:
+    with profiling.profiling(args.profile, args.profile_dir) if args.profile else contextlib.nullcontext():
+        with github.prefer_cached_tags(), github.hedging(args.github_hedge_after), profiling.stage('discovery'):
+            ports = asyncio.get_event_loop().run_until_complete(_init_all_ports(args.ports_dir, selection))
+        repo = RepositoryAccess.open(args.repo_dir)
+        hist = History.open()
+        try:
+            with profiling.stage('plan'):
+                plan = compute_plan(ports, repo, hist)
+        finally:
+            hist.close()
+    print(plan.to_json() if args.plan_format == 'json' else plan.to_text())
+    return 0
+
+
+def _add_run_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--ports-dir', type=Path, required=True, help='Root directory of the ports directories')
+    parser.add_argument('--repo-dir', type=Path, required=True, help='Directory containing the dds repository')
+    parser.add_argument('--staging-dir',
+                        type=Path,
+                        help='Directory in which sdists are prepared (Default: within the dds-ports cache)')
+    parser.add_argument('--staging-budget',
+                        type=parse_size,
+                        help='Disk space that prepared-but-not-yet-imported sdists may occupy (e.g. "10G"). '
+                        'New preps will wait for imports to free space once this is reached.')
+    parser.add_argument('--cache-max-size',
+                        type=parse_size,
+                        help='After the run, evict least-recently-used cache entries until the dds-ports cache is '
+                        'no larger than this (e.g. "50G")')
+    parser.add_argument('--select',
+                        metavar='<glob>',
+                        action='append',
+                        default=[],
+                        help='Only build packages whose name matches the given glob (May be repeated)')
+    parser.add_argument('--port-file',
+                        metavar='<name>',
+                        action='append',
+                        default=[],
+                        help='Only load the named port file, e.g. "imgui_ports" (May be repeated)')
+    parser.add_argument('--min-version',
+                        type=VersionInfo.parse,
+                        help='Only build package versions at or above this version')
+    parser.add_argument('--max-version', type=VersionInfo.parse, help='Only build package versions below this version')
+    parser.add_argument('--newest', metavar='<N>', type=int, help='Only build the newest <N> versions of each package')
+    parser.add_argument('--shard',
+                        metavar='<i>/<N>',
+                        type=Shard.parse,
+                        help='Only build the i-th of N disjoint subsets of the packages (1 <= i <= N). '
+                        'Use dds-ports-merge to combine the resulting repositories.')
+    parser.add_argument('--jobs',
+                        metavar='<N>',
+                        type=int,
+                        default=PREP_JOBS,
+                        help=f'Number of packages to prepare concurrently (Default: {PREP_JOBS})')
+    parser.add_argument('--full-validate-every',
+                        metavar='<hours>',
+                        type=float,
+                        default=24,
+                        help='After importing, run a full "bpt repo validate" if the last full validation of the '
+                        'repository was more than <hours> ago. Use 0 to validate fully on every run. '
+                        'New packages and their dependents are always validated. (Default: 24)')
+    parser.add_argument('--no-full-validate',
+                        action='store_true',
+                        help='Never run a full "bpt repo validate", only validate new packages and their dependents')
+    parser.add_argument('--io-report',
+                        metavar='<path>',
+                        type=Path,
+                        help='Account the bytes, files and operations of network, Git and filesystem I/O of each '
+                        'package and stage, and write them to <path>, as JSON. The totals are printed at the end '
+                        'of the run.')
+    parser.add_argument('--profile',
+                        choices=profiling.MODES,
+                        help='Profile discovery, planning, and each prep and import task, sampling the CPU time '
+                        '("cpu") or the memory allocations ("alloc") of each. The profile is written to --profile-dir.')
+    parser.add_argument('--profile-dir',
+                        metavar='<dir>',
+                        type=Path,
+                        default=Path('dds-ports-profile'),
+                        help='Write the profile of each stage, and the merged profile of all stages, to <dir> as '
+                        'flame graph input in the "collapsed stacks" format (Default: %(default)s)')
+    parser.add_argument('--github-hedge-after',
+                        metavar='<seconds>',
+                        type=float,
+                        help='Send a second, identical GitHub API request if a request has not completed after '
+                        '<seconds>, and use whichever completes first (Not done while the rate limit is low)')
+
+
+def main(argv: Sequence[str]) -> int:
+    serving = argv[:1] == ['serve']
+    if serving:
+        from .serve import Address
+        parser = argparse.ArgumentParser(
+            prog='dds-ports-mkrepo serve',
+            description='Keep running, and poll the upstreams of the ports for new versions to import')
+        _add_run_arguments(parser)
+        parser.add_argument('--interval',
+                            metavar='<minutes>',
+                            type=float,
+                            default=15,
+                            help='Poll the upstreams every <minutes> minutes (Default: 15)')
+        parser.add_argument('--listen',
+                            metavar='[<host>:]<port>',
+                            type=Address.parse,
+                            help='Listen on the given local address for HTTP requests: "POST /poll" starts a poll '
+                            'right away, and "GET /status" reports the state of the daemon as JSON')
+        argv = argv[1:]
+    else:
+        parser = argparse.ArgumentParser(epilog='Use "%(prog)s serve --help" for the long-running mode')
+        _add_run_arguments(parser)
+        parser.add_argument('--plan',
+                            action='store_true',
+                            help='Only print the set of packages that would be imported, using cached tag listings '
+                            'where available. Nothing is cloned or imported.')
+        parser.add_argument('--plan-format',
+                            choices=('text', 'json'),
+                            default='text',
+                            help='Output format for --plan (Default: text)')
+        parser.add_argument('--workers',
+                            metavar='<N>',
+                            type=int,
+                            help='Prepare packages in <N> worker processes that share the dds-ports cache. '
+                            '--staging-dir and --staging-budget do not apply in this mode.')
+        parser.add_argument('--resume',
+                            action='store_true',
+                            help='If the previous run for this repository was interrupted, skip the work that it '
+                            'already completed: Mirrors it fetched are not fetched again, and sdists it prepared are '
+                            'imported directly')
+    args = cast(CommandArguments, parser.parse_args(argv))
+    selection = PortSelection(
+        package_globs=args.select,
+        port_files=args.port_file,
+        min_version=args.min_version,
+        max_version=args.max_version,
+        newest=args.newest,
+        shard=args.shard,
+    )
+    if not serving and args.plan:
+        return _print_plan(args, selection)
+    if not serving and args.workers:
+        if args.resume:
+            parser.error('--resume is not supported with --workers')
+        if args.profile:
+            parser.error('--profile is not supported with --workers')
+        i = _run_workers(args, selection)
+        _collect_garbage(args)
+        return i
+
+    config = BuildConfig(args.ports_dir,
+                         args.repo_dir,
+                         selection=selection,
+                         staging_dir=args.staging_dir,
+                         staging_budget=args.staging_budget,
+                         prep_jobs=args.jobs,
+                         full_validate_interval=_full_validate_interval(args),
+                         io_report=args.io_report,
+                         profile=args.profile,
+                         profile_dir=args.profile_dir,
+                         ui='auto',
+                         github_hedge_after=args.github_hedge_after)
+    run = _serve if serving else _run_pipeline
+    i = asyncio.get_event_loop().run_until_complete(run(args, config))
+    _collect_garbage(args)
     return i
 
 
+def _collect_garbage(args: CommandArguments) -> None:
+    if args.cache_max_size is not None:
+        evicted = cache.collect_garbage(args.cache_max_size, min_age=60 * 60)
+        print(f'Evicted {len(evicted)} cache entries, freeing {format_size(sum(e.size for e in evicted))}')
+
+
 def start() -> NoReturn:
     sys.exit(main(sys.argv[1:]))
 
@@ -0,0 +1,117 @@
+"""
+Merging of repositories, e.g. to combine the partial repositories produced by
+sharded runs of dds-ports-mkrepo into a single repository.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+from typing import Iterable, NoReturn, Sequence, cast
+
+from typing_extensions import Literal, Protocol
+
+from . import fs, staging
+from .port import PackageID
+from .repo import RepositoryAccess
+from .util import run_process, wait_all
+
+IfExists = Literal['ignore', 'replace']
+
+
+def _sdist_root(extracted: Path) -> Path:
+    if any(extracted.glob('pkg.json*')):
+        return extracted
+    children = list(extracted.iterdir())
+    if len(children) == 1 and children[0].is_dir():
+        return children[0]
+    return extracted
+
+
+async def _copy_package(into: RepositoryAccess, source: RepositoryAccess, pid: PackageID, if_exists: IfExists,
+                        sem: asyncio.Semaphore) -> None:
+    async with sem:
+        area = staging.current()
+        tmp = await area.create(str(pid))
+        try:
+            await fs.extract_archive(source.package_archive(pid), tmp)
+            print(f'Importing {pid} from [{source.directory}]')
+            await run_process(
+                ['./bpt', 'repo', 'import',
+                 str(into.directory),
+                 str(_sdist_root(tmp)), f'--if-exists={if_exists}'])
+        finally:
+            await area.release(tmp)
+
+
+async def merge_repositories(into: RepositoryAccess,
+                             sources: Iterable[RepositoryAccess],
+                             *,
+                             if_exists: IfExists = 'ignore',
+                             jobs: int = 4) -> list[PackageID]:
+    """
+    Import the packages of each source repository into ``into``. Packages that
+    are present in more than one source are taken from the first source.
+
+    Returns the IDs of the packages that were imported.
+    """
+    existing = set(into.packages)
+    todo: dict[PackageID, RepositoryAccess] = {}
+    for src in sources:
+        for pid in src.packages:
+            if pid in todo or (if_exists == 'ignore' and pid in existing):
+                continue
+            todo[pid] = src
+    sem = asyncio.Semaphore(jobs)
+    await wait_all(_copy_package(into, src, pid, if_exists, sem) for pid, src in todo.items())
+    return sorted(todo)
+
+
+class CommandArguments(Protocol):
+    repo_dir: Path
+    partial: list[Path]
+    if_exists: IfExists
+    jobs: int
+    no_validate: bool
+
+
+async def _main(args: CommandArguments) -> list[PackageID]:
+    into = RepositoryAccess.open(args.repo_dir)
+    sources = [RepositoryAccess.open(p) for p in args.partial]
+    with staging.staging_area():
+        merged = await merge_repositories(into, sources, if_exists=args.if_exists, jobs=args.jobs)
+    if not args.no_validate:
+        await run_process(['./bpt', 'repo', 'validate', str(into.directory)])
+    return merged
+
+
+def main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='dds-ports-merge',
+                                     description='Merge the packages of several repositories into one repository')
+    parser.add_argument('--repo-dir', type=Path, required=True, help='The repository to merge packages into')
+    parser.add_argument('partial', type=Path, nargs='+', help='Repositories to take packages from')
+    parser.add_argument('--if-exists',
+                        choices=('ignore', 'replace'),
+                        default='ignore',
+                        help='What to do with packages that are already in the target repository (Default: ignore)')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of packages to import in parallel (Default: 4)')
+    parser.add_argument('--no-validate', action='store_true', help='Do not validate the merged repository')
+    args = cast(CommandArguments, parser.parse_args(argv))
+    merged = asyncio.run(_main(args))
+    if merged:
+        print('The following packages were merged:')
+        for pid in merged:
+            print(f'  - {pid}')
+    else:
+        print('No packages were merged')
+    return 0
+
+
+def start() -> NoReturn:
+    sys.exit(main(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    start()
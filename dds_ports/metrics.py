@@ -0,0 +1,217 @@
+"""
+Per-run performance metrics of every package, kept for comparison across runs.
+
+While a run is recorded (see :func:`recording`), the pipeline and the code that
+fetches, prepares and imports packages report measurements with :func:`add`.
+Measurements are attributed to the package that the current task works on
+(see :func:`for_package`). When the run finishes, the metrics are saved to a
+SQLite database in the dds-ports cache directory, from which
+``dds-ports-report`` reports the slowest and largest packages, their trends,
+and regressions.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator, NamedTuple, Optional
+
+from . import cache
+from .port import PackageID
+
+if TYPE_CHECKING:
+    import sqlite3
+
+METRICS = {
+    'discovery': 'Seconds from the start of the run until the package was discovered',
+    'fetch': 'Seconds spent cloning/fetching the mirror or downloading the archive of the package',
+    'prep': 'Seconds spent preparing the sdist, apart from fetching',
+    'import': 'Seconds spent importing the sdist into the repository',
+    'sdist-bytes': 'The total size of the files of the prepared sdist',
+    'sdist-files': 'The number of files in the prepared sdist',
+    'downloaded-bytes': 'The number of bytes downloaded to prepare the package',
+}
+"The metrics that are recorded for each package, with their descriptions"
+
+FETCH_STAGES = ('clone-all', 'download')
+"The task stages (see :func:`.history.task_subject`) whose time counts as fetching"
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    repo TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS package_metrics (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    package_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (run_id, package_id, metric)
+);
+CREATE INDEX IF NOT EXISTS package_metrics_by_metric ON package_metrics (metric, package_id, run_id);
+'''
+
+
+class RunInfo(NamedTuple):
+    """A recorded run"""
+    run_id: int
+    repo: str
+    "The directory of the repository that the run built"
+    started_at: float
+    finished_at: float
+
+
+class Sample(NamedTuple):
+    """The value of one metric of one package in one run"""
+    run_id: int
+    package_id: PackageID
+    value: float
+
+
+class MetricsDB:
+    """Access to the database of per-run package metrics"""
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self._db = db
+        self._db.executescript(_SCHEMA)
+
+    @staticmethod
+    def open(path: Optional[Path] = None) -> 'MetricsDB':
+        """Open the metrics database at ``path`` (Default: in the dds-ports cache directory)"""
+        import sqlite3  # pylint: disable=redefined-outer-name
+        if path is None:
+            root = cache.cache_root()
+            root.mkdir(exist_ok=True, parents=True)
+            path = root / 'metrics.db'
+        return MetricsDB(sqlite3.connect(path, timeout=30))
+
+    def close(self) -> None:
+        """Close the database"""
+        self._db.close()
+
+    def save_run(self, repo: Path, started_at: float, metrics: dict[PackageID, dict[str, float]]) -> int:
+        """Save the metrics of a finished run. Returns the ID of the new run."""
+        with self._db:
+            cur = self._db.execute('INSERT INTO runs (repo, started_at, finished_at) VALUES (?, ?, ?)',
+                                   (str(repo.absolute()), started_at, time.time()))
+            run_id = cur.lastrowid
+            assert run_id is not None
+            rows = ((run_id, str(pid), metric, value) for pid, values in metrics.items()
+                    for metric, value in values.items())
+            self._db.executemany('INSERT INTO package_metrics (run_id, package_id, metric, value) VALUES (?, ?, ?, ?)',
+                                 rows)
+        return run_id
+
+    def runs(self, *, limit: Optional[int] = None) -> list[RunInfo]:
+        """Get the most recent runs, newest first"""
+        rows = self._db.execute('SELECT run_id, repo, started_at, finished_at FROM runs ORDER BY run_id DESC LIMIT ?',
+                                (-1 if limit is None else limit, ))
+        return [RunInfo(*row) for row in rows]
+
+    def samples(self, metric: str, *, runs: Optional[Iterable[int]] = None) -> list[Sample]:
+        """Get the samples of the given metric, in order of run, optionally only of the given runs"""
+        query = 'SELECT run_id, package_id, value FROM package_metrics WHERE metric = ?'
+        params: list[object] = [metric]
+        if runs is not None:
+            run_ids = list(runs)
+            query += f' AND run_id IN ({", ".join("?" * len(run_ids))})'
+            params.extend(run_ids)
+        rows = self._db.execute(f'{query} ORDER BY run_id', params)
+        return [Sample(run_id, PackageID.parse(pid), value) for run_id, pid, value in rows]
+
+
+class RunRecorder:
+    """Collects the metrics of the packages of one run"""
+    def __init__(self, repo: Path) -> None:
+        self._repo = repo
+        self._started_at = time.time()
+        self._started = time.monotonic()
+        self._metrics: dict[PackageID, dict[str, float]] = {}
+
+    @property
+    def elapsed(self) -> float:
+        """The number of seconds since the run started"""
+        return time.monotonic() - self._started
+
+    @property
+    def metrics(self) -> dict[PackageID, dict[str, float]]:
+        """The metrics recorded so far, by package"""
+        return self._metrics
+
+    def add(self, pid: PackageID, metric: str, value: float) -> None:
+        """Add ``value`` to a metric of the given package"""
+        assert metric in METRICS, metric
+        values = self._metrics.setdefault(pid, {})
+        values[metric] = values.get(metric, 0) + value
+
+    def save(self, db: MetricsDB) -> int:
+        """Save the recorded metrics as a finished run. Returns the ID of the run."""
+        return db.save_run(self._repo, self._started_at, self._metrics)
+
+
+_RECORDER = contextvars.ContextVar['RunRecorder | None']('_RUN_RECORDER', default=None)
+_PACKAGE = contextvars.ContextVar['PackageID | None']('_METRICS_PACKAGE', default=None)
+
+
+def current() -> RunRecorder | None:
+    """Get the recorder of the current run, if the run is being recorded"""
+    return _RECORDER.get()
+
+
+@contextmanager
+def recording(repo: Path) -> Iterator[RunRecorder]:
+    """
+    Record the metrics of a run that builds the given repository. The metrics
+    are saved if the context exits normally.
+    """
+    rec = RunRecorder(repo)
+    tok = _RECORDER.set(rec)
+    try:
+        yield rec
+    finally:
+        _RECORDER.reset(tok)
+    db = MetricsDB.open()
+    try:
+        rec.save(db)
+    finally:
+        db.close()
+
+
+@contextmanager
+def for_package(pid: PackageID) -> Iterator[None]:
+    """Attribute the measurements that are made within the context to the given package"""
+    tok = _PACKAGE.set(pid)
+    try:
+        yield
+    finally:
+        _PACKAGE.reset(tok)
+
+
+def current_package() -> PackageID | None:
+    """Get the package that measurements within the current context are attributed to"""
+    return _PACKAGE.get()
+
+
+def add(metric: str, value: float, *, pid: Optional[PackageID] = None) -> None:
+    """
+    Add ``value`` to a metric of the given package (Default: the package of the
+    current context). Does nothing if the run is not recorded, or if there is no
+    current package.
+    """
+    rec = _RECORDER.get()
+    pid = pid or _PACKAGE.get()
+    if rec is not None and pid is not None:
+        rec.add(pid, metric, value)
+
+
+def add_stage_time(stage: str, seconds: float) -> None:
+    """Add the duration of a task stage of the current package to the matching metric"""
+    if stage == 'import':
+        add('import', seconds)
+    elif stage in FETCH_STAGES:
+        add('fetch', seconds)
+    else:
+        add('prep', seconds)
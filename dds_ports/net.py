@@ -0,0 +1,87 @@
+"""
+The shared HTTP session of dds-ports.
+
+All network requests (the GitHub API, source archives, and other downloads)
+go through one pooled :class:`aiohttp.ClientSession`, so that connections
+(and TLS sessions) are reused across the many requests of a run. The session
+is created lazily within the running event loop by :func:`session`, and is
+closed when the outermost :func:`session_scope` exits.
+"""
+
+from __future__ import annotations
+
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator
+
+from .util import LoopLocal
+
+if TYPE_CHECKING:
+    import aiohttp
+
+CONNECTION_LIMIT = 64
+"The maximum number of open connections"
+CONNECTION_LIMIT_PER_HOST = 8
+"The maximum number of open connections to a single host"
+DNS_CACHE_TTL = 300
+"Seconds for which DNS resolutions are cached"
+KEEPALIVE_TIMEOUT = 30.0
+"Seconds for which an idle connection is kept open for reuse"
+
+
+class _LoopState:
+    def __init__(self) -> None:
+        self.session: aiohttp.ClientSession | None = None
+        self.scopes = 0
+
+
+_STATE = LoopLocal(_LoopState)
+"The session of each event loop (A session is bound to the loop in which it was created)"
+
+
+def _new_session() -> aiohttp.ClientSession:
+    # aiohttp is slow to import, and most commands never touch the network
+    import aiohttp  # pylint: disable=redefined-outer-name
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+def session() -> aiohttp.ClientSession:
+    """
+    Get the shared HTTP session, creating it if there is none for the running
+    event loop. Must be called within a running event loop.
+    """
+    state = _STATE.get()
+    if state.session is None or state.session.closed:
+        state.session = _new_session()
+    return state.session
+
+
+async def close() -> None:
+    """Close the shared HTTP session of the running event loop, if it is open"""
+    state = _STATE.get()
+    sess, state.session = state.session, None
+    if sess is not None and not sess.closed:
+        await sess.close()
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[None]:
+    """
+    Use the shared HTTP session for the duration of the context. The session is
+    created by the first request within the scope (if any), and is closed when
+    the outermost scope (of the same event loop) exits. Nested and concurrent
+    scopes share the session of the outermost scope.
+    """
+    state = _STATE.get()
+    state.scopes += 1
+    try:
+        yield
+    finally:
+        state.scopes -= 1
+        if state.scopes == 0:
+            await close()
@@ -0,0 +1,347 @@
+"""
+The streaming import pipeline.
+
+Ports are prepared and imported as soon as they are discovered, while other
+port files are still being enumerated. Each port's prep and import stages run
+as small Dagon task graphs of their own, all within a single extension context
+(:func:`extension_context`), so the Dagon UI and the timing extension see every
+stage. Concurrency limits that must hold across ports are enforced here, and by
+the process-wide limits in :mod:`dds_ports.git`. Ports that are waiting for a
+job slot start longest-first (see :mod:`dds_ports.schedule`).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+import traceback
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Callable, NamedTuple, Optional, TypeVar, cast
+
+import dagon.ui
+from dagon import task
+from dagon.core import ll_dag
+from dagon.core.result import Failure, NodeResult, Success
+from dagon.ext.loader import ExtLoader
+from dagon.task import TaskDAG
+from dagon.task.dag import OpaqueTask, TaskExecutor, populate_dag_context
+from dagon.tool.args import get_argparser
+from dagon.util import Opaque
+
+from . import fs, ioacct, journal, metrics, process, profiling, selection, staging
+from .history import History, task_subject
+from .port import Port, PackageID, cost_hint
+from .repo import RepositoryAccess
+from .sdist import DigestStore, content_digest, finalize, known_packages
+from .schedule import CostModel
+from .staging import IMPORT_JOBS, PREP_JOBS
+from .util import PriorityLimiter, wait_all
+from .validate import PackageInfo, read_package_info
+
+T = TypeVar('T')
+
+IMPORT_TIMEOUT: Optional[float] = 30 * 60
+"Seconds after which a ``bpt repo import`` is killed as hung (``None`` waits forever)"
+
+
+class TaskFailed(RuntimeError):
+    """Raised when a task within a single-port task graph fails"""
+
+
+@asynccontextmanager
+async def extension_context(exts: ExtLoader, *, ui: str = 'auto') -> AsyncIterator[None]:
+    """
+    Enter the global context of the Dagon extensions, in which any number of
+    task graphs may be run with :func:`run_task_graph`. Must be entered within
+    the app context of ``exts``.
+
+    Dagon extensions expect one global context per run (e.g. the UI captures
+    stdout for its duration), so the task graphs of all ports share this one.
+
+    :param ui: The Dagon user interface to use (as for ``dagon --interface``).
+        Every UI but ``none`` replaces the stdout of the whole process, so only
+        one such context may be entered at a time.
+    """
+    exts.handle_options(get_argparser(exts).parse_args(['--interface', ui]))
+    tok = _STARTED_TASKS.set(set())
+    try:
+        async with exts.global_context(ll_dag.DAGView(TaskDAG('<dds-ports>').low_level_graph([]))):
+            yield
+    finally:
+        _STARTED_TASKS.reset(tok)
+
+
+_STARTED_TASKS = contextvars.ContextVar['set[str] | None']('_STARTED_TASKS', default=None)
+"The names of the tasks that have started within the current extension context"
+
+
+class _SharedContextExecutor(TaskExecutor[Opaque]):
+    """Executes a task graph within an already-entered extension global context"""
+    def __init__(self, exts: ExtLoader, graph: ll_dag.LowLevelDAG[OpaqueTask]) -> None:
+        super().__init__(graph, self.__exec_task, catch_signals=False, fail_cancels=True)
+        self._exts = exts
+
+    async def __exec_task(self, t: OpaqueTask) -> Opaque:
+        return await t.function()
+
+    async def do_run_task(self, node: OpaqueTask) -> NodeResult[OpaqueTask]:
+        started = _STARTED_TASKS.get()
+        assert started is not None, 'Task graphs must be run within extension_context()'
+        if node.name in started:
+            # Tasks shared between ports (i.e. mirror clones) appear in the
+            # graph of every port that uses them, but their work is single-flight.
+            # The repeats only join the first run, and are not reported again.
+            return await super().do_run_task(node)
+        started.add(node.name)
+        stage = task_subject(node.name).stage
+        async with self._exts.task_context(node):
+            start = time.monotonic()
+            with ioacct.in_stage(stage), profiling.stage(stage):
+                result = await super().do_run_task(node)
+            metrics.add_stage_time(stage, time.monotonic() - start)
+            await self._exts.notify_result(result)
+            return result
+
+
+async def run_task_graph(exts: ExtLoader, name: str, make_target: Callable[[], task.Task[T]]) -> T:
+    """
+    Create a task graph with ``make_target``, and run it to obtain the result
+    of the target task. Must be called within :func:`extension_context`.
+    """
+    dag = TaskDAG(name)
+    with populate_dag_context(dag):
+        target = make_target()
+    exe = _SharedContextExecutor(exts, dag.low_level_graph([target.name]))
+    results = await exe.run_all()
+    res = results.get(target)
+    if res is not None and isinstance(res.result, Success):
+        return cast(T, res.result.value)
+    for r in results.values():
+        if isinstance(r.result, Failure):
+            raise TaskFailed(f'Task "{r.task.name}" failed') from r.result.exception
+    raise TaskFailed(f'Task "{target.name}" was cancelled')
+
+
+async def prepare_port(port: Port, exts: ExtLoader) -> Path:
+    """
+    Run the prep task of a single port, and return the path to the prepared
+    sdist. The other staging directories that the prep created (all of them,
+    if it fails) are released.
+    """
+    area = staging.current()
+    with staging.collecting_created() as created:
+        try:
+            sdist = await run_task_graph(exts, f'<prep {port.package_id}>', port.make_prep_task)
+        except Exception:
+            # Not on cancellation: An interrupted run keeps its staging directories
+            await wait_all(area.release(path) for path in created)
+            raise
+    await wait_all(area.release(path) for path in created if path != sdist)
+    return sdist
+
+
+async def import_prepared(repo: RepositoryAccess, pid: PackageID, sdist: Path) -> PackageInfo:
+    """
+    Import a prepared sdist into the repository, and release its staging
+    directory (unless the import is cancelled, as a resumed run imports it).
+    Returns the dependency information of the imported package.
+    """
+    area = staging.current()
+    await area.settle(sdist)
+    try:
+        info = read_package_info(pid, sdist)
+        dagon.ui.status(f'Importing {pid}')
+        await process.run(['./bpt', 'repo', 'import', repo.directory, sdist, '--if-exists=replace'],
+                          timeout=IMPORT_TIMEOUT,
+                          on_line=dagon.ui.status)
+    except Exception:
+        await area.release(sdist)
+        raise
+    await area.release(sdist)
+    dagon.ui.print(f'New package imported: {pid}')
+    return info
+
+
+class PipelineResult(NamedTuple):
+    """The outcome of a pipeline run"""
+    imported: dict[PackageID, PackageInfo]
+    "The packages that were imported, with their dependency information"
+    failed: dict[PackageID, str]
+    "The packages that could not be prepared or imported, with the error"
+    up_to_date: int
+    "The number of discovered packages that were already in the repository"
+    unchanged: set[PackageID]
+    "The packages that were not imported because their content is unchanged from the imported revision"
+    discovery_errors: dict[Path, str]
+    "The port files that could not be loaded or enumerated, with the error"
+    io: Optional[ioacct.IOAccount] = None
+    "The I/O of the run, if it was accounted (see :mod:`dds_ports.ioacct`)"
+    profile: Optional[profiling.Profiler] = None
+    "The profile of the run, if it was profiled (see :mod:`dds_ports.profiling`)"
+
+
+class _Pipeline:
+    def __init__(self, repo: RepositoryAccess, exts: ExtLoader, prep_jobs: int, import_jobs: int) -> None:
+        self._repo = repo
+        self._exts = exts
+        # Ports that are waiting for a slot start longest-first
+        self._prep_slots = PriorityLimiter(prep_jobs)
+        self._import_slots = PriorityLimiter(import_jobs)
+        self._costs = CostModel(History.open())
+        self._digests = DigestStore.open(repo.directory)
+        self.result = PipelineResult({}, {}, 0, set(), {})
+
+    def close(self) -> None:
+        self._costs.close()
+
+    async def import_sdist(self, pid: PackageID, sdist: Path, digest: str) -> None:
+        if self._digests.is_unchanged(pid, digest, self._repo.packages):
+            await staging.current().release(sdist)
+            self._digests.record_equivalent(pid)
+            self._digests.save()
+            self.result.unchanged.add(pid)
+            journal.current().imported(pid)
+            dagon.ui.print(f'Package content is unchanged, not importing: {pid}')
+            return
+        async with self._import_slots.slot(self._costs.priority(pid, stage='import')):
+            info = await run_task_graph(
+                self._exts, f'<import {pid}>',
+                lambda: task.fn_task(f'{pid}@import', lambda: import_prepared(self._repo, pid, sdist)))
+        self.result.imported[pid] = info
+        self._digests.record_import(pid, digest)
+        self._digests.save()
+        journal.current().imported(pid)
+
+    async def run_port(self, port: Port) -> None:
+        pid = port.package_id
+        sdist: Optional[Path] = None
+        try:
+            with metrics.for_package(pid), profiling.stage('pipeline'):
+                async with self._prep_slots.slot(self._costs.priority(pid, hint=cost_hint(port))):
+                    sdist = await prepare_port(port, self._exts)
+                with ioacct.in_stage('finalize'), profiling.stage('finalize'):
+                    digest = await finalize(sdist)
+                    if metrics.current() is not None:
+                        stats = await fs.tree_stats(sdist)
+                        metrics.add('sdist-bytes', stats.size)
+                        metrics.add('sdist-files', stats.files)
+                journal.current().prepared(pid, sdist, digest)
+                await self.import_sdist(pid, sdist, digest)
+        except Exception:  # pylint: disable=broad-except
+            self.result.failed[pid] = traceback.format_exc()
+            if sdist is not None:
+                # Does nothing if the import already released it
+                await staging.current().release(sdist)
+
+    async def import_resumed(self, pid: PackageID, prev: journal.PreparedSdist) -> None:
+        try:
+            dagon.ui.print(f'Resuming with the sdist of {pid} prepared by the previous run')
+            with metrics.for_package(pid), profiling.stage('pipeline'):
+                await self.import_sdist(pid, prev.sdist, prev.digest)
+        except Exception:  # pylint: disable=broad-except
+            self.result.failed[pid] = traceback.format_exc()
+        # The sdist is not part of this run's staging area. (Kept if this run is
+        # interrupted too, for the next resumed run.)
+        await fs.remove_directory(prev.sdist, absent_ok=True)
+
+
+async def _resumable_sdists(resumed: journal.ResumeState,
+                            existing: set[PackageID]) -> dict[PackageID, journal.PreparedSdist]:
+    """The intact sdists of the interrupted run, of packages that are selected and not yet imported"""
+    async def check(prev: journal.PreparedSdist) -> bool:
+        return prev.sdist.is_dir() and await content_digest(prev.sdist) == prev.digest
+
+    sel = selection.current()
+    items = [(pid, prev) for pid, prev in resumed.prepared.items() if pid not in existing and sel.wants(pid)]
+    intact = await wait_all(check(prev) for _, prev in items)
+    return {pid: prev for (pid, prev), ok in zip(items, intact) if ok}
+
+
+async def run_pipeline(repo: RepositoryAccess,
+                       ports: AsyncIterable[Port],
+                       exts: ExtLoader,
+                       *,
+                       prep_jobs: int = PREP_JOBS,
+                       import_jobs: int = IMPORT_JOBS) -> PipelineResult:
+    """
+    Prepare and import each port from ``ports`` as it arrives. Ports for
+    packages that are already in the repository are skipped, as are repeated
+    ports for the same package. A failure to prepare or import one package
+    does not stop the others.
+
+    When resuming an interrupted run (see :mod:`dds_ports.journal`), the
+    packages that it imported are skipped, and the sdists that it prepared are
+    imported directly once their ports are discovered (so only for the ports
+    that are selected in this run). The other sdists that it prepared are
+    removed.
+
+    Prepared sdists whose content digest matches that of the revision of the
+    same version that is already in the repository are not imported (see
+    :mod:`dds_ports.sdist`).
+
+    Must be called within :func:`extension_context`.
+    """
+    pipe = _Pipeline(repo, exts, prep_jobs, import_jobs)
+    try:
+        return await _run(pipe, repo, ports)
+    finally:
+        pipe.close()
+
+
+async def _run(pipe: _Pipeline, repo: RepositoryAccess, ports: AsyncIterable[Port]) -> PipelineResult:
+    resumed = journal.current().resumed
+    existing = known_packages(repo) | resumed.imported
+    seen: set[PackageID] = set()
+    running: list[asyncio.Future[None]] = []
+    up_to_date = 0
+    rec = metrics.current()
+    # The sdists of the interrupted run are only imported for packages that
+    # this run discovers, which applies the whole port selection to them
+    resumable = await _resumable_sdists(resumed, existing)
+    try:
+        with profiling.stage('discovery'):
+            async for p in ports:
+                pid = p.package_id
+                if pid in seen:
+                    continue
+                seen.add(pid)
+                if pid in existing:
+                    up_to_date += 1
+                    continue
+                prev = resumable.pop(pid, None)
+                if prev is not None:
+                    running.append(asyncio.ensure_future(pipe.import_resumed(pid, prev)))
+                    continue
+                if rec is not None:
+                    rec.add(pid, 'discovery', rec.elapsed)
+                running.append(asyncio.ensure_future(pipe.run_port(p)))
+    except BaseException:
+        # The staging area and the pipeline are torn down once this returns
+        for fut in running:
+            fut.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        raise
+    await asyncio.gather(*running)
+    # Remove the sdists of the interrupted run that were not imported (e.g. not selected)
+    await wait_all(fs.remove_directory(prev.sdist, absent_ok=True) for prev in resumed.prepared.values())
+    return pipe.result._replace(up_to_date=up_to_date)
+
+
+async def import_sdist(repo: RepositoryAccess, exts: ExtLoader, pid: PackageID, sdist: Path,
+                       digest: str) -> PipelineResult:
+    """
+    Import a single sdist that was prepared and finalized (see
+    :func:`.sdist.finalize`), as :func:`run_pipeline` does: It is not imported
+    if its content is unchanged from the revision of the same version that is
+    already in the repository. Raises if the import fails.
+
+    Must be called within :func:`extension_context`.
+    """
+    pipe = _Pipeline(repo, exts, PREP_JOBS, IMPORT_JOBS)
+    try:
+        await pipe.import_sdist(pid, sdist, digest)
+    finally:
+        pipe.close()
+    return pipe.result
@@ -0,0 +1,86 @@
+"""
+Import planning: which packages a run would import, and roughly how long it
+would take.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Iterable, NamedTuple, Sequence
+
+from .history import History
+from .port import Port, PackageID, cost_hint
+from .repo import RepositoryAccess
+from .sdist import known_packages
+from .util import format_duration
+
+
+class PlanItem(NamedTuple):
+    """A single package that a run would import"""
+    package_id: PackageID
+    estimated_seconds: float | None
+    "Estimated time to prepare and import the package, if there is any history for it"
+
+
+class ImportPlan(NamedTuple):
+    """The set of packages that a run would import"""
+    items: Sequence[PlanItem]
+    up_to_date: int
+    "The number of discovered packages that are already in the repository"
+
+    @property
+    def estimated_seconds(self) -> float:
+        """
+        The estimated total (serial) time of all items. Items without history
+        are assumed to take the median time of the items that have history.
+        """
+        import statistics
+        known = [i.estimated_seconds for i in self.items if i.estimated_seconds is not None]
+        fallback = statistics.median(known) if known else 0.0
+        return sum(fallback if i.estimated_seconds is None else i.estimated_seconds for i in self.items)
+
+    def to_json(self) -> str:
+        """Render the plan as a JSON document"""
+        items = [{
+            'id': str(i.package_id),
+            'name': i.package_id.name,
+            'version': str(i.package_id.version),
+            'revision': i.package_id.revision,
+            'estimated-seconds': i.estimated_seconds,
+        } for i in self.items]
+        doc = {'items': items, 'up-to-date': self.up_to_date, 'estimated-seconds': self.estimated_seconds}
+        return json.dumps(doc, indent=2)
+
+    def to_text(self) -> str:
+        """Render the plan as human-readable text"""
+        if not self.items:
+            return f'Nothing to do: all {self.up_to_date} discovered packages are already in the repository'
+        lines = [f'The following {len(self.items)} packages would be imported:']
+        for item in self.items:
+            est = '(no history)' if item.estimated_seconds is None else f'~{format_duration(item.estimated_seconds)}'
+            lines.append(f'  - {item.package_id}  {est}')
+        lines.append(f'{self.up_to_date} discovered packages are already in the repository')
+        lines.append(f'Estimated total (serial) time: {format_duration(self.estimated_seconds)}')
+        return '\n'.join(lines)
+
+
+def compute_plan(ports: Iterable[Port], repo: RepositoryAccess, history: History) -> ImportPlan:
+    """
+    Compute the import plan for the given ports against the given repository.
+    This does not create any tasks, nor touch the network or the cache.
+    """
+    existing = known_packages(repo)
+    items: list[PlanItem] = []
+    up_to_date = 0
+    seen: set[PackageID] = set()
+    for p in ports:
+        pid = p.package_id
+        if pid in seen:
+            continue
+        seen.add(pid)
+        if pid in existing:
+            up_to_date += 1
+            continue
+        items.append(PlanItem(pid, history.estimate(pid) or cost_hint(p)))
+    items.sort(key=lambda i: i.package_id)
+    return ImportPlan(items, up_to_date)
@@ -1,10 +1,11 @@
-from typing import Iterable, NamedTuple
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, NamedTuple, Optional
 from typing_extensions import Protocol
 from pathlib import Path
 
 from semver import VersionInfo
 
-from dagon import task
+if TYPE_CHECKING:
+    from dagon import task
 
 
 class PackageID(NamedTuple):
@@ -27,8 +28,18 @@ class Port(Protocol):
     def package_id(self) -> PackageID:
         ...
 
-    def make_prep_task(self) -> task.Task[Path]:
+    def make_prep_task(self) -> 'task.Task[Path]':
         ...
 
 
+def cost_hint(port: Port) -> Optional[float]:
+    """
+    The rough number of seconds that the given port takes to prepare and
+    import, as declared by its optional ``cost_hint`` attribute. Used to
+    schedule the port until there is history for its package.
+    """
+    return getattr(port, 'cost_hint', None)
+
+
 PortIter = Iterable[Port]
+PortStream = AsyncIterator[Port]
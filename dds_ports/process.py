@@ -0,0 +1,150 @@
+"""
+Running child processes (Git, bpt) with bounded memory and time.
+
+:func:`run` streams the output of a process as it is produced, rather than
+collecting all of it: only the last lines are kept (see :class:`OutputTail`),
+to report if the process fails, and each line may be passed on (e.g. to the
+Dagon UI) as it arrives. A process that runs for too long, or whose caller is
+cancelled, is killed along with the processes that it started (e.g. the
+transport helpers of ``git clone``).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import atexit
+import os
+import re
+import signal
+import subprocess
+from collections import deque
+from pathlib import Path
+from typing import Callable, Optional, Sequence, Union
+
+MAX_OUTPUT_LINES = 200
+"The number of last lines of output that are kept for error reporting"
+MAX_OUTPUT_BYTES = 64 * 1024
+"The size of the last lines of output that are kept for error reporting"
+MAX_LINE_LENGTH = 4096
+"Longer lines of output are split"
+
+_READ_SIZE = 64 * 1024
+_LINE_BREAK = re.compile(rb'\r\n|[\r\n]')
+
+_RUNNING: set[int] = set()
+"The process groups of the child processes that are running"
+
+
+class OutputTail:
+    """The last lines of the output of a process, bounded in number and size"""
+    def __init__(self, max_lines: int = MAX_OUTPUT_LINES, max_bytes: int = MAX_OUTPUT_BYTES) -> None:
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._lines: deque[bytes] = deque()
+        self._size = 0
+        self.dropped = 0
+        "The number of earlier lines that are no longer kept"
+
+    def add(self, line: bytes) -> None:
+        """Keep a line of output, dropping the earliest lines beyond the limits"""
+        self._lines.append(line)
+        self._size += len(line)
+        while len(self._lines) > self._max_lines or self._size > self._max_bytes:
+            self._size -= len(self._lines.popleft())
+            self.dropped += 1
+
+    def to_bytes(self) -> bytes:
+        """The kept lines, preceded by a note on the dropped ones"""
+        head = f'[... {self.dropped} earlier lines omitted ...]\n'.encode() if self.dropped else b''
+        return head + b''.join(line + b'\n' for line in self._lines)
+
+
+async def _pump(stream: asyncio.StreamReader, tail: OutputTail, on_line: Optional[Callable[[str], None]]) -> None:
+    def emit(line: bytes) -> None:
+        if not line:
+            return
+        tail.add(line)
+        if on_line is not None:
+            on_line(line.decode(errors='replace'))
+
+    pending = b''
+    while True:
+        chunk = await stream.read(_READ_SIZE)
+        if not chunk:
+            break
+        # Progress output (e.g. of Git) rewrites its line with carriage returns
+        *lines, pending = _LINE_BREAK.split(pending + chunk)
+        for line in lines:
+            emit(line)
+        while len(pending) > MAX_LINE_LENGTH:
+            emit(pending[:MAX_LINE_LENGTH])
+            pending = pending[MAX_LINE_LENGTH:]
+    emit(pending)
+
+
+def _kill_group(pid: int) -> None:
+    try:
+        if os.name == 'posix':
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+@atexit.register
+def _kill_running() -> None:
+    # E.g. after a KeyboardInterrupt escaped the event loop. Children are in
+    # process groups of their own, so the interrupt did not reach them.
+    for pid in list(_RUNNING):
+        _kill_group(pid)
+
+
+async def run(command: Sequence[Union[str, Path]],
+              *,
+              cwd: Optional[Path] = None,
+              timeout: Optional[float] = None,
+              on_line: Optional[Callable[[str], None]] = None) -> None:
+    """
+    Run a process to completion, with its stdout and stderr combined.
+
+    :param timeout: Kill the process if it has not exited after this many
+        seconds, and raise :class:`subprocess.TimeoutExpired`.
+    :param on_line: Called with each line of output as it arrives.
+    :raise subprocess.CalledProcessError: If the process exits with an error.
+        The exception and the printed error report carry the last lines of
+        output (see :class:`OutputTail`).
+    """
+    argv = [str(c) for c in command]
+    proc = await asyncio.create_subprocess_exec(*argv,
+                                                cwd=cwd,
+                                                stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT,
+                                                start_new_session=os.name == 'posix')
+    _RUNNING.add(proc.pid)
+    tail = OutputTail()
+
+    async def communicate() -> int:
+        assert proc.stdout
+        await _pump(proc.stdout, tail, on_line)
+        return await proc.wait()
+
+    try:
+        retc = await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        _kill_group(proc.pid)
+        await proc.wait()
+        output = tail.to_bytes()
+        print(f'Subprocess {argv} timed out after {timeout}s:\n{output.decode(errors="replace")}')
+        raise subprocess.TimeoutExpired(argv, timeout or 0, output=output) from None
+    except BaseException:
+        # Cancelled: The process is reaped by the child watcher of the loop
+        _kill_group(proc.pid)
+        raise
+    finally:
+        _RUNNING.discard(proc.pid)
+    if retc != 0:
+        output = tail.to_bytes()
+        print(f'Subprocess {argv} failed:\n{output.decode(errors="replace")}')
+        raise subprocess.CalledProcessError(retc, argv, output=output)
@@ -0,0 +1,301 @@
+"""
+Built-in profiling of a run, per stage and package.
+
+While a run is profiled (see :func:`profiling`), a sampler thread periodically
+captures the Python stack of every thread that works for the run: the thread of
+the event loop, and the filesystem threads (see :func:`.fs.run_fs_op`). Each
+sample is attributed to the stage (see :func:`stage`) and package (see
+:func:`.metrics.for_package`) that the sampled asyncio task or thread is
+working on. Discovery, planning, and every prep and import task are stages.
+
+Deterministic profilers (``cProfile``) cannot tell the tasks that interleave
+on the event loop apart, so samples are weighted instead:
+
+- ``cpu``: by the CPU time that the sampled thread used since the previous
+  sample, in microseconds. Threads that wait (e.g. for the network or a child
+  process) are not counted, and neither are the child processes themselves.
+- ``alloc``: by the growth of the memory traced by :mod:`tracemalloc` since the
+  previous sample, in bytes, split between the threads that were running.
+
+The profile is written as stacks in the "collapsed" format of ``flamegraph.pl``
+(and speedscope, inferno, ...): one file per stage, and a merged file whose
+stacks start with the stage and package.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Any, Callable, Iterator, NamedTuple, Optional, TypeVar
+
+from typing_extensions import Literal
+
+from . import metrics
+from .util import format_size
+
+Mode = Literal['cpu', 'alloc']
+MODES: tuple[Mode, ...] = ('cpu', 'alloc')
+
+INTERVAL = 0.005
+"Seconds between samples"
+
+UNATTRIBUTED = 'other'
+"The stage of work on the event loop that is not done within a stage"
+
+T = TypeVar('T')
+
+
+class Label(NamedTuple):
+    """What a sample is attributed to"""
+    stage: str
+    package: Optional[str]
+
+
+_LABEL = contextvars.ContextVar['Label | None']('_PROFILE_LABEL', default=None)
+
+
+def _frame_name(code: CodeType) -> str:
+    name = getattr(code, 'co_qualname', code.co_name)
+    path = Path(code.co_filename)
+    # Frame names must not contain the separators of the collapsed format
+    return re.sub(r'[; ]', '_', f'{name}({path.parent.name}/{path.name}:{code.co_firstlineno})')
+
+
+class Profiler:
+    """Samples the stacks of the threads and tasks of a run"""
+    def __init__(self, mode: Mode) -> None:
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._samples: Counter[tuple[Label, tuple[str, ...]]] = Counter()
+        self._task_labels: weakref.WeakKeyDictionary[asyncio.Task[Any], Label] = weakref.WeakKeyDictionary()
+        self._thread_labels: dict[int, Label] = {}
+        self._loops: dict[asyncio.AbstractEventLoop, int] = {}
+        self._cpu_clocks: dict[int, float] = {}
+        self._traced = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='dds-ports-profiler', daemon=True)
+
+    @property
+    def samples(self) -> Counter[tuple[Label, tuple[str, ...]]]:
+        """The weights of the sampled stacks (outermost frame first), by label"""
+        with self._lock:
+            return Counter(self._samples)
+
+    def start(self) -> None:
+        if self.mode == 'alloc':
+            import tracemalloc
+            tracemalloc.start()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        for loop in self._loops:
+            loop.set_task_factory(None)
+        if self.mode == 'alloc':
+            import tracemalloc
+            tracemalloc.stop()
+
+    def watch_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Sample the tasks of the given (running) event loop. New tasks start in
+        the stage of the task that created them.
+        """
+        if loop in self._loops:
+            return
+        # Installing a task factory would replace one that is already there
+        assert loop.get_task_factory() is None, 'Profiling does not support custom task factories'
+
+        def factory(loop: asyncio.AbstractEventLoop, coro: Any, **kwargs: Any) -> asyncio.Task[Any]:
+            t = asyncio.Task(coro, loop=loop, **kwargs)
+            ctx: contextvars.Context = kwargs.get('context') or contextvars.copy_context()
+            label = ctx.get(_LABEL)
+            if label is not None:
+                self._task_labels[t] = label
+            return t
+
+        loop.set_task_factory(factory)
+        self._loops[loop] = threading.get_ident()
+
+    def set_label(self, label: Optional[Label]) -> None:
+        """Attribute the current task (or thread, outside of an event loop) to ``label``"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            key = threading.get_ident()
+            if label is None:
+                self._thread_labels.pop(key, None)
+            else:
+                self._thread_labels[key] = label
+            return
+        self.watch_loop(loop)
+        t = asyncio.current_task()
+        if t is None:
+            return
+        if label is None:
+            self._task_labels.pop(t, None)
+        else:
+            self._task_labels[t] = label
+
+    def _run(self) -> None:
+        while not self._stop.wait(INTERVAL):
+            self._sample()
+
+    def _label_of(self, ident: int) -> Optional[Label]:
+        for loop, loop_ident in list(self._loops.items()):
+            if loop_ident == ident:
+                # Callbacks that run outside of tasks (e.g. the protocols of
+                # connections and child processes) are unattributed
+                t = asyncio.tasks._current_tasks.get(loop)  # pylint: disable=protected-access
+                return Label(UNATTRIBUTED, None) if t is None else self._task_labels.get(t, Label(UNATTRIBUTED, None))
+        return self._thread_labels.get(ident)
+
+    def _cpu_delta(self, ident: int) -> float:
+        try:
+            now = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            # No per-thread CPU clocks here: count the wall time
+            return INTERVAL
+        prev = self._cpu_clocks.get(ident, now)
+        self._cpu_clocks[ident] = now
+        return now - prev
+
+    def _sample(self) -> None:
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        running: list[tuple[Label, tuple[str, ...], float]] = []
+        for ident, frame in frames.items():
+            # The CPU clocks of all threads are read, so that a pool thread is
+            # only charged for the time since it started working for the run
+            cpu = self._cpu_delta(ident)
+            label = self._label_of(ident)
+            if label is not None and cpu > 0:
+                running.append((label, _stack(frame), cpu))
+        if self.mode == 'cpu':
+            weights = [int(cpu * 1_000_000) for _, _, cpu in running]
+        else:
+            import tracemalloc
+            traced, _ = tracemalloc.get_traced_memory()
+            grown, self._traced = max(0, traced - self._traced), traced
+            weights = [grown // len(running)] * len(running) if running else []
+        with self._lock:
+            for (label, stack, _), weight in zip(running, weights):
+                if weight:
+                    self._samples[label, stack] += weight
+
+    def write(self, out_dir: Path) -> None:
+        """
+        Write the profile to ``out_dir``: ``<stage>.collapsed`` for each stage,
+        whose stacks start with the package, and ``profile.collapsed``, whose
+        stacks start with the stage and the package.
+        """
+        out_dir.mkdir(exist_ok=True, parents=True)
+        for old in out_dir.glob('*.collapsed'):
+            old.unlink()
+        by_stage: dict[str, list[str]] = {}
+        merged: list[str] = []
+        for (label, stack), weight in sorted(self.samples.items(), key=lambda kv: (*map(str, kv[0][0]), kv[0][1])):
+            frames = (label.package, *stack) if label.package else stack
+            line = f'{";".join(frames)} {weight}\n'
+            by_stage.setdefault(label.stage, []).append(line)
+            merged.append(f'{label.stage};{line}')
+        for stage_name, lines in by_stage.items():
+            filename = re.sub(r'[^\w.-]', '_', stage_name) + '.collapsed'
+            (out_dir / filename).write_text(''.join(lines))
+        (out_dir / 'profile.collapsed').write_text(''.join(merged))
+
+    def summary(self) -> str:
+        """A one-line summary of the weight of each stage, for the run summary"""
+        totals: Counter[str] = Counter()
+        for (label, _), weight in self.samples.items():
+            totals[label.stage] += weight
+        if self.mode == 'cpu':
+            return ', '.join(f'{name}: {weight / 1_000_000:.3f}s CPU' for name, weight in totals.most_common())
+        return ', '.join(f'{name}: {format_size(weight)} allocated' for name, weight in totals.most_common())
+
+
+def call_labelled(op: Callable[[], T]) -> T:
+    """
+    Call ``op`` in a thread of a thread pool, attributed to the stage and
+    package of the context it is called in
+    """
+    prof = _PROFILER
+    label = _LABEL.get()
+    if prof is None or label is None:
+        return op()
+    prof.set_label(label)
+    try:
+        return op()
+    finally:
+        prof.set_label(None)
+
+
+_BOUNDARIES = frozenset([
+    asyncio.events.Handle._run.__code__,  # pylint: disable=protected-access
+    call_labelled.__code__,
+])
+"The frames below which the stacks of tasks and filesystem operations start"
+
+
+def _stack(frame: Optional[FrameType]) -> tuple[str, ...]:
+    names: list[str] = []
+    while frame is not None and frame.f_code not in _BOUNDARIES:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+_PROFILER: Optional[Profiler] = None
+"The profiler of the run that is being profiled. Only one run in a process may be profiled at a time."
+
+
+@contextmanager
+def profiling(mode: Mode, out_dir: Path) -> Iterator[Profiler]:
+    """Profile the run within the context, and write the profile to ``out_dir`` (see :meth:`Profiler.write`)"""
+    global _PROFILER  # pylint: disable=global-statement
+    if _PROFILER is not None:
+        raise RuntimeError('Another run is already being profiled')
+    prof = Profiler(mode)
+    _PROFILER = prof
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        prof.watch_loop(loop)
+    prof.start()
+    try:
+        yield prof
+    finally:
+        prof.stop()
+        _PROFILER = None
+        prof.write(out_dir)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Attribute the work within the context to the given stage, and to the
+    package of the current context. Does nothing if no run is profiled.
+    """
+    prof = _PROFILER
+    if prof is None:
+        yield
+        return
+    pid = metrics.current_package()
+    label = Label(name, None if pid is None else str(pid))
+    tok = _LABEL.set(label)
+    prof.set_label(label)
+    try:
+        yield
+    finally:
+        _LABEL.reset(tok)
+        prof.set_label(_LABEL.get())
@@ -0,0 +1,100 @@
+"""
+Rules for pruning files from upstream trees before they become sdists.
+
+Upstream repositories contain much that is not part of a package: CI
+configuration, documentation, tests, examples, and benchmarks. Git ports drop
+these while the tree is checked out (see :mod:`dds_ports.blobs`), before any
+transform runs, so they never reach ``bpt repo import``.
+
+Patterns are matched with :func:`fnmatch.fnmatchcase` against the POSIX-style
+path of each file relative to the root of the tree. (A ``*`` also matches
+``/``.) A pattern ending with ``/`` names a directory, and matches every file
+within a directory whose relative path matches the rest of the pattern.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import os
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from . import fs
+
+
+def _matches(pattern: str, relpath: str) -> bool:
+    if not pattern.endswith('/'):
+        return fnmatch.fnmatchcase(relpath, pattern)
+    dir_pattern = pattern[:-1]
+    parts = relpath.split('/')[:-1]
+    return any(fnmatch.fnmatchcase('/'.join(parts[:n]), dir_pattern) for n in range(1, len(parts) + 1))
+
+
+class PruneRules(NamedTuple):
+    """Which files of an upstream tree are left out of its sdist"""
+    exclude: tuple[str, ...] = ()
+    "Patterns of files to leave out"
+    keep: tuple[str, ...] = ()
+    "Patterns of files to keep, even if they match an ``exclude`` pattern"
+
+    def excludes(self, relpath: str) -> bool:
+        """Whether the file at the given relative path is left out"""
+        return any(_matches(p, relpath) for p in self.exclude) and not any(_matches(p, relpath) for p in self.keep)
+
+    def extended(self, *, exclude: Iterable[str] = (), keep: Iterable[str] = ()) -> PruneRules:
+        """Create new rules with additional ``exclude`` and ``keep`` patterns"""
+        return PruneRules((*self.exclude, *exclude), (*self.keep, *keep))
+
+
+NO_PRUNE = PruneRules()
+"Rules that keep the whole upstream tree"
+
+DEFAULT_RULES = PruneRules(exclude=(
+    # Continuous integration and hosting configuration
+    '.github/',
+    '.gitlab/',
+    '.circleci/',
+    '.azure-pipelines/',
+    '.ci/',
+    '.travis.yml',
+    'appveyor.yml',
+    '.appveyor.yml',
+    'azure-pipelines.yml',
+    '.gitlab-ci.yml',
+    '.cirrus.yml',
+    'codecov.yml',
+    '.codecov.yml',
+    # Top-level documentation, tests, examples, and benchmarks
+    'doc/',
+    'docs/',
+    'example/',
+    'examples/',
+    'test/',
+    'tests/',
+    'bench/',
+    'benchmark/',
+    'benchmarks/',
+))
+"The rules used by ports that do not give their own"
+
+
+def prune_tree_sync(dirpath: Path, rules: PruneRules) -> None:
+    """Synchronous version of :func:`prune_tree`"""
+    emptied: set[Path] = set()
+    for parent, dirs, files in os.walk(dirpath):
+        dirs[:] = [d for d in dirs if d != '.git']
+        for name in files:
+            fpath = Path(parent, name)
+            if rules.excludes(fpath.relative_to(dirpath).as_posix()):
+                fpath.unlink()
+                emptied.add(fpath.parent)
+    # Remove the directories that no longer contain anything
+    for dpath in sorted(emptied, key=lambda p: len(p.parts), reverse=True):
+        while dpath != dirpath and dpath.is_dir() and not any(dpath.iterdir()):
+            dpath.rmdir()
+            dpath = dpath.parent
+
+
+async def prune_tree(dirpath: Path, rules: PruneRules) -> None:
+    """Delete the files within the given directory that are excluded by ``rules``"""
+    await fs.run_fs_op(lambda: prune_tree_sync(dirpath, rules))
@@ -1,9 +1,10 @@
 import asyncio
-from typing import Iterable
+from typing import Iterable, Optional
 from pathlib import Path
 import subprocess
 
 from .port import PackageID
+from .util import run_process
 
 
 class RepositoryAccess:
@@ -17,6 +18,10 @@ class RepositoryAccess:
         """Packages in the repository"""
         return self._pkgs
 
+    def add_packages(self, pids: Iterable[PackageID]) -> None:
+        """Record packages that were imported into the repository since it was opened"""
+        self._pkgs.update(pids)
+
     @property
     def database_path(self) -> Path:
         return self._dirpath / 'repo.db'
@@ -26,7 +31,28 @@ class RepositoryAccess:
         """Directory root of the repository"""
         return self._dirpath
 
+    def package_archive(self, pid: PackageID) -> Path:
+        """Find the sdist archive of the given package within the repository directory"""
+        pkg_dir = self._dirpath / 'pkg' / pid.name / f'{pid.version}~{pid.revision}'
+        cands = [pkg_dir / 'pkg.tgz', *sorted(pkg_dir.glob('*.tgz')), *sorted(pkg_dir.glob('*.tar.gz'))]
+        for cand in cands:
+            if cand.is_file():
+                return cand
+        raise RuntimeError(f'No package archive for {pid} in repository [{self._dirpath}] (Looked in [{pkg_dir}])')
+
     @staticmethod
     def open(dirpath: Path) -> 'RepositoryAccess':
         lines = subprocess.check_output(['./bpt', 'repo', 'ls', str(dirpath)]).strip().splitlines()
         return RepositoryAccess(dirpath, (PackageID.parse(l.decode()) for l in lines))
+
+    async def import_sdist(self, sdist: Path, *, if_exists: str = 'replace', timeout: Optional[float] = None) -> None:
+        """
+        Import the sdist in the given directory into the repository. The import
+        is killed if it has not finished after ``timeout`` seconds.
+        """
+        command = ['./bpt', 'repo', 'import', str(self._dirpath), str(sdist), f'--if-exists={if_exists}']
+        await run_process(command, timeout=timeout)
+
+    async def validate(self) -> None:
+        """Run a full validation of the repository"""
+        await run_process(['./bpt', 'repo', 'validate', str(self._dirpath)])
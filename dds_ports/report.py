@@ -0,0 +1,226 @@
+"""
+Command-line tool that reports on the per-package metrics of past runs (see
+:mod:`dds_ports.metrics`): the slowest or largest packages, how a package has
+changed over time, and regressions in the latest run.
+
+A package version is normally only prepared once per repository, so trends and
+regressions compare the versions of a package *name* across runs: a new version
+of a package that takes much longer than the versions before it is reported.
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import fnmatch
+import json
+import sys
+from typing import Iterable, NamedTuple, NoReturn, Optional, Sequence, cast
+
+from typing_extensions import Protocol
+
+from .metrics import METRICS, MetricsDB, Sample
+from .util import format_duration, format_size
+
+TOTAL = 'total'
+"Pseudo-metric: the sum of the fetch, prep and import times of a package"
+
+_TIME_METRICS = ('discovery', 'fetch', 'prep', 'import', TOTAL)
+_BYTE_METRICS = ('sdist-bytes', 'downloaded-bytes')
+
+
+class CommandArguments(Protocol):
+    command: str
+    metric: str
+    top: int
+    run: Optional[int]
+    packages: list[str]
+    runs: int
+    threshold: float
+    json: bool
+
+
+class Regression(NamedTuple):
+    """A package whose latest value of a metric is well above that of the previous runs"""
+    sample: Sample
+    baseline: float
+    "The mean value of the metric for the same package name in the previous runs"
+
+    @property
+    def ratio(self) -> float:
+        """The latest value relative to the baseline"""
+        return self.sample.value / self.baseline if self.baseline else float('inf')
+
+
+def _format(metric: str, value: float) -> str:
+    if metric in _TIME_METRICS:
+        return format_duration(value)
+    if metric in _BYTE_METRICS:
+        return format_size(int(value))
+    return f'{value:g}'
+
+
+def _samples(db: MetricsDB, metric: str, runs: Optional[Iterable[int]] = None) -> list[Sample]:
+    if metric != TOTAL:
+        return db.samples(metric, runs=runs)
+    totals: dict[tuple[int, str], Sample] = {}
+    for part in ('fetch', 'prep', 'import'):
+        for s in db.samples(part, runs=runs):
+            key = (s.run_id, str(s.package_id))
+            prev = totals.get(key)
+            totals[key] = s if prev is None else prev._replace(value=prev.value + s.value)
+    return sorted(totals.values(), key=lambda s: s.run_id)
+
+
+def _matches(sample: Sample, patterns: Sequence[str]) -> bool:
+    return not patterns or any(fnmatch.fnmatch(sample.package_id.name, pat) for pat in patterns)
+
+
+def find_regressions(samples: Sequence[Sample], run_id: int, *, threshold: float,
+                     history_runs: int) -> list[Regression]:
+    """
+    Find the packages of the given run whose value is more than ``threshold``
+    times the mean value for the same package name in up to ``history_runs``
+    earlier runs.
+    """
+    found: list[Regression] = []
+    for latest in (s for s in samples if s.run_id == run_id):
+        same_name = [s for s in samples if s.package_id.name == latest.package_id.name]
+        earlier_runs = sorted(set(s.run_id for s in same_name if s.run_id < run_id))[-history_runs:]
+        earlier = [s.value for s in same_name if s.run_id in earlier_runs]
+        if not earlier:
+            continue
+        baseline = sum(earlier) / len(earlier)
+        if latest.value > baseline * threshold:
+            found.append(Regression(latest, baseline))
+    return sorted(found, key=lambda r: r.ratio, reverse=True)
+
+
+def _latest_run(db: MetricsDB, args: CommandArguments) -> Optional[int]:
+    if args.run is not None:
+        return args.run
+    runs = db.runs(limit=1)
+    return runs[0].run_id if runs else None
+
+
+def _top(db: MetricsDB, args: CommandArguments) -> int:
+    run_id = _latest_run(db, args)
+    if run_id is None:
+        print('No runs have been recorded')
+        return 0
+    samples = [s for s in _samples(db, args.metric, runs=[run_id]) if _matches(s, args.packages)]
+    top = sorted(samples, key=lambda s: s.value, reverse=True)[:args.top]
+    if args.json:
+        packages = [{'id': str(s.package_id), 'value': s.value} for s in top]
+        print(json.dumps({'run': run_id, 'metric': args.metric, 'packages': packages}, indent=2))
+        return 0
+    print(f'Top {len(top)} packages by {args.metric} in run #{run_id}:')
+    for s in top:
+        print(f'  {_format(args.metric, s.value):>10}  {s.package_id}')
+    return 0
+
+
+def _trend(db: MetricsDB, args: CommandArguments) -> int:
+    run_ids = {r.run_id: r for r in db.runs(limit=args.runs)}
+    samples = [s for s in _samples(db, args.metric, runs=run_ids) if _matches(s, args.packages)]
+    names = sorted(set(s.package_id.name for s in samples))
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    name: [{
+                        'run': s.run_id,
+                        'started-at': run_ids[s.run_id].started_at,
+                        'id': str(s.package_id),
+                        'value': s.value,
+                    } for s in samples if s.package_id.name == name]
+                    for name in names
+                },
+                indent=2,
+            ))
+        return 0
+    if not names:
+        print('No matching packages have been recorded')
+    for name in names:
+        print(f'{name} ({args.metric}):')
+        for s in (s for s in samples if s.package_id.name == name):
+            when = datetime.datetime.fromtimestamp(run_ids[s.run_id].started_at).isoformat(sep=' ', timespec='minutes')
+            print(f'  #{s.run_id:<5} {when}  {_format(args.metric, s.value):>10}  {s.package_id}')
+    return 0
+
+
+def _regressions(db: MetricsDB, args: CommandArguments) -> int:
+    run_id = _latest_run(db, args)
+    if run_id is None:
+        print('No runs have been recorded')
+        return 0
+    samples = [s for s in _samples(db, args.metric) if _matches(s, args.packages)]
+    found = find_regressions(samples, run_id, threshold=args.threshold, history_runs=args.runs)
+    if args.json:
+        regressions = [{
+            'id': str(r.sample.package_id),
+            'value': r.sample.value,
+            'baseline': r.baseline,
+        } for r in found]
+        print(json.dumps({'run': run_id, 'metric': args.metric, 'regressions': regressions}, indent=2))
+    elif not found:
+        print(f'No regressions of {args.metric} in run #{run_id}')
+    else:
+        print(f'Regressions of {args.metric} in run #{run_id} (more than {args.threshold:g}x the previous runs):')
+        for r in found:
+            print(f'  {r.sample.package_id}: {_format(args.metric, r.sample.value)} '
+                  f'(was {_format(args.metric, r.baseline)}, {r.ratio:.1f}x)')
+    # Regressions fail the command, so that it can gate a scheduled build
+    return 1 if found else 0
+
+
+def main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='dds-ports-report',
+                                     description='Report on the per-package metrics of past dds-ports-mkrepo runs')
+    sub = parser.add_subparsers(dest='command', required=True)
+    top = sub.add_parser('top', help='Show the packages with the highest value of a metric in a run')
+    trend = sub.add_parser('trend', help='Show how a metric of each package has changed over the recent runs')
+    regr = sub.add_parser('regressions',
+                          help='Show the packages of a run that regressed compared with the previous runs '
+                          '(Exits non-zero if there are any)')
+    metric_help = 'The metric to report (Default: %(default)s). ' + '; '.join(
+        f'{name}: {desc}' for name, desc in [*METRICS.items(), (TOTAL, 'fetch + prep + import')])
+    for p in (top, trend, regr):
+        p.add_argument('--metric', choices=[*METRICS, TOTAL], default=TOTAL, help=metric_help)
+        p.add_argument('--json', action='store_true', help='Emit the report as JSON')
+        p.add_argument('packages',
+                       nargs='*',
+                       metavar='<glob>',
+                       help='Only report packages whose name matches one of these globs')
+    for p in (top, regr):
+        p.add_argument('--run', type=int, help='The ID of the run to report (Default: the latest run)')
+    top.add_argument('--top', metavar='<N>', type=int, default=20, help='Show the top <N> packages (Default: 20)')
+    trend.add_argument('--runs', metavar='<N>', type=int, default=20, help='Cover the last <N> runs (Default: 20)')
+    regr.add_argument('--runs',
+                      metavar='<N>',
+                      type=int,
+                      default=5,
+                      help='Compare with the previous <N> runs of each package (Default: 5)')
+    regr.add_argument('--threshold',
+                      metavar='<ratio>',
+                      type=float,
+                      default=1.5,
+                      help='Report values more than <ratio> times the previous mean (Default: 1.5)')
+    args = cast(CommandArguments, parser.parse_args(argv))
+    db = MetricsDB.open()
+    try:
+        if args.command == 'top':
+            return _top(db, args)
+        if args.command == 'trend':
+            return _trend(db, args)
+        return _regressions(db, args)
+    finally:
+        db.close()
+
+
+def start() -> NoReturn:
+    sys.exit(main(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    start()
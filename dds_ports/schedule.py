@@ -0,0 +1,53 @@
+"""
+Longest-job-first scheduling of the preps and imports of a run.
+
+When more ports are ready than there are job slots, the ports that are
+expected to take longest start first, so that a large package (e.g. abseil)
+does not start last and stretch the tail of the run. The expected cost of a
+port comes from the stage timings of previous runs (see
+:mod:`dds_ports.history`), or else from the port's cost hint (see
+:func:`.port.cost_hint`).
+"""
+
+from __future__ import annotations
+
+import statistics
+
+from .history import History
+from .port import PackageID
+
+
+class CostModel:
+    """Estimates of the cost of ports, for ordering them longest-first"""
+    def __init__(self, history: History) -> None:
+        self._history = history
+        self._known: dict[str | None, list[float]] = {}
+
+    def estimate(self, pid: PackageID, *, stage: str | None = None, hint: float | None = None) -> float | None:
+        """
+        Estimate the duration (in seconds) of all stages (or only ``stage``) of
+        the given package. Without history, this is the ``hint`` of the port
+        (see :func:`.port.cost_hint`), which only applies to all stages.
+        """
+        est = self._history.estimate(pid, stage=stage)
+        if est is None and stage is None:
+            est = hint
+        if est is not None:
+            self._known.setdefault(stage, []).append(est)
+        return est
+
+    def priority(self, pid: PackageID, *, stage: str | None = None, hint: float | None = None) -> float:
+        """
+        The scheduling priority of the given package (see :meth:`estimate`).
+        Packages with no estimate are assumed to be of median cost among the
+        packages estimated so far.
+        """
+        est = self.estimate(pid, stage=stage, hint=hint)
+        if est is not None:
+            return est
+        known = self._known.get(stage)
+        return statistics.median(known) if known else 0.0
+
+    def close(self) -> None:
+        """Close the history database"""
+        self._history.close()
@@ -0,0 +1,143 @@
+"""
+Deterministic sdists, and the record of the sdist content that was imported
+into a repository.
+
+Before import, a prepared sdist is normalized (fixed modification times and
+modes), and a digest of its content is computed. The digest does not include
+the package revision ("pkg-version" in pkg.json), so a revision bump that
+leaves the package content unchanged produces the same digest. The digests of
+imported packages are stored alongside the repository in
+:data:`DIGESTS_FILENAME`, and a package whose content is unchanged from the
+imported revision of the same version is not imported again.
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Container, Iterable, NamedTuple
+
+from . import blobs, cache, fs
+from .port import PackageID
+from .repo import RepositoryAccess
+
+SDIST_MTIME = blobs.BLOB_MTIME
+"""
+The modification time given to every file of a normalized sdist. The same as
+that of the blob store, so normalizing leaves the files shared with it as-is.
+"""
+
+DIGESTS_FILENAME = 'dds-ports-digests.json'
+"The name of the file within the repository directory that stores sdist digests"
+
+
+def _digest_replacements(sdist: Path) -> dict[str, bytes]:
+    pkg_json = sdist / 'pkg.json'
+    if not pkg_json.is_file():
+        return {}
+    import json5
+    data = json5.loads(pkg_json.read_text())
+    data.pop('pkg-version', None)
+    return {'pkg.json': json.dumps(data, sort_keys=True).encode()}
+
+
+async def content_digest(sdist: Path) -> str:
+    """Compute the content digest of the sdist in the given directory"""
+    return await fs.tree_digest(sdist, _digest_replacements(sdist))
+
+
+async def finalize(sdist: Path) -> str:
+    """Normalize the sdist in the given directory for import, and return its content digest"""
+    await blobs.verify(sdist)
+    await fs.normalize_tree(sdist, SDIST_MTIME)
+    return await content_digest(sdist)
+
+
+class StoredDigest(NamedTuple):
+    """The content digest of a package version that was imported into a repository"""
+    digest: str
+    package_id: PackageID
+    "The revision of the package that was imported with this content"
+    equivalent: frozenset[PackageID]
+    "Other revisions that were found to have the same content, and so were not imported"
+
+
+class DigestStore:
+    """The content digests of the packages in a repository"""
+    def __init__(self, path: Path, entries: dict[str, StoredDigest]) -> None:
+        self._path = path
+        self._entries = entries
+
+    @staticmethod
+    def open(repo_dir: Path) -> 'DigestStore':
+        """Load the digest store of the repository in the given directory"""
+        path = repo_dir / DIGESTS_FILENAME
+        try:
+            data = json.loads(path.read_text())
+        except FileNotFoundError:
+            data = {}
+        entries = {
+            key: StoredDigest(e['digest'], PackageID.parse(e['package']),
+                              frozenset(PackageID.parse(p) for p in e.get('equivalent', ())))
+            for key, e in data.get('packages', {}).items()
+        }
+        return DigestStore(path, entries)
+
+    @staticmethod
+    def _key(pid: PackageID) -> str:
+        return f'{pid.name}@{pid.version}'
+
+    def lookup(self, pid: PackageID) -> StoredDigest | None:
+        """Get the stored digest for the version of the given package (of any revision)"""
+        return self._entries.get(self._key(pid))
+
+    def is_unchanged(self, pid: PackageID, digest: str, present: Container[PackageID]) -> bool:
+        """
+        Whether the given content of the given package is identical to the
+        content of a revision of the same version that is in the repository.
+        """
+        stored = self.lookup(pid)
+        return stored is not None and stored.digest == digest and stored.package_id in present
+
+    def equivalents(self, present: Iterable[PackageID]) -> set[PackageID]:
+        """
+        Get the package revisions that were not imported because their content
+        is identical to a package that is (still) present in the repository.
+        """
+        present = set(present)
+        return {pid for e in self._entries.values() if e.package_id in present for pid in e.equivalent}
+
+    def record_import(self, pid: PackageID, digest: str) -> None:
+        """Record that the given package was imported with the given content"""
+        self._entries[self._key(pid)] = StoredDigest(digest, pid, frozenset())
+
+    def record_equivalent(self, pid: PackageID) -> None:
+        """Record that the given package has the same content as the stored revision of its version"""
+        stored = self.lookup(pid)
+        assert stored is not None
+        self._entries[self._key(pid)] = stored._replace(equivalent=stored.equivalent | {pid})
+
+    def save(self) -> None:
+        """Write the digest store back into the repository directory"""
+        data = {
+            'packages': {
+                key: {
+                    'digest': e.digest,
+                    'package': str(e.package_id),
+                    'equivalent': sorted(str(p) for p in e.equivalent),
+                }
+                for key, e in sorted(self._entries.items())
+            }
+        }
+        with cache.publishing_file(self._path) as tmp:
+            tmp.write_text(json.dumps(data, indent=2))
+
+
+def known_packages(repo: RepositoryAccess) -> set[PackageID]:
+    """
+    Get the packages that are in the repository, along with the revisions that
+    were not imported because their content is identical to a package in the
+    repository.
+    """
+    present = set(repo.packages)
+    return present | DigestStore.open(repo.directory).equivalents(present)
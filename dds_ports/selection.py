@@ -0,0 +1,127 @@
+"""
+Port selection, for building only a subset of the ports catalog.
+
+The current selection is set by :func:`collect.collect_ports` while port files
+are being loaded, so the port-generating helpers in :mod:`dds_ports.auto` and
+:mod:`dds_ports.github` can skip querying or cloning repositories for packages
+that were not selected.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import fnmatch
+import hashlib
+import itertools
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Sequence
+
+from semver import VersionInfo
+
+from .port import Port, PackageID
+
+
+class Shard(NamedTuple):
+    """
+    One of ``count`` disjoint subsets of the packages. Packages are assigned to
+    shards by a stable hash of the package name, so every version of a package
+    (and therefore every user of its mirror) lands on the same shard.
+    """
+    index: int
+    "The 1-based index of this shard"
+    count: int
+    "The total number of shards"
+
+    @staticmethod
+    def parse(s: str) -> 'Shard':
+        """Parse a shard string of the form "<i>/<N>", with 1 <= i <= N"""
+        idx_str, _, count_str = s.partition('/')
+        try:
+            shard = Shard(int(idx_str), int(count_str))
+        except ValueError:
+            raise ValueError(f'Invalid shard "{s}" (Expected "<i>/<N>")') from None
+        if not 1 <= shard.index <= shard.count:
+            raise ValueError(f'Invalid shard "{s}" (Shard index must be between 1 and {shard.count})')
+        return shard
+
+    def contains(self, package_name: str) -> bool:
+        """Whether the named package belongs to this shard"""
+        digest = hashlib.sha1(package_name.encode()).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count == self.index - 1
+
+    def __str__(self) -> str:
+        return f'{self.index}/{self.count}'
+
+
+class PortSelection(NamedTuple):
+    """
+    A filter on the set of ports to build. An empty selection selects everything.
+    """
+    package_globs: Sequence[str] = ()
+    "Glob patterns of package names to select. Empty to select all packages"
+    port_files: Sequence[str] = ()
+    "Names (or globs) of port files to load, with or without the '.py' suffix. Empty to load all files"
+    min_version: VersionInfo | None = None
+    "The lowest package version to select"
+    max_version: VersionInfo | None = None
+    "Select only package versions below this version"
+    newest: int | None = None
+    "Select only this many of the newest versions of each package"
+    shard: Shard | None = None
+    "Select only the packages that belong to this shard"
+
+    def wants_port_file(self, fpath: Path) -> bool:
+        """Whether the given port file should be loaded"""
+        if not self.port_files:
+            return True
+        name, stem = fpath.name, fpath.stem
+        return any(fnmatch.fnmatchcase(name, pat) or fnmatch.fnmatchcase(stem, pat) for pat in self.port_files)
+
+    def wants_package(self, name: str) -> bool:
+        """Whether any versions of the named package may be selected"""
+        if self.shard is not None and not self.shard.contains(name):
+            return False
+        if not self.package_globs:
+            return True
+        return any(fnmatch.fnmatchcase(name, pat) for pat in self.package_globs)
+
+    def wants_version(self, version: VersionInfo) -> bool:
+        """Whether the given version is within the selected version range"""
+        if self.min_version is not None and version < self.min_version:
+            return False
+        if self.max_version is not None and version >= self.max_version:
+            return False
+        return True
+
+    def wants(self, pid: PackageID) -> bool:
+        """Whether the given package is selected, not considering `newest`"""
+        return self.wants_package(pid.name) and self.wants_version(pid.version)
+
+    def apply(self, ports: Iterable[Port]) -> Iterable[Port]:
+        """Filter the given ports down to the ports that are selected"""
+        selected = (p for p in ports if self.wants(p.package_id))
+        if self.newest is None:
+            return selected
+        by_name = itertools.groupby(sorted(selected, key=lambda p: p.package_id.name), key=lambda p: p.package_id.name)
+        newest = self.newest
+        return itertools.chain.from_iterable(
+            sorted(group, key=lambda p: p.package_id.version, reverse=True)[:newest] for _, group in by_name)
+
+
+_CURRENT = contextvars.ContextVar('_CURRENT_PORT_SELECTION', default=PortSelection())
+
+
+def current() -> PortSelection:
+    """Get the port selection that is in effect for the current context"""
+    return _CURRENT.get()
+
+
+@contextmanager
+def selecting(sel: PortSelection) -> Iterator[None]:
+    """Make the given port selection current for the duration of the context"""
+    tok = _CURRENT.set(sel)
+    try:
+        yield
+    finally:
+        _CURRENT.reset(tok)
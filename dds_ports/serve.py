@@ -0,0 +1,195 @@
+"""
+Long-running mode of dds-ports-mkrepo (``dds-ports-mkrepo serve``).
+
+Rather than a cold run on a schedule, one process polls the upstreams over and
+over, and keeps its state warm between polls. That state includes the package
+listing of the repository, the ETags of tag listings (see
+:func:`dds_ports.github.get_repo_tags`), the shared HTTP session and the Dagon
+extensions. Each poll runs the import pipeline over all ports, so new upstream
+tags are imported as they appear, and mirrors are only fetched for ports that
+have something new to prepare.
+
+A poll runs every ``interval`` seconds, or sooner when triggered with a
+``POST /poll`` to the optional local HTTP endpoint. ``GET /status`` on the same
+endpoint reports the state of the daemon as JSON.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import signal
+import sys
+import time
+import traceback
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+
+from .pipeline import PipelineResult
+
+DEFAULT_HOST = '127.0.0.1'
+
+
+class Address(NamedTuple):
+    """The local address on which the HTTP trigger listens"""
+    host: str
+    port: int
+
+    @staticmethod
+    def parse(s: str) -> Address:
+        """Parse a ``[<host>:]<port>`` string"""
+        host, _, port = s.rpartition(':')
+        if not port.isdigit():
+            raise ValueError(f'Invalid listen address "{s}" (Expected [<host>:]<port>)')
+        return Address(host or DEFAULT_HOST, int(port))
+
+
+class PollOutcome(NamedTuple):
+    """The outcome of one poll of the upstreams"""
+    started_at: float
+    finished_at: float
+    imported: list[str]
+    "The packages that were imported"
+    unchanged: int
+    "The number of packages that were not imported because their content is unchanged"
+    up_to_date: int
+    "The number of discovered packages that were already in the repository"
+    failed: list[str]
+    "The packages that failed to prepare or import"
+    discovery_errors: list[str]
+    "The port files that could not be loaded"
+    error: Optional[str]
+    "The error that stopped the poll, if it did not complete"
+
+
+PollFn = Callable[[], Awaitable[PipelineResult]]
+
+
+class Daemon:
+    """
+    Runs ``poll`` every ``interval`` seconds until stopped. A poll that raises
+    is reported, and does not stop the daemon.
+    """
+    def __init__(self, poll: PollFn, interval: float) -> None:
+        self._poll = poll
+        self._interval = interval
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self.polls = 0
+        "The number of polls that have finished"
+        self.polling = False
+        "Whether a poll is running"
+        self.next_poll_at: float | None = None
+        "When the next scheduled poll starts, if no poll is running"
+        self.last: PollOutcome | None = None
+        "The outcome of the most recent poll"
+
+    def trigger(self) -> None:
+        """
+        Start a poll now, rather than at the next scheduled time. If a poll is
+        running, another starts as soon as it finishes.
+        """
+        self._wake.set()
+
+    def stop(self) -> None:
+        """Stop the daemon once the running poll (if any) has finished"""
+        self._stopping = True
+        self._wake.set()
+
+    def status(self) -> dict[str, Any]:
+        """The state of the daemon, as a JSON-compatible object"""
+        return {
+            'polls': self.polls,
+            'polling': self.polling,
+            'interval': self._interval,
+            'next-poll-at': self.next_poll_at,
+            'last': None if self.last is None else {
+                'started-at': self.last.started_at,
+                'finished-at': self.last.finished_at,
+                'imported': self.last.imported,
+                'unchanged': self.last.unchanged,
+                'up-to-date': self.last.up_to_date,
+                'failed': self.last.failed,
+                'discovery-errors': self.last.discovery_errors,
+                'error': self.last.error,
+            },
+        }
+
+    async def _poll_once(self) -> None:
+        started = time.time()
+        self.polling = True
+        try:
+            result = await self._poll()
+        except Exception:  # pylint: disable=broad-except
+            self.last = PollOutcome(started, time.time(), [], 0, 0, [], [], traceback.format_exc())
+            print(f'Poll failed:\n{self.last.error}', file=sys.stderr)
+        else:
+            self.last = PollOutcome(started, time.time(), sorted(map(str, result.imported)), len(result.unchanged),
+                                    result.up_to_date, sorted(map(str, result.failed)),
+                                    sorted(map(str, result.discovery_errors)), None)
+        finally:
+            self.polling = False
+            self.polls += 1
+
+    async def run(self) -> None:
+        """Poll until :meth:`stop` is called"""
+        while not self._stopping:
+            self._wake.clear()
+            await self._poll_once()
+            if self._stopping:
+                break
+            self.next_poll_at = time.time() + self._interval
+            print(f'Next poll in {self._interval / 60:.1f} minutes')
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self._interval)
+            self.next_poll_at = None
+
+
+@asynccontextmanager
+async def http_trigger(daemon: Daemon, address: Address) -> AsyncIterator[None]:
+    """Serve ``POST /poll`` and ``GET /status`` for the daemon on the given address"""
+    from aiohttp import web
+
+    async def poll(_req: web.Request) -> web.Response:
+        daemon.trigger()
+        return web.json_response({'triggered': True}, status=202)
+
+    async def status(_req: web.Request) -> web.Response:
+        return web.json_response(daemon.status())
+
+    app = web.Application()
+    app.router.add_post('/poll', poll)
+    app.router.add_get('/status', status)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, address.host, address.port).start()
+        print(f'Listening for poll triggers on http://{address.host}:{address.port}/poll')
+        yield
+    finally:
+        await runner.cleanup()
+
+
+async def serve(poll: PollFn, *, interval: float, listen: Address | None = None) -> None:
+    """
+    Call ``poll`` every ``interval`` seconds (and when triggered over HTTP, if
+    ``listen`` is given) until the process receives SIGINT or SIGTERM.
+    """
+    daemon = Daemon(poll, interval)
+    loop = asyncio.get_running_loop()
+    signals = (signal.SIGINT, signal.SIGTERM)
+
+    def on_signal() -> None:
+        print('Stopping once the running poll has finished')
+        daemon.stop()
+
+    for sig in signals:
+        loop.add_signal_handler(sig, on_signal)
+    try:
+        if listen is None:
+            await daemon.run()
+        else:
+            async with http_trigger(daemon, listen):
+                await daemon.run()
+    finally:
+        for sig in signals:
+            loop.remove_signal_handler(sig)
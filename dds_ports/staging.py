@@ -0,0 +1,203 @@
+"""
+Staging area for sdists that are being prepared for import.
+
+Every prep creates its working directory through the current
+:class:`StagingArea`, which removes it again as soon as the package has been
+imported. If a disk budget is set, new preps wait until enough of the
+in-flight sdists have been imported and removed.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import atexit
+import contextvars
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from . import cache, fs
+from .deferred import dagon
+
+PREP_JOBS = 8
+"Default number of ports that are prepared concurrently"
+
+IMPORT_JOBS = 10
+"Default number of sdists that are imported concurrently"
+
+SDIST_SIZE_ESTIMATE = 64 * 1024 * 1024
+"""
+The size (in bytes) that a staging directory is assumed to grow to while it is
+being prepared, until the size of a prepared sdist is known
+"""
+
+
+class StagingArea:
+    """
+    Manages the directories of sdists that are in-flight between prep and import.
+
+    :param root: The directory in which staging directories are created. Owned
+        by this object, and deleted by :meth:`close`.
+    :param budget: The number of bytes that in-flight sdists may occupy before
+        new preps are held back. ``None`` for no limit.
+    """
+    def __init__(self, root: Path, *, budget: int | None = None) -> None:
+        self._root = root
+        self._budget = budget
+        self._sizes: dict[Path, int | None] = {}
+        self._cond = asyncio.Condition()
+
+    @property
+    def root(self) -> Path:
+        """The directory containing all staging directories"""
+        return self._root
+
+    @property
+    def budget(self) -> int | None:
+        """The disk budget of the staging area, in bytes"""
+        return self._budget
+
+    @property
+    def estimated_usage(self) -> int:
+        """
+        The estimated number of bytes used by in-flight sdists. Directories
+        that are still being prepared are assumed to be of the average size of
+        the prepared ones, or of :data:`SDIST_SIZE_ESTIMATE` before any have
+        been prepared.
+        """
+        known = [s for s in self._sizes.values() if s is not None]
+        pending = len(self._sizes) - len(known)
+        average = sum(known) // len(known) if known else SDIST_SIZE_ESTIMATE
+        return sum(known) + pending * average
+
+    def _has_room(self) -> bool:
+        if self._budget is None or not self._sizes:
+            # Always allow at least one sdist in flight, or we'd never progress
+            return True
+        return self.estimated_usage < self._budget
+
+    async def create(self, name: str) -> Path:
+        """
+        Create a new empty staging directory. Waits until the staging area is
+        within its disk budget.
+        """
+        async with self._cond:
+            if not self._has_room():
+                dagon.ui.status(f'Waiting for staging space to prepare {name}')
+            await self._cond.wait_for(self._has_room)
+            self._root.mkdir(exist_ok=True, parents=True)
+            path = Path(tempfile.mkdtemp(dir=self._root, prefix=name.replace('/', '_') + '.'))
+            self._sizes[path] = None
+        created = _CREATED.get()
+        if created is not None:
+            created.append(path)
+        return path
+
+    async def settle(self, path: Path) -> None:
+        """Record the final size of a staging directory once its prep has finished"""
+        if path not in self._sizes:
+            return
+        size = await fs.tree_size(path)
+        async with self._cond:
+            if path in self._sizes:
+                self._sizes[path] = size
+            self._cond.notify_all()
+
+    async def release(self, path: Path) -> None:
+        """
+        Delete a staging directory that is no longer needed. Paths that were
+        not created by this staging area are ignored.
+        """
+        if path not in self._sizes:
+            return
+        # Not with dagon.fs.remove(): It refuses to run once a failed task has cancelled the context
+        await fs.remove_directory(path, absent_ok=True)
+        async with self._cond:
+            self._sizes.pop(path, None)
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        """Delete the staging area and everything still in it"""
+        self._sizes.clear()
+        shutil.rmtree(self._root, ignore_errors=True)
+
+
+def _new_root() -> Path:
+    return Path(tempfile.mkdtemp(dir=cache.cache_dir('staging'), prefix=f'run-{os.getpid()}-'))
+
+
+_CURRENT = contextvars.ContextVar['StagingArea | None']('_CURRENT_STAGING_AREA', default=None)
+_DEFAULT: StagingArea | None = None
+_CREATED = contextvars.ContextVar['list[Path] | None']('_STAGING_CREATED', default=None)
+
+
+def current() -> StagingArea:
+    """
+    Get the staging area for the current context. If none has been set with
+    :func:`staging_area`, an unbounded staging area is created that is removed
+    when the process exits.
+    """
+    global _DEFAULT  # pylint: disable=global-statement
+    area = _CURRENT.get()
+    if area is not None:
+        return area
+    if _DEFAULT is None:
+        _DEFAULT = StagingArea(_new_root())
+        atexit.register(_DEFAULT.close)
+    return _DEFAULT
+
+
+@contextmanager
+def collecting_created() -> Iterator[list[Path]]:
+    """
+    Collect the staging directories that are created within the context, and
+    within the tasks that are started from it (e.g. to release them if a prep
+    fails).
+    """
+    created: list[Path] = []
+    tok = _CREATED.set(created)
+    try:
+        yield created
+    finally:
+        _CREATED.reset(tok)
+
+
+@contextmanager
+def using(area: StagingArea) -> Iterator[StagingArea]:
+    """
+    Make the given staging area current for the duration of the context. The
+    staging area is not deleted when the context exits.
+    """
+    tok = _CURRENT.set(area)
+    try:
+        yield area
+    finally:
+        _CURRENT.reset(tok)
+
+
+def new_area(root: Path | None = None, *, budget: int | None = None) -> StagingArea:
+    """
+    Create a staging area in a new directory within ``root`` (Default: within
+    the dds-ports cache). The caller must :meth:`~StagingArea.close` it.
+    """
+    if root is None:
+        return StagingArea(_new_root(), budget=budget)
+    root.mkdir(exist_ok=True, parents=True)
+    return StagingArea(Path(tempfile.mkdtemp(dir=root, prefix=f'run-{os.getpid()}-')), budget=budget)
+
+
+@contextmanager
+def staging_area(root: Path | None = None, *, budget: int | None = None) -> Iterator[StagingArea]:
+    """
+    Create a staging area and make it current for the duration of the context.
+    The staging area is deleted when the context exits.
+    """
+    area = new_area(root, budget=budget)
+    try:
+        with using(area):
+            yield area
+    finally:
+        area.close()
@@ -0,0 +1,56 @@
+"""
+The Dagon extension that records stage timings into the history database (see
+:mod:`dds_ports.history`).
+
+This is kept apart from :mod:`dds_ports.history` because Dagon is slow to
+import, and reading the history (e.g. for ``--plan``) does not need it.
+"""
+
+from __future__ import annotations
+
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from dagon.core.result import NodeResult, Success
+from dagon.ext.base import BaseExtension
+from dagon.ext.iface import OpaqueTaskGraphView
+from dagon.task.dag import OpaqueTask
+
+from .history import History, task_subject
+
+
+class TimingExtension(BaseExtension[None, History, None]):
+    """
+    Dagon extension that records the duration of every executed task into the
+    history database. Only the time that a task spends running is measured, not
+    the time spent waiting on a job pool.
+    """
+    dagon_ext_name = 'dds-ports.timing'
+    dagon_ext_requires = ['dagon.pools']
+
+    def __init__(self) -> None:
+        self._started: dict[OpaqueTask, float] = {}
+
+    @asynccontextmanager
+    async def global_context(self, graph: OpaqueTaskGraphView) -> AsyncIterator[History]:
+        hist = History.open()
+        try:
+            yield hist
+        finally:
+            hist.close()
+
+    @asynccontextmanager
+    async def task_context(self, task: OpaqueTask) -> AsyncIterator[None]:
+        self._started[task] = time.monotonic()
+        try:
+            yield
+        finally:
+            self._started.pop(task, None)
+
+    async def notify_result(self, result: NodeResult[OpaqueTask]) -> None:
+        start = self._started.get(result.task)
+        if start is None or not isinstance(result.result, Success):
+            return
+        subject = task_subject(result.task.name)
+        self.global_data().record(subject.subject, subject.stage, time.monotonic() - start)
@@ -1,11 +1,13 @@
 import asyncio
+import heapq
+import itertools
 from pathlib import Path
-from typing import TypeVar, Iterable, Awaitable, Iterator, Sequence, Optional
+from typing import Callable, Generic, TypeVar, Iterable, Awaitable, AsyncIterator, Iterator, Sequence, Optional
 import tempfile
 import shutil
-from contextlib import contextmanager
-import subprocess
+from contextlib import asynccontextmanager, contextmanager
 import re
+from weakref import WeakKeyDictionary
 
 from semver import VersionInfo
 
@@ -13,11 +15,90 @@ T = TypeVar('T')
 
 TAG_VERSION_RE = re.compile(r'(?:v|boost-|yaml-cpp-|release-|pegtl-)?(\d+\.\d+(\.\d+)?([-.].*|$))')
 
+_SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)i?[bB]?\s*$')
+_SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+
+
+class LoopLocal(Generic[T]):
+    """
+    A value (e.g. a semaphore or a lock) of which each event loop has its own,
+    created on first use within that loop by ``factory``. Asyncio primitives
+    are bound to the loop that first uses them, so module-level limits are
+    kept per loop, and work from any number of loops (in turn, or in separate
+    threads).
+    """
+    def __init__(self, factory: Callable[[], T]) -> None:
+        self._factory = factory
+        self._values: WeakKeyDictionary[asyncio.AbstractEventLoop, T] = WeakKeyDictionary()
+
+    def get(self) -> T:
+        """Get the value for the running event loop"""
+        loop = asyncio.get_running_loop()
+        value = self._values.get(loop)
+        if value is None:
+            value = self._values[loop] = self._factory()
+        return value
+
+
+class PriorityLimiter:
+    """
+    Limits the number of concurrent holders of a slot, like a semaphore, but
+    lets waiters in by descending priority (first come, first served among
+    equal priorities) rather than in arrival order.
+    """
+    def __init__(self, value: int) -> None:
+        self._free = value
+        self._waiters: list[tuple[float, int, asyncio.Future[None]]] = []
+        self._seq = itertools.count()
+
+    @asynccontextmanager
+    async def slot(self, priority: float = 0) -> AsyncIterator[None]:
+        """Hold a slot for the duration of the context"""
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: float) -> None:
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed to us just as we were cancelled
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            # Waiters that were cancelled are skipped
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._free += 1
+
 
 async def wait_all(futs: Iterable[Awaitable[T]]) -> Iterable[T]:
     return await asyncio.gather(*futs)
 
 
+async def iter_completed(futs: Iterable[Awaitable[T]]) -> AsyncIterator[T]:
+    """Run the given awaitables concurrently, and yield their results in the order that they complete"""
+    pending = [asyncio.ensure_future(f) for f in futs]
+    try:
+        for fut in asyncio.as_completed(pending):
+            yield await fut
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
 def tag_as_version(tag: str) -> Optional[VersionInfo]:
     mat = TAG_VERSION_RE.match(tag)
     if not mat:
@@ -32,6 +113,39 @@ def tag_as_version(tag: str) -> Optional[VersionInfo]:
         return None
 
 
+def parse_size(size: str) -> int:
+    """
+    Parse a human-readable size string (e.g. "512M", "20G", "1.5TiB") into a
+    number of bytes
+    """
+    mat = _SIZE_RE.match(size)
+    if not mat:
+        raise ValueError(f'Invalid size string "{size}"')
+    num, unit = mat.groups()
+    return int(float(num) * _SIZE_UNITS[unit.lower()])
+
+
+def format_size(size: int) -> str:
+    """Render a number of bytes as a short human-readable string"""
+    value = float(size)
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(value) < 1024:
+            return f'{value:.1f} {unit}' if unit != 'B' else f'{int(value)} B'
+        value /= 1024
+    return f'{value:.1f} TiB'
+
+
+def format_duration(seconds: float) -> str:
+    """Render a number of seconds as a short human-readable string"""
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    minutes, secs = divmod(int(seconds), 60)
+    if minutes < 60:
+        return f'{minutes}m{secs:02}s'
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02}m'
+
+
 @contextmanager
 def temporary_directory(suffix: str = 'dds-ports') -> Iterator[Path]:
     """
@@ -45,13 +159,7 @@ def temporary_directory(suffix: str = 'dds-ports') -> Iterator[Path]:
         shutil.rmtree(tdir)
 
 
-async def run_process(command: Sequence[str]) -> None:
-    proc = await asyncio.create_subprocess_exec(*command,
-                                                stdin=asyncio.subprocess.PIPE,
-                                                stdout=asyncio.subprocess.PIPE,
-                                                stderr=asyncio.subprocess.STDOUT)
-    output, _ = await proc.communicate()
-    retc = await proc.wait()
-    if retc != 0:
-        print(f'Subprocess {command} failed:\n{output.decode()}')
-        raise subprocess.CalledProcessError(retc, command, output=output)
+async def run_process(command: Sequence[str], *, timeout: Optional[float] = None) -> None:
+    """Run a process to completion, keeping only the end of its output (see :func:`.process.run`)"""
+    from .process import run
+    await run(command, timeout=timeout)
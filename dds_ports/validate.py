@@ -0,0 +1,237 @@
+"""
+Incremental validation of a repository after new packages are imported.
+
+Rather than running ``bpt repo validate`` over the whole repository after every
+run, only the dependencies of the newly imported packages, and the
+dependencies of the packages that depend on them, are checked against an index
+of the repository's packages. The index is kept in the dds-ports cache
+directory, and is filled in from the repository's package archives for any
+packages that it has not seen yet.
+
+A full ``bpt repo validate`` is still run periodically (see
+:func:`validate_imports`).
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Mapping, NamedTuple, Sequence
+
+import json5
+from semver import VersionInfo
+
+from . import cache, crs, fs
+from .port import PackageID
+from .repo import RepositoryAccess
+from .util import format_duration, wait_all
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    repo TEXT NOT NULL,
+    package_id TEXT NOT NULL,
+    libraries TEXT,
+    dependencies TEXT NOT NULL,
+    PRIMARY KEY (repo, package_id)
+);
+CREATE TABLE IF NOT EXISTS full_validations (
+    repo TEXT PRIMARY KEY,
+    validated_at REAL NOT NULL
+);
+'''
+
+PKG_JSON_NAMES = ('pkg.json', 'pkg.jsonc', 'pkg.json5')
+
+
+class PackageInfo(NamedTuple):
+    """The dependency information of a single package"""
+    package_id: PackageID
+    libraries: frozenset[str] | None
+    "The names of the libraries in the package, or ``None`` if unknown"
+    dependencies: Sequence[crs.CRS_Dependency]
+    "The (non-test) dependencies of all libraries in the package"
+
+
+class ValidationError(RuntimeError):
+    """Raised when newly imported packages leave the repository unsatisfiable"""
+    def __init__(self, problems: Sequence[str]) -> None:
+        super().__init__(f'Repository validation found {len(problems)} problems:\n' + '\n'.join(problems))
+        self.problems = problems
+
+
+def package_info_from_crs(pid: PackageID, crs_json: crs.CRS_JSON) -> PackageInfo:
+    """Get the dependency information from a package's pkg.json content"""
+    libs = crs_json.get('libraries', [])
+    deps: list[crs.CRS_Dependency] = []
+    for lib in libs:
+        deps.extend(lib.get('dependencies', []))
+    return PackageInfo(pid, frozenset(l['name'] for l in libs), deps)
+
+
+def read_package_info(pid: PackageID, sdist: Path) -> PackageInfo:
+    """Read the dependency information of the sdist in the given directory"""
+    for fname in PKG_JSON_NAMES:
+        cand = sdist / fname
+        if cand.is_file():
+            return package_info_from_crs(pid, json5.loads(cand.read_text()))
+    raise RuntimeError(f'No pkg.json file in prepared sdist [{sdist}]')
+
+
+async def _read_archived_info(repo: RepositoryAccess, pid: PackageID) -> PackageInfo:
+    try:
+        content = await fs.read_archive_file(repo.package_archive(pid), PKG_JSON_NAMES)
+    except RuntimeError:
+        content = None
+    if content is None:
+        # The package's libraries are unknown, so any library requirements
+        # against it are assumed to be met.
+        print(f'Warning: Could not read the pkg.json of {pid} from the repository')
+        return PackageInfo(pid, None, ())
+    return package_info_from_crs(pid, json5.loads(content.decode()))
+
+
+def _satisfies(info: PackageInfo, dep: crs.CRS_Dependency) -> bool:
+    ver = info.package_id.version
+    if not any(VersionInfo.parse(r['low']) <= ver < VersionInfo.parse(r['high']) for r in dep['versions']):
+        return False
+    return info.libraries is None or set(dep.get('using', ())) <= info.libraries
+
+
+def _dep_str(dep: crs.CRS_Dependency) -> str:
+    ranges = ', '.join(f'[{r["low"]}, {r["high"]})' for r in dep['versions'])
+    return f'{dep["name"]} {ranges} using {", ".join(dep.get("using", ()))}'
+
+
+def find_problems(packages: Mapping[PackageID, PackageInfo], check: Iterable[PackageID]) -> list[str]:
+    """
+    Check that every dependency of the packages in ``check`` can be satisfied
+    by some package in ``packages``.
+    """
+    by_name: dict[str, list[PackageInfo]] = {}
+    for info in packages.values():
+        by_name.setdefault(info.package_id.name, []).append(info)
+    problems: list[str] = []
+    for pid in sorted(check):
+        for dep in packages[pid].dependencies:
+            if not any(_satisfies(c, dep) for c in by_name.get(dep['name'], ())):
+                problems.append(f'  - {pid}: No package in the repository satisfies dependency {_dep_str(dep)}')
+    return problems
+
+
+class RepositoryIndex:
+    """
+    The dependency information of every package in a repository, as recorded
+    in the dds-ports cache.
+    """
+    def __init__(self, db: sqlite3.Connection, repo: RepositoryAccess) -> None:
+        self._db = db
+        self._db.executescript(_SCHEMA)
+        self._repo = repo
+        self._key = str(repo.directory.resolve())
+
+    @staticmethod
+    def open(repo: RepositoryAccess) -> 'RepositoryIndex':
+        """Open the index for the given repository"""
+        root = cache.cache_root()
+        root.mkdir(exist_ok=True, parents=True)
+        return RepositoryIndex(sqlite3.connect(root / 'repo-index.db', timeout=30), repo)
+
+    def close(self) -> None:
+        """Close the index database"""
+        self._db.close()
+
+    def _load(self) -> dict[PackageID, PackageInfo]:
+        rows = self._db.execute('SELECT package_id, libraries, dependencies FROM packages WHERE repo = ?',
+                                (self._key, ))
+        infos: dict[PackageID, PackageInfo] = {}
+        for pid_str, libs, deps in rows:
+            pid = PackageID.parse(pid_str)
+            infos[pid] = PackageInfo(pid, None if libs is None else frozenset(json.loads(libs)), json.loads(deps))
+        return infos
+
+    def record(self, infos: Iterable[PackageInfo]) -> None:
+        """Record (or replace) the dependency information of the given packages"""
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO packages (repo, package_id, libraries, dependencies) VALUES (?, ?, ?, ?)',
+                ((self._key, str(i.package_id), None if i.libraries is None else json.dumps(sorted(i.libraries)),
+                  json.dumps(i.dependencies)) for i in infos))
+
+    async def packages(self) -> dict[PackageID, PackageInfo]:
+        """
+        Get the dependency information of every package that is currently in
+        the repository. Packages that are not yet in the index are read from
+        the repository and recorded.
+        """
+        infos = self._load()
+        current = set(self._repo.packages)
+        gone = [pid for pid in infos if pid not in current]
+        if gone:
+            with self._db:
+                self._db.executemany('DELETE FROM packages WHERE repo = ? AND package_id = ?',
+                                     ((self._key, str(pid)) for pid in gone))
+        missing = [pid for pid in current if pid not in infos]
+        if missing:
+            print(f'Indexing {len(missing)} packages in [{self._repo.directory}]')
+            new = list(await wait_all(_read_archived_info(self._repo, pid) for pid in missing))
+            self.record(new)
+            infos.update((i.package_id, i) for i in new)
+        return {pid: infos[pid] for pid in current}
+
+    def last_full_validation(self) -> float | None:
+        """The time at which the repository last passed a full validation"""
+        row = self._db.execute('SELECT validated_at FROM full_validations WHERE repo = ?', (self._key, )).fetchone()
+        return None if row is None else float(row[0])
+
+    def record_full_validation(self) -> None:
+        """Record that the repository just passed a full validation"""
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO full_validations (repo, validated_at) VALUES (?, ?)',
+                             (self._key, time.time()))
+
+
+async def validate_imports(repo: RepositoryAccess,
+                           imported: Iterable[PackageInfo],
+                           *,
+                           full_interval: float | None = None) -> None:
+    """
+    Validate the repository after the given packages have been imported into
+    it. Checks the dependencies of the imported packages, and of the packages
+    that depend on them (nothing, if no packages were imported).
+
+    :param full_interval: If given, also run a full ``bpt repo validate`` if
+        the last full validation was more than this many seconds ago. ``0``
+        runs a full validation every time.
+
+    Raises :class:`ValidationError` if any dependencies cannot be satisfied.
+    """
+    new = {i.package_id: i for i in imported}
+    index = RepositoryIndex.open(repo)
+    try:
+        if new:
+            packages = await index.packages()
+            packages.update(new)
+            new_names = set(pid.name for pid in new)
+            dependents = [
+                info.package_id for info in packages.values()
+                if info.package_id not in new and any(d['name'] in new_names for d in info.dependencies)
+            ]
+            problems = find_problems(packages, [*new, *dependents])
+            if problems:
+                raise ValidationError(problems)
+            index.record(new.values())
+            print(f'Validated {len(new)} new packages and {len(dependents)} of their dependents')
+
+        if full_interval is None:
+            return
+        last = index.last_full_validation()
+        if last is not None and time.time() - last < full_interval:
+            print(f'Skipping full validation (Last ran {format_duration(time.time() - last)} ago)')
+            return
+        print('Running full repository validation')
+        await repo.validate()
+        index.record_full_validation()
+    finally:
+        index.close()
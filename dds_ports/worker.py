@@ -0,0 +1,238 @@
+"""
+Multi-process execution of a repository build.
+
+The coordinator (:func:`run_with_workers`) enqueues a prep job for every
+package to import into a :class:`~.workqueue.WorkQueue`, and starts worker
+processes (``python -m dds_ports.worker``) that claim jobs one at a time until
+the queue is drained. Each worker loads the port file for its job, prepares the
+sdist in its own staging directory, and reports the sdist back through the
+queue. The coordinator imports prepared sdists into the repository as they
+arrive.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from pathlib import Path
+from typing import Iterable, NamedTuple, NoReturn, Sequence, cast
+
+import dagon.pool
+import dagon.tool.main
+from typing_extensions import Protocol
+
+from . import cache, github, staging
+from .collect import ports_in_file
+from .history import History
+from .timing import TimingExtension
+from .pipeline import IMPORT_TIMEOUT, extension_context, prepare_port
+from .port import Port, PackageID, cost_hint
+from .repo import RepositoryAccess
+from .schedule import CostModel
+from .sdist import DigestStore, finalize, known_packages
+from .util import wait_all
+from .validate import PackageInfo, read_package_info
+from .workqueue import Job, WorkQueue
+
+POLL_INTERVAL = 0.5
+"Seconds between checks of the queue for newly prepared sdists"
+
+MAX_WORKER_RESTARTS = 3
+"The number of times the workers are started again after all of them exited with jobs still pending"
+
+
+class _PortLoader:
+    """Loads ports from port files on demand, loading each port file only once"""
+    def __init__(self) -> None:
+        self._by_file: dict[Path, dict[PackageID, Port]] = {}
+
+    async def get(self, port_file: Path, pid: PackageID) -> Port:
+        ports = self._by_file.get(port_file)
+        if ports is None:
+            # The coordinator has just listed the tags of every repository, so
+            # the cached listings are up-to-date.
+            with github.prefer_cached_tags():
+                ports = {p.package_id: p for p in await ports_in_file(port_file)}
+            self._by_file[port_file] = ports
+        found = ports.get(pid)
+        if found is None:
+            raise RuntimeError(f'Port file [{port_file}] no longer defines a port for {pid}')
+        return found
+
+
+async def _work(queue: WorkQueue, worker: str, staging_dir: Path) -> int:
+    exts = dagon.tool.main.get_extensions()
+    exts.load(TimingExtension())
+    loader = _PortLoader()
+    n_done = 0
+    # The staging directories are deleted by the coordinator after import, so
+    # the staging area is not closed here.
+    area = staging.StagingArea(staging_dir)
+    with exts.app_context(), staging.using(area):
+        dagon.pool.add('cloner', 3)
+        async with github.session_context_manager(), extension_context(exts):
+            while 1:
+                job = queue.claim(worker)
+                if job is None:
+                    break
+                try:
+                    port = await loader.get(job.port_file, job.package_id)
+                    sdist = await prepare_port(port, exts)
+                except Exception:  # pylint: disable=broad-except
+                    queue.fail(job, traceback.format_exc())
+                else:
+                    queue.complete(job, sdist)
+                    n_done += 1
+    return n_done
+
+
+class WorkerArguments(Protocol):
+    queue: Path
+    worker_id: str
+    staging_dir: Path
+
+
+def worker_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='python -m dds_ports.worker')
+    parser.add_argument('--queue', type=Path, required=True, help='Path to the work queue database')
+    parser.add_argument('--worker-id', required=True, help='Name of this worker')
+    parser.add_argument('--staging-dir', type=Path, required=True, help='Directory in which to prepare sdists')
+    args = cast(WorkerArguments, parser.parse_args(argv))
+    queue = WorkQueue.open(args.queue)
+    try:
+        asyncio.run(_work(queue, args.worker_id, args.staging_dir))
+    finally:
+        queue.close()
+    return 0
+
+
+async def _run_worker(queue: WorkQueue, queue_path: Path, worker: str, staging_dir: Path) -> None:
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        '-m',
+        'dds_ports.worker',
+        f'--queue={queue_path}',
+        f'--worker-id={worker}',
+        f'--staging-dir={staging_dir}',
+        stdin=asyncio.subprocess.DEVNULL,
+    )
+    retc = await proc.wait()
+    requeued = queue.requeue_claimed_by(worker)
+    if retc != 0:
+        print(f'Worker {worker} exited with code {retc}. {requeued} jobs returned to the queue.')
+
+
+async def _import_job(repo: RepositoryAccess, queue: WorkQueue, job: Job, sem: asyncio.Semaphore, digests: DigestStore,
+                      imported: dict[PackageID, PackageInfo]) -> None:
+    assert job.sdist
+    async with sem:
+        try:
+            digest = await finalize(job.sdist)
+            if digests.is_unchanged(job.package_id, digest, repo.packages):
+                digests.record_equivalent(job.package_id)
+                digests.save()
+                queue.finish(job)
+                print(f'Package content is unchanged, not importing: {job.package_id}')
+                return
+            info = read_package_info(job.package_id, job.sdist)
+            print(f'Importing {job.package_id}')
+            await repo.import_sdist(job.sdist, timeout=IMPORT_TIMEOUT)
+            digests.record_import(job.package_id, digest)
+            digests.save()
+        except Exception:  # pylint: disable=broad-except
+            queue.fail(job, traceback.format_exc())
+            return
+        finally:
+            shutil.rmtree(job.sdist, ignore_errors=True)
+    queue.finish(job)
+    imported[job.package_id] = info
+    print(f'New package imported: {job.package_id}')
+
+
+async def _coordinate(repo: RepositoryAccess, queue: WorkQueue, queue_path: Path, run_dir: Path, n_workers: int,
+                      imported: dict[PackageID, PackageInfo]) -> None:
+    workers = [
+        asyncio.ensure_future(_run_worker(queue, queue_path, f'worker-{n}', run_dir / f'worker-{n}'))
+        for n in range(n_workers)
+    ]
+    import_sem = asyncio.Semaphore(10)
+    digests = DigestStore.open(repo.directory)
+    importing: list[asyncio.Future[None]] = []
+    restarts = 0
+    while 1:
+        all_exited = all(w.done() for w in workers)
+        for job in queue.take_prepared():
+            importing.append(asyncio.ensure_future(_import_job(repo, queue, job, import_sem, digests, imported)))
+        counts = queue.counts()
+        if all_exited and not counts.get('prepared'):
+            if counts.get('pending'):
+                if restarts == MAX_WORKER_RESTARTS:
+                    # Fail the remaining jobs, to be reported along with the other failures
+                    print(f'All workers have exited {restarts + 1} times with {counts["pending"]} jobs still pending. '
+                          'Giving up.')
+                    stranded = queue.claim('coordinator')
+                    while stranded is not None:
+                        queue.fail(stranded, f'All workers have exited {restarts + 1} times before preparing it')
+                        stranded = queue.claim('coordinator')
+                    break
+                # Every worker has died, but there is still work to do. Start over.
+                restarts += 1
+                print(f'All workers have exited with {counts["pending"]} jobs still pending. Restarting workers.')
+                workers = [
+                    asyncio.ensure_future(_run_worker(queue, queue_path, f'worker-{n}', run_dir / f'worker-{n}'))
+                    for n in range(n_workers)
+                ]
+                continue
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+    await wait_all(importing)
+
+
+class WorkersResult(NamedTuple):
+    """The outcome of :func:`run_with_workers`"""
+    imported: dict[PackageID, PackageInfo]
+    "The packages that were imported, with their dependency information"
+    failed: list[Job]
+    "The jobs of the packages that could not be prepared or imported, with the error"
+
+
+def run_with_workers(repo: RepositoryAccess, ports: Iterable[tuple[Path, Port]], n_workers: int) -> WorkersResult:
+    """
+    Prepare the given ports using ``n_workers`` worker processes, and import the
+    results into the repository. Ports for packages that are already in the
+    repository are skipped. A failure to prepare or import one package does not
+    stop the others.
+    """
+    run_dir = Path(tempfile.mkdtemp(dir=cache.cache_dir('staging'), prefix=f'run-{os.getpid()}-'))
+    queue_path = run_dir / 'queue.db'
+    queue = WorkQueue.open(queue_path)
+    imported: dict[PackageID, PackageInfo] = {}
+    try:
+        existing = known_packages(repo)
+        costs = CostModel(History.open())
+        try:
+            # Workers claim the ports that are expected to take longest first
+            for port_file, p in ports:
+                if p.package_id not in existing:
+                    queue.enqueue(p.package_id, port_file, priority=costs.priority(p.package_id, hint=cost_hint(p)))
+        finally:
+            costs.close()
+        asyncio.run(_coordinate(repo, queue, queue_path, run_dir, n_workers, imported))
+        failed = queue.failed()
+    finally:
+        queue.close()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return WorkersResult(imported, failed)
+
+
+def start() -> NoReturn:
+    sys.exit(worker_main(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    start()
@@ -0,0 +1,164 @@
+"""
+A SQLite-backed queue of port preparation jobs, shared between a coordinator
+process and its worker processes.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import time
+from pathlib import Path
+from typing import NamedTuple
+from typing_extensions import Literal
+
+from .port import PackageID
+
+JobState = Literal['pending', 'claimed', 'prepared', 'importing', 'failed', 'done']
+
+MAX_ATTEMPTS = 3
+"The number of times a job may be claimed by a worker that then dies, before the job fails"
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    package_id TEXT NOT NULL UNIQUE,
+    port_file TEXT NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    sdist TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority DESC, job_id);
+'''
+
+
+class Job(NamedTuple):
+    """A port preparation job"""
+    job_id: int
+    package_id: PackageID
+    port_file: Path
+    "The port file that defines the port for this package"
+    sdist: Path | None
+    "The prepared sdist directory, once the job is prepared"
+    error: str | None
+    "The error that was encountered, if the job failed"
+
+
+class WorkQueue:
+    """
+    A queue of jobs in a SQLite database file. Any number of processes may open
+    the same queue: Workers :meth:`claim` pending jobs one at a time and report
+    their results, and the coordinator collects the prepared sdists.
+    """
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self._db = db
+
+    @staticmethod
+    def open(path: Path) -> 'WorkQueue':
+        """Open (or create) the queue database at the given path"""
+        db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(_SCHEMA)
+        return WorkQueue(db)
+
+    def close(self) -> None:
+        """Close the queue database"""
+        self._db.close()
+
+    @staticmethod
+    def _job(row: 'tuple[int, str, str, str | None, str | None]') -> Job:
+        job_id, pid, port_file, sdist, error = row
+        return Job(job_id, PackageID.parse(pid), Path(port_file), Path(sdist) if sdist else None, error)
+
+    def enqueue(self, pid: PackageID, port_file: Path, *, priority: float = 0) -> None:
+        """
+        Add a job to prepare the given package. Jobs with a higher priority
+        are claimed first.
+        """
+        self._db.execute(
+            'INSERT INTO jobs (package_id, port_file, priority, updated_at) VALUES (?, ?, ?, ?)'
+            ' ON CONFLICT (package_id) DO NOTHING', (str(pid), str(port_file), priority, time.time()))
+
+    def claim(self, worker: str) -> Job | None:
+        """Claim the next pending job for the given worker, or ``None`` if no jobs are pending"""
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._db.execute('''
+                SELECT job_id, package_id, port_file, sdist, error FROM jobs
+                 WHERE state = 'pending'
+                 ORDER BY priority DESC, job_id
+                 LIMIT 1
+                ''').fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE jobs SET state = 'claimed', worker = ?, attempts = attempts + 1, updated_at = ?"
+                    ' WHERE job_id = ?', (worker, time.time(), row[0]))
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        return None if row is None else self._job(row)
+
+    def _set_state(self, job_id: int, state: JobState, *, sdist: Path | None = None, error: str | None = None) -> None:
+        self._db.execute('UPDATE jobs SET state = ?, sdist = ?, error = ?, updated_at = ? WHERE job_id = ?',
+                         (state, str(sdist) if sdist else None, error, time.time(), job_id))
+
+    def complete(self, job: Job, sdist: Path) -> None:
+        """Mark a claimed job as prepared, with the given sdist directory"""
+        self._set_state(job.job_id, 'prepared', sdist=sdist)
+
+    def fail(self, job: Job, error: str) -> None:
+        """Mark a claimed or importing job as failed"""
+        self._set_state(job.job_id, 'failed', error=error)
+
+    def finish(self, job: Job) -> None:
+        """Mark an importing job as done"""
+        self._set_state(job.job_id, 'done', sdist=job.sdist)
+
+    def take_prepared(self) -> list[Job]:
+        """
+        Collect all jobs that are prepared, and move them to the 'importing'
+        state. Call :meth:`finish` or :meth:`fail` on each when the import
+        completes.
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._db.execute(
+                "SELECT job_id, package_id, port_file, sdist, error FROM jobs WHERE state = 'prepared'").fetchall()
+            self._db.executemany("UPDATE jobs SET state = 'importing' WHERE job_id = ?", ((r[0], ) for r in rows))
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        return [self._job(r) for r in rows]
+
+    def failed(self) -> list[Job]:
+        """Get all jobs that have failed"""
+        rows = self._db.execute("SELECT job_id, package_id, port_file, sdist, error FROM jobs WHERE state = 'failed'")
+        return [self._job(r) for r in rows]
+
+    def requeue_claimed_by(self, worker: str) -> int:
+        """
+        Return the jobs that are claimed by the given (dead) worker to the
+        pending state. Jobs that have already been claimed
+        :data:`MAX_ATTEMPTS` times fail instead, as they are likely what kills
+        their workers. Returns the number of requeued jobs.
+        """
+        now = time.time()
+        self._db.execute(
+            "UPDATE jobs SET state = 'failed', error = ?, updated_at = ?"
+            " WHERE state = 'claimed' AND worker = ? AND attempts >= ?",
+            (f'The worker preparing the package exited {MAX_ATTEMPTS} times (last: {worker})', now, worker,
+             MAX_ATTEMPTS))
+        cur = self._db.execute(
+            "UPDATE jobs SET state = 'pending', worker = NULL, updated_at = ? WHERE state = 'claimed' AND worker = ?",
+            (now, worker))
+        return cur.rowcount
+
+    def counts(self) -> dict[JobState, int]:
+        """The number of jobs in each state"""
+        rows = self._db.execute('SELECT state, count(*) FROM jobs GROUP BY state')
+        return {state: n for state, n in rows}
@@ -1,10 +1,30 @@
-import itertools
 from pathlib import Path
 
 from semver import VersionInfo
 
 from dds_ports import auto, port, fs
 from dds_ports.crs import simple_placeholder_json
+from dds_ports.prune import DEFAULT_RULES
+
+# Files that should not be included:
+ABSEIL_PRUNE = DEFAULT_RULES.extended(exclude=(f'absl/*/{pat}' for pat in (
+    '*_test.c*',
+    '*_testing.c*',
+    '*_benchmark.c*',
+    '*_benchmarks.c*',
+    'benchmarks.c*',
+    '*_test_common.c*',
+    'mocking_*.c*',
+    'test_util.cc',
+    'mutex_nonprod.cc',
+    'named_generator.cc',
+    'print_hash_of.cc',
+    '*_gentables.cc',
+)))
+
+# Abseil is by far the largest of the ports. Schedule it early, even before
+# there is any history for it.
+ABSEIL_COST_HINT = 120.0
 
 
 async def fixup_abseil(root: Path) -> None:
@@ -13,22 +33,6 @@ async def fixup_abseil(root: Path) -> None:
         whence=root,
         into=root / 'src',
     )
-    # Files that should not be included:
-    rm_patterns = (
-        '*_test.c*',
-        '*_testing.c*',
-        '*_benchmark.c*',
-        '*_benchmarks.c*',
-        'benchmarks.c*',
-        '*_test_common.c*',
-        'mocking_*.c*',
-        'test_util.cc',
-        'mutex_nonprod.cc',
-        'named_generator.cc',
-        'print_hash_of.cc',
-        '*_gentables.cc',
-    )
-    await fs.remove_files(itertools.chain.from_iterable(root.joinpath('src/absl').rglob(pat) for pat in rm_patterns))
 
 
 async def all_ports() -> port.PortIter:
@@ -46,4 +50,6 @@ async def all_ports() -> port.PortIter:
         crs_json=simple_placeholder_json('abseil'),
         fs_transform=fixup_abseil,
         try_build=False,
+        prune=ABSEIL_PRUNE,
+        cost_hint=ABSEIL_COST_HINT,
     ) for tag, version_str in tags)
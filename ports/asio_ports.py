@@ -2,29 +2,30 @@ from pathlib import Path
 from semver import VersionInfo
 import re
 
-from dds_ports import auto, port, fs, github, crs
+from dds_ports import auto, port, fs, github, crs, selection
+from dds_ports.prune import DEFAULT_RULES
+
+ASIO_PRUNE = DEFAULT_RULES.extended(exclude=(
+    'asio/src/doc/',
+    'asio/src/examples/',
+    'asio/src/tests/',
+    'asio/src/tools/',
+))
 
 
 async def fixup_asio(root: Path) -> None:
     root.joinpath('asio/include').rename(root / 'include')
     root.joinpath('asio/src').rename(root / 'src')
-    rm_dirs = (
-        'doc',
-        'examples',
-        'tests',
-        'tools',
-    )
-    for d in rm_dirs:
-        await fs.remove_directory(root / 'src' / d)
-
     config_hpp = root / 'include/asio/detail/config.hpp'
     config_hpp_lines = config_hpp.read_text().splitlines()
     config_hpp_lines.insert(13, '#define ASIO_STANDALONE 1')
     config_hpp_lines.insert(14, '#define ASIO_SEPARATE_COMPILATION 1')
-    config_hpp.write_text('\n'.join(config_hpp_lines))
+    fs.detach(config_hpp).write_text('\n'.join(config_hpp_lines))
 
 
 async def all_ports() -> port.PortIter:
+    if not selection.current().wants_package('asio'):
+        return ()
     owner = 'chriskohlhoff'
     tags = await github.get_repo_tags(owner, 'asio')
     tag_re = re.compile(r'asio-(\d+)-(\d+)-(\d+)')
@@ -39,4 +40,5 @@ async def all_ports() -> port.PortIter:
         crs_json=crs.simple_placeholder_json('asio'),
         fs_transform=fixup_asio,
         try_build=version != VersionInfo(1, 16, 0),
+        prune=ASIO_PRUNE,
     ) for tag, version in versions if version >= VersionInfo(1, 12, 0))
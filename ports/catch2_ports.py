@@ -3,7 +3,7 @@ import itertools
 
 from semver import VersionInfo
 
-from dds_ports import auto, port, fs, github, util, crs
+from dds_ports import auto, port, fs, github, util, crs, selection
 
 CATCH2_V2_HEADER_PREFIX = '''
 #ifndef CATCH2_DDS_WRAPPED_INCLUDED
@@ -40,7 +40,7 @@ async def fixup_catch2_v2(root: Path) -> None:
         whence=root / 'single_include/',
     )
     main_header = root / 'src/catch2/catch.hpp'
-    main_header.write_text(  #
+    fs.detach(main_header).write_text(  #
         CATCH2_V2_HEADER_PREFIX +  #
         main_header.read_text()  #
         + CATCH2_V2_HEADER_SUFFIX,  #
@@ -60,6 +60,8 @@ async def fixup_catch2_v3(root: Path) -> None:
 
 
 async def all_ports() -> port.PortIter:
+    if not selection.current().wants_package('catch2'):
+        return ()
     tags = await github.get_repo_tags('catchorg', 'catch2')
     versions = list((tag, util.tag_as_version(tag)) for tag in tags)
 
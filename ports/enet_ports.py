@@ -50,11 +50,11 @@ async def fixup_enet(dirpath: Path) -> None:
         files=dirpath.glob('*.c'),
         into=dirpath / 'src',
     )
-    dirpath.joinpath('include/enet/config.h').write_text(ENET_CONFIG)
+    fs.detach(dirpath / 'include/enet/config.h').write_text(ENET_CONFIG)
     main_h = dirpath / 'include/enet/enet.h'
     main_h_content = main_h.read_text()
     main_h_content = '#include <enet/config.h>\n' + main_h_content
-    main_h.write_text(main_h_content)
+    fs.detach(main_h).write_text(main_h_content)
 
 
 async def all_ports() -> port.PortIter:
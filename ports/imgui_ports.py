@@ -6,11 +6,14 @@ import textwrap
 from pathlib import Path
 from typing import Iterable, NamedTuple, Sequence, Union
 
-from dds_ports import crs, fs, git, github, port
+from dds_ports import crs, fs, git, github, port, selection
 from semver import VersionInfo
 
 IMGUI_PORT_REVISION = 1
 
+# Rough seconds to prepare and import one version, used until there is history
+IMGUI_COST_HINT = 60.0
+
 CONFIG_INCLUDE_TWEAKS = r'''
 #pragma once
 
@@ -245,7 +248,7 @@ async def fixup_clone(root: Path, version: VersionInfo, rev: int) -> None:
     config_h = src_dir / 'imconfig.h'
     config_content = config_h.read_text('utf-8')
     new_content = config_content.replace('#pragma once', CONFIG_INCLUDE_TWEAKS)
-    config_h.write_bytes(new_content.encode('utf-8'))
+    fs.detach(config_h).write_bytes(new_content.encode('utf-8'))
     for inf in backends:
         await fixup_backend(root, src_dir, inf)
     # yapf: disable
@@ -274,10 +277,11 @@ class ImGuiPort(git.SimpleGitPort):
 
 def port_for_tag(tag: str, major: int, minor: int, patch: int) -> ImGuiPort:
     return ImGuiPort(
-        'imgui',
+        github.gh_clone_key('ocornut', 'imgui'),
         port.PackageID('imgui', VersionInfo(major, minor, patch), IMGUI_PORT_REVISION),
         github.gh_repo_url('ocornut', 'imgui'),
         tag,
+        cost_hint=IMGUI_COST_HINT,
     )
 
 
@@ -292,5 +296,7 @@ def ports_for_tags(tags: Iterable[str]) -> port.PortIter:
 
 
 async def all_ports() -> port.PortIter:
+    if not selection.current().wants_package('imgui'):
+        return ()
     tags = await github.get_repo_tags('ocornut', 'imgui')
     return ports_for_tags(tags)
@@ -165,12 +165,12 @@ async def fixup_libsodium(root: Path) -> None:
     export_h = root / 'include/sodium/export.h'
     export_h_lines = export_h.read_text().splitlines()
     export_h_lines.insert(8, '#define SODIUM_STATIC 1')
-    export_h.write_text('\n'.join(export_h_lines))
+    fs.detach(export_h).write_text('\n'.join(export_h_lines))
     # Write our custom compile-time config logic
     common_h = root / 'include/sodium/private/common.h'
     common_h_lines = common_h.read_text().splitlines()
     common_h_lines.insert(1, SODIUM_CONFIG)
-    common_h.write_text('\n'.join(common_h_lines))
+    fs.detach(common_h).write_text('\n'.join(common_h_lines))
     # Copy the version file that is used for MSVC
     root.joinpath('builds/msvc/version.h').rename(root / 'include/sodium/version.h')
     # They do bad #include assumptions, so duplicate some public headers into the private root
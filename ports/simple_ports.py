@@ -2,7 +2,6 @@ import itertools
 import re
 import textwrap
 from pathlib import Path
-from typing import Iterable
 
 from semver import VersionInfo
 
@@ -28,7 +27,7 @@ async def fixup_spdlog(root: Path) -> None:
     tweakme_h = root / 'include/spdlog/tweakme.h'
     tweakme_h_lines = tweakme_h.read_text().splitlines()
     tweakme_h_lines.insert(13, '#define SPDLOG_FMT_EXTERNAL 1')
-    tweakme_h.write_text('\n'.join(tweakme_h_lines))
+    fs.detach(tweakme_h).write_text('\n'.join(tweakme_h_lines))
 
 
 async def fixup_fmt_8(root: Path) -> None:
@@ -61,7 +60,7 @@ async def fixup_immer(root: Path) -> None:
         #endif
         '''),
     )
-    config_hpp.write_text('\n'.join(config_lines))
+    fs.detach(config_hpp).write_text('\n'.join(config_lines))
 
 
 def _nvstdexec_tagmap(tag: str) -> VersionInfo | None:
@@ -72,8 +71,8 @@ def _nvstdexec_tagmap(tag: str) -> VersionInfo | None:
     return VersionInfo(int(maj), int(mn), 0, rc)
 
 
-async def all_ports() -> Iterable[port.Port]:
-    return itertools.chain.from_iterable(await util.wait_all((
+async def all_ports() -> port.PortStream:
+    listings = (
         auto.enumerate_simple_github(
             owner='zajo',
             repo='leaf',
@@ -235,4 +234,8 @@ async def all_ports() -> Iterable[port.Port]:
             repo='debate',
             pkg_name='vob.debate',
         ),
-    )))
+    )
+    # Yield the ports of each repository as soon as its tags are listed
+    async for ports in util.iter_completed(listings):
+        for p in ports:
+            yield p
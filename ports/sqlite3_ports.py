@@ -1,15 +1,14 @@
 import itertools
 from pathlib import Path, PurePosixPath
-import tempfile
 from semver import VersionInfo
 import zipfile
-from typing import NamedTuple, Sequence
-import aiohttp.client
+from typing import TYPE_CHECKING, NamedTuple, Sequence
 
-from dagon import task
-import dagon.ui
+from dds_ports import cache, port, crs, staging
+from dds_ports.deferred import dagon
 
-from dds_ports import port, util, crs
+if TYPE_CHECKING:
+    from dagon import task
 
 
 class SQLite3VersionGroup(NamedTuple):
@@ -85,21 +84,13 @@ SRC_PREFIX = r'''
 
 
 async def prep_sqlite3_dir(destdir: Path, url: str, version: VersionInfo) -> None:
-    topdir = PurePosixPath(url).with_suffix('').name
-    with util.temporary_directory(f'sqlite3-{version}') as tmpdir:
-        zip_dest = tmpdir / 'archive.zip'
-        dagon.ui.status(f'Downloading SQLite3 archive for {version}')
-        async with aiohttp.client.ClientSession() as sess:
-            resp = await sess.get(url)
-            resp.raise_for_status()
-            with zip_dest.open('wb') as ofd:
-                while 1:
-                    buf = await resp.content.read(1024)
-                    if not buf:
-                        break
-                    ofd.write(buf)
-
-        with zipfile.ZipFile(zip_dest) as zf:
+    archive = PurePosixPath(url)
+    topdir = archive.with_suffix('').name
+    dagon.ui.status(f'Downloading SQLite3 archive for {version}')
+    zip_path = await cache.cached_download(url, f'sqlite3/{archive.name}')
+
+    async with cache.locked(zip_path, shared=True):
+        with zipfile.ZipFile(zip_path) as zf:
             destdir.joinpath('src/sqlite3').mkdir(exist_ok=True, parents=True)
             for fname in ('sqlite3.h', 'sqlite3.c', 'sqlite3ext.h'):
                 with zf.open(f'{topdir}/{fname}') as sf:
@@ -117,7 +108,7 @@ class SQLite3Port:
     async def _prep_sd(self) -> Path:
         ver = self.version
         url = f'https://sqlite.org/{self.year}/sqlite-amalgamation-{ver.major}{ver.minor:0>2}{ver.patch:0>2}00.zip'
-        tmpdir = Path(tempfile.mkdtemp(suffix=f'-dds-ports-sqlite3-{ver}'))
+        tmpdir = await staging.current().create(str(self.package_id))
 
         await prep_sqlite3_dir(tmpdir, url, ver)
         crs.write_crs_file(
@@ -143,8 +134,8 @@ class SQLite3Port:
         )
         return tmpdir
 
-    def make_prep_task(self) -> task.Task[Path]:
-        return task.fn_task(str(self.package_id), self._prep_sd)
+    def make_prep_task(self) -> 'task.Task[Path]':
+        return dagon.task.fn_task(str(self.package_id), self._prep_sd)
 
 
 async def all_ports() -> port.PortIter:
@@ -1,13 +1,10 @@
-import itertools
-from typing import Iterable
-
 from semver import VersionInfo
 
 from dds_ports import github, util, port
 
 
-async def all_ports() -> Iterable[port.Port]:
-    return itertools.chain.from_iterable(await util.wait_all((
+async def all_ports() -> port.PortStream:
+    listings = (
         github.native_dds_ports_for_github_repo(
             owner='vector-of-bool',
             repo='semver',
@@ -33,4 +30,8 @@ async def all_ports() -> Iterable[port.Port]:
             pkg_name='vob-semester',
             revision=2,
         ),
-    )))
+    )
+    # Yield the ports of each repository as soon as its tags are listed
+    async for ports in util.iter_completed(listings):
+        for p in ports:
+            yield p
@@ -0,0 +1,126 @@
+"""
+Tests of the ports that are prepared from source archives (see
+:mod:`dds_ports.archive`), against archives served locally in place of GitHub.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from contextlib import AsyncExitStack
+from pathlib import Path
+from unittest import mock
+
+from aiohttp import web
+from semver import VersionInfo
+
+from dds_ports import archive, blobs, net, staging
+from dds_ports.port import PackageID
+
+
+def _tarball(*members: tuple[tarfile.TarInfo, bytes]) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        for info, content in members:
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content) if info.isfile() else None)
+    return buf.getvalue()
+
+
+def _file(name: str, content: bytes, mode: int = 0o644) -> tuple[tarfile.TarInfo, bytes]:
+    info = tarfile.TarInfo(name)
+    info.mode = mode
+    return info, content
+
+
+def _member(name: str, kind: bytes, linkname: str = '') -> tuple[tarfile.TarInfo, bytes]:
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.linkname = linkname
+    info.mode = 0o755
+    return info, b''
+
+
+class ArchivePortTest(unittest.IsolatedAsyncioTestCase):
+    """Prepares sdists from archives served by a local codeload server"""
+    async def asyncSetUp(self) -> None:
+        stack = AsyncExitStack()
+        self.addAsyncCleanup(stack.aclose)
+        tmp = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        self.outside = tmp / 'outside'
+        self.outside.mkdir()
+        self.archives: dict[str, bytes] = {}
+
+        async def serve(request: web.Request) -> web.Response:
+            body = self.archives.get(request.match_info['tag'])
+            if body is None:
+                raise web.HTTPNotFound()
+            return web.Response(body=body, content_type='application/gzip')
+
+        app = web.Application()
+        app.router.add_get('/{owner}/{repo}/tar.gz/refs/tags/{tag}', serve)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        stack.push_async_callback(runner.cleanup)
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        env = {
+            'DDS_PORTS_CODELOAD_URL': f'http://127.0.0.1:{runner.addresses[0][1]}',
+            'DDS_PORTS_CACHE_DIR': str(tmp / 'cache'),
+        }
+        stack.enter_context(mock.patch.dict(os.environ, env))
+        stack.enter_context(staging.staging_area(tmp / 'staging'))
+        await stack.enter_async_context(net.session_scope())
+
+    async def _prepare(self, tag: str, *members: tuple[tarfile.TarInfo, bytes]) -> Path:
+        self.archives[tag] = _tarball(*members)
+        pid = PackageID('proj', VersionInfo.parse(tag), 1)
+        port = archive.github_archive_port('owner', 'proj', tag, pid)
+        return await port._make_sdist()  # pylint: disable=protected-access
+
+    async def test_extracts_tree(self) -> None:
+        sdist = await self._prepare(
+            '1.0.0',
+            _member('proj-1.0.0', tarfile.DIRTYPE),
+            _file('proj-1.0.0/src/a.cpp', b'int a;\n'),
+            _file('proj-1.0.0/tool.sh', b'#!/bin/sh\n', 0o755),
+            _member('proj-1.0.0/include/a.cpp', tarfile.SYMTYPE, '../src/a.cpp'),
+            _member('proj-1.0.0/src/b.cpp', tarfile.LNKTYPE, 'proj-1.0.0/src/a.cpp'),
+            _file('proj-1.0.0/.github/workflows/ci.yml', b'on: push\n'),
+        )
+        self.assertEqual((sdist / 'src/a.cpp').read_bytes(), b'int a;\n')
+        self.assertTrue(os.access(sdist / 'tool.sh', os.X_OK))
+        self.assertEqual(os.readlink(sdist / 'include/a.cpp'), '../src/a.cpp')
+        self.assertTrue((sdist / 'src/b.cpp').samefile(sdist / 'src/a.cpp'))
+        self.assertEqual((sdist / 'src/a.cpp').stat().st_mtime, blobs.BLOB_MTIME)
+        self.assertFalse((sdist / '.github').exists())
+
+    async def test_rejects_absolute_symlink(self) -> None:
+        with self.assertRaisesRegex(RuntimeError, 'symlink'):
+            await self._prepare('1.0.1', _member('proj-1.0.1/lib', tarfile.SYMTYPE, str(self.outside)))
+
+    async def test_rejects_escaping_symlink(self) -> None:
+        with self.assertRaisesRegex(RuntimeError, 'symlink'):
+            await self._prepare('1.0.2', _member('proj-1.0.2/lib', tarfile.SYMTYPE, '../../../outside'))
+
+    async def test_does_not_write_through_symlinks(self) -> None:
+        # Each link on its own leads to the parent directory of the link, but
+        # together they lead out of the tree (to <tmp>/staging/run-*/<sdist>/..)
+        links = [_member(f'proj-1.0.3/d{"/up" * n}', tarfile.SYMTYPE, '..') for n in range(1, 5)]
+        with self.assertRaisesRegex(RuntimeError, 'symlink'):
+            await self._prepare('1.0.3', *links, _file('proj-1.0.3/d/up/up/up/up/outside/evil', b'evil'))
+        self.assertEqual(list(self.outside.iterdir()), [])
+
+    async def test_rejects_hard_link_to_pruned_file(self) -> None:
+        with self.assertRaisesRegex(RuntimeError, 'hard link'):
+            await self._prepare(
+                '1.0.4',
+                _file('proj-1.0.4/.github/a.yml', b'on: push\n'),
+                _member('proj-1.0.4/a.yml', tarfile.LNKTYPE, 'proj-1.0.4/.github/a.yml'),
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Tests of resuming an interrupted build (see :mod:`dds_ports.journal`): The
+sdists that the interrupted build prepared are imported without being
+prepared again.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import tempfile
+import unittest
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import Sequence, Union
+from unittest import mock
+
+from dds_ports import cache, journal, process, validate
+from dds_ports.builder import BuildConfig, open_builder
+from dds_ports.pipeline import PipelineResult
+from dds_ports.repo import RepositoryAccess
+
+_PORT_FILE = '''
+from semver import VersionInfo
+
+from dds_ports import crs, port, staging
+from dds_ports.deferred import dagon
+
+
+class CountedPort:
+    """A port that logs each of its preps"""
+    def __init__(self, version: str) -> None:
+        self.package_id = port.PackageID('pkg', VersionInfo.parse(version), 1)
+
+    async def _prep(self):
+        with open({log!r}, 'a') as log:
+            log.write(f'{{self.package_id}}\\n')
+        tree = await staging.current().create(str(self.package_id))
+        json = crs.simple_placeholder_json('pkg')
+        json.update(name='pkg', version=str(self.package_id.version), **{{'pkg-version': 1}})
+        crs.write_crs_file(tree, json)
+        return tree
+
+    def make_prep_task(self):
+        return dagon.task.fn_task(f'{{self.package_id}}@prep', self._prep)
+
+
+async def all_ports():
+    return [CountedPort('1.0.0'), CountedPort('1.1.0')]
+'''
+
+
+class ResumeTest(unittest.IsolatedAsyncioTestCase):
+    """Interrupts a build while it imports, and resumes it"""
+    async def asyncSetUp(self) -> None:
+        stack = AsyncExitStack()
+        self.addAsyncCleanup(stack.aclose)
+        tmp = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        self.preps_log = tmp / 'preps.log'
+        ports_dir = tmp / 'ports'
+        ports_dir.mkdir()
+        (ports_dir / 'counted_ports.py').write_text(_PORT_FILE.format(log=str(self.preps_log)))
+        self.config = BuildConfig(ports_dir, tmp / 'repo')
+        self.imports_started = asyncio.Event()
+        self.importing: list[str] = []
+        self.interrupt = True
+        stack.enter_context(mock.patch.dict(os.environ, {'DDS_PORTS_CACHE_DIR': str(tmp / 'cache')}))
+        stack.enter_context(mock.patch.object(RepositoryAccess, 'open', lambda dirpath: RepositoryAccess(dirpath, [])))
+        stack.enter_context(mock.patch.object(process, 'run', self._run_process))
+        stack.enter_context(mock.patch.object(validate, 'validate_imports', mock.AsyncMock()))
+
+    async def _run_process(self, command: Sequence[Union[str, Path]], **_kwargs: object) -> None:
+        self.importing.append(str(command[4]))
+        if not self.interrupt:
+            return
+        if len(self.importing) == 2:
+            self.imports_started.set()
+        # Until the build is interrupted
+        await asyncio.Event().wait()
+
+    async def _build(self, *, resume: bool) -> PipelineResult:
+        async with open_builder(self.config) as builder:
+            return await builder.build(resume=resume)
+
+    async def test_resume_does_not_prepare_again(self) -> None:
+        first = asyncio.ensure_future(self._build(resume=False))
+        await asyncio.wait_for(self.imports_started.wait(), 10)
+        first.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        sdists = journal.unfinished_sdists()
+        self.assertEqual(sdists, set(Path(p) for p in self.importing))
+        self.assertTrue(all(p.is_dir() for p in sdists))
+
+        # The interrupted run is gone, but its staging directory is kept for the resumed run
+        with mock.patch.object(cache, '_pid_is_alive', return_value=False):
+            cache.collect_garbage(0)
+        self.assertTrue(all(p.is_dir() for p in sdists))
+
+        self.interrupt = False
+        self.importing.clear()
+        result = await asyncio.wait_for(self._build(resume=True), 10)
+        self.assertEqual(sorted(map(str, result.imported)), ['pkg@1.0.0~1', 'pkg@1.1.0~1'])
+        self.assertEqual(set(Path(p) for p in self.importing), sdists)
+        self.assertEqual(len(self.preps_log.read_text().splitlines()), 2)
+        self.assertFalse(any(p.exists() for p in sdists))
+        self.assertEqual(journal.unfinished_sdists(), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Tests of the staging area (see :mod:`dds_ports.staging`) as the pipeline uses
+it to prepare ports.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import tempfile
+import unittest
+from contextlib import AsyncExitStack
+from pathlib import Path
+
+from dagon import task
+from semver import VersionInfo
+
+from dds_ports import staging
+from dds_ports.builder import default_extensions
+from dds_ports.pipeline import TaskFailed, extension_context, prepare_port
+from dds_ports.port import PackageID
+
+
+class _Port:
+    """A port whose prep creates a staging directory, and then fails if ``fail``"""
+    def __init__(self, version: str, *, fail: bool) -> None:
+        self.package_id = PackageID('pkg', VersionInfo.parse(version), 1)
+        self._fail = fail
+
+    async def _prep(self) -> Path:
+        tree = await staging.current().create(str(self.package_id))
+        (tree / 'file.txt').write_text('content')
+        if self._fail:
+            raise RuntimeError('The prep failed')
+        return tree
+
+    def make_prep_task(self) -> task.Task[Path]:
+        return task.fn_task(f'{self.package_id}@prep', self._prep)
+
+
+class FailedPrepTest(unittest.IsolatedAsyncioTestCase):
+    """Preps that fail release their staging directories"""
+    async def asyncSetUp(self) -> None:
+        stack = AsyncExitStack()
+        self.addAsyncCleanup(stack.aclose)
+        tmp = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        # Only one sdist fits in the budget
+        self.area = stack.enter_context(staging.staging_area(tmp / 'staging', budget=1))
+        exts = default_extensions()
+        stack.enter_context(exts.app_context())
+        await stack.enter_async_context(extension_context(exts))
+        self.exts = exts
+
+    async def test_failed_prep_does_not_block_later_preps(self) -> None:
+        for version in ('1.0.0', '1.0.1', '1.0.2'):
+            with self.assertRaises(TaskFailed):
+                await prepare_port(_Port(version, fail=True), self.exts)  # type: ignore
+        self.assertEqual(self.area.estimated_usage, 0)
+        self.assertEqual(list(self.area.root.iterdir()), [])
+        sdist = await asyncio.wait_for(prepare_port(_Port('1.1.0', fail=False), self.exts), 10)  # type: ignore
+        self.assertEqual((sdist / 'file.txt').read_text(), 'content')
+
+
+if __name__ == '__main__':
+    unittest.main()